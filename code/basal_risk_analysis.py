@@ -10,11 +10,41 @@ from sklearn.ensemble import IsolationForest
 from pathlib import Path
 from mpl_toolkits.mplot3d import Axes3D
 from datetime import datetime
-from bolus_risk_analysis import train_model
+from bolus_risk_analysis import get_model_predictions
 from utils import extract_array
+from bg_features import fill_missing_bg_features
+
+# Columns that are passed into the temp basal model
+temp_basal_features = [
+    "duration",
+    "percent",
+    "rate",
+    "bgInput",
+    "bg_30_min_before",
+    "bg_75_min_after",
+    "smoothed_bg",
+    "bg_rate_of_change",
+    "bg_acceleration",
+    "bg_variability",
+    "iob",
+    "cob",
+]
+
+
+def find_abnormal_temp_basals(
+    processed_df, bgs, model_type="knn", model_path=None, score_only=False
+):
+    """
+    Identify the abnormal temp basals in a df of processed doses
 
+    processed_df: df of processed dose data
+    bgs: df of BG data
+    model_type: type of model to use; see 'bolus_risk_analysis.train_model' for the options
+    model_path: path to save the trained model to, or to load it from if "score_only" is True
+    score_only: whether to score the temp basals with the stored model at "model_path" instead of training a new one
 
-def find_abnormal_temp_basals(processed_df, bgs, model_type="knn"):
+    Returns: df of the abnormal temp basals
+    """
     print(processed_df.head())
     df = extract_and_process_temp_basals(processed_df)
 
@@ -25,22 +55,12 @@ def find_abnormal_temp_basals(processed_df, bgs, model_type="knn"):
     print("Shape", shape)
     print(df.describe().apply(lambda s: s.apply(lambda x: format(x, "f"))))
 
-    data_to_predict = df[
-        [
-            "duration",
-            "percent",
-            "rate",
-            "bgInput",
-            "bg_30_min_before",
-            "bg_75_min_after",
-        ]
-    ]
-
-    model = train_model(data_to_predict, model_type)
-    predictions = model.predict(data_to_predict)
+    data_to_predict = df[temp_basal_features]
+    predictions, scores = get_model_predictions(
+        data_to_predict, model_type, model_path, score_only, df["time"]
+    )
     df["abnormal"] = predictions
-    if model_type == "isolation_forest":
-        df["abnormality_score"] = model.decision_function(data_to_predict)
+    df["abnormality_score"] = scores
 
     # Plot the results
     # Note that this plot only incorporates 3 dimensions of the data, so there are other
@@ -128,6 +148,12 @@ def extract_and_process_temp_basals(processed_df):
             "bgInput",
             "bg_30_min_before",
             "bg_75_min_after",
+            "smoothed_bg",
+            "bg_rate_of_change",
+            "bg_acceleration",
+            "bg_variability",
+            "iob",
+            "cob",
         ]
     ]
     type_map = {"temp": 0}
@@ -147,7 +173,10 @@ def extract_and_process_temp_basals(processed_df):
         ],
         inplace=True,
     )
+    df = fill_missing_bg_features(df)
     # Convert the time strings to pandas datetime format
     df["time"] = pd.to_datetime(df["time"], infer_datetime_format=True)
+    # Streaming models score the doses in the order they occurred
+    df = df.sort_values("time", kind="stable")
 
     return df
@@ -0,0 +1,152 @@
+import numpy as np
+import pandas as pd
+
+from scipy.signal import savgol_coeffs
+
+from utils import sliding_windows
+
+"""
+BG trend features, computed over a patient's whole BG grid at once & looked up at each dose time.
+
+The smoothed BG & its derivatives come from a Savitzky-Golay filter: a quadratic is fit to
+the last 'window_length' BGs at every grid point, and the features are the fit's value,
+slope & curvature at that grid point. Because each fit only uses BGs at or before its grid
+point, the features at a dose time don't depend on BGs after the dose, and they can be
+computed the same way as BGs arrive in real time. Grid points with a missing BG in their
+window have no smoothed BG or derivatives.
+"""
+
+# Columns of the BG features, in the order 'get_bg_features' returns them
+bg_feature_columns = [
+    "smoothed_bg",  # mmol/L
+    "bg_rate_of_change",  # mmol/L per minute
+    "bg_acceleration",  # mmol/L per minute^2
+    "bg_variability",  # standard deviation of the BGs, in mmol/L
+]
+
+
+def get_bg_features(
+    bg_values, bg_interval=5, window_length=7, polyorder=2, variability_length=12
+):
+    """
+    Compute the BG features at every point of a BG grid
+
+    bg_values: array of BGs (in mmol/L) at 'bg_interval' minute intervals, where missing BGs are -1 or NaN
+    bg_interval: minutes between each BG value
+    window_length: number of BGs the smoothed BG & its derivatives are fit to
+    polyorder: order of the polynomial that is fit to the BGs
+    variability_length: number of BGs the variability is computed over; at least half
+                        of them must be present
+
+    Returns: 2d array with one row per grid point & one column per feature in 'bg_feature_columns'
+    """
+    values = np.asarray(bg_values, dtype=float)
+    values = np.where(values == -1, np.nan, values)
+    features = np.full((len(values), len(bg_feature_columns)), np.nan)
+
+    # Savitzky-Golay coefficients for the fit's value & derivatives at the end of each window
+    coefficients = np.stack(
+        [
+            savgol_coeffs(
+                window_length,
+                polyorder,
+                deriv=deriv,
+                delta=bg_interval,
+                pos=window_length - 1,
+                use="dot",
+            )
+            for deriv in range(3)
+        ]
+    )
+    windows, missing = sliding_windows(values, window_length, dtype=float)
+    if len(windows) > 0:
+        smoothed = windows @ coefficients.T
+        smoothed[missing.any(axis=1)] = np.nan
+        features[window_length - 1 :, :3] = smoothed
+
+    # Rolling standard deviation from cumulative sums, skipping missing BGs
+    is_present = ~np.isnan(values)
+    present_values = np.where(is_present, values, 0)
+    sums, squared_sums, counts = [
+        np.concatenate([[0], np.cumsum(series)])
+        for series in [present_values, present_values**2, is_present]
+    ]
+    ends = np.arange(1, len(values) + 1)
+    starts = np.maximum(ends - variability_length, 0)
+    count = counts[ends] - counts[starts]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = (sums[ends] - sums[starts]) / count
+        variance = (squared_sums[ends] - squared_sums[starts]) / count - mean**2
+    features[:, 3] = np.where(
+        count >= variability_length / 2, np.sqrt(np.maximum(variance, 0)), np.nan
+    )
+
+    return features
+
+
+def get_bg_features_df(bgs, bg_interval=5):
+    """
+    Compute the BG features at every point of a BG grid
+
+    bgs: df with "time" & "value" columns, at a consistent interval of 'bg_interval' minutes
+
+    Returns: df with the "time" of each grid point & the columns in 'bg_feature_columns'
+    """
+    features = pd.DataFrame(
+        get_bg_features(bgs["value"].values, bg_interval),
+        columns=bg_feature_columns,
+        index=bgs.index,
+    )
+    features.insert(0, "time", bgs["time"])
+    return features
+
+
+def join_bg_features(doses, bg_features, bg_interval=5, columns=bg_feature_columns):
+    """
+    Add the BG features at the grid point at or before each dose
+
+    doses: df of doses with a "time" column
+    bg_features: df from 'get_bg_features_df', or another df of features on a grid
+                 (like from 'on_board_features.get_on_board_features_df')
+    columns: feature columns of 'bg_features' to add
+
+    Returns: the doses df with the feature columns added
+    """
+    doses = doses.copy()
+    grid_times = pd.to_datetime(bg_features["time"])
+    if len(grid_times) == 0:
+        for column in columns:
+            doses[column] = np.nan
+        return doses
+
+    indices = np.floor(
+        (pd.to_datetime(doses["time"]) - grid_times.iloc[0])
+        / pd.Timedelta(minutes=bg_interval)
+    ).values
+    in_grid = (indices >= 0) & (indices < len(bg_features))
+    values = np.full((len(doses), len(columns)), np.nan)
+    values[in_grid] = bg_features[columns].values[indices[in_grid].astype(int)]
+    for i, column in enumerate(columns):
+        doses[column] = values[:, i]
+
+    return doses
+
+
+def fill_missing_bg_features(df, variability_fill_value=None):
+    """
+    Fill in the BG features of doses that had missing BGs around them, so they can be
+    passed into a model: the smoothed BG becomes the dose's "bgInput", the derivatives
+    become 0, and the variability becomes 'variability_fill_value'
+
+    variability_fill_value: value for missing variabilities; defaults to the median variability
+    """
+    if variability_fill_value is None:
+        variability_fill_value = df["bg_variability"].median()
+    return df.fillna(
+        {
+            "smoothed_bg": df["bgInput"],
+            "bg_rate_of_change": 0,
+            "bg_acceleration": 0,
+            "bg_variability": variability_fill_value,
+        }
+    )
@@ -0,0 +1,156 @@
+import struct
+import d6tflow
+import numpy as np
+import pandas as pd
+
+from os.path import exists, splitext
+
+"""
+Binary store for a patient's BGs on a regular time grid, so that tools can look up
+the BGs in a time range by arithmetic instead of parsing & searching a csv.
+
+Each file is a small header followed by one float32 BG (in mmol/L) per grid point,
+where missing BGs are NaN. The BGs are memory-mapped when the file is opened, so only
+the pages that are read are loaded, and processes that open the same file share them.
+
+Header (little-endian):
+    - 8 bytes: the format name, "BGGRID01"
+    - int64: time of the first grid point, in seconds since the Unix epoch
+    - int64: minutes between grid points
+    - int64: number of grid points
+    - int64: 1 if the times are in UTC, 0 if they're timezone-naive
+    - 24 bytes of padding
+"""
+
+grid_format_name = b"BGGRID01"
+header_format = "<8sqqqq24x"
+header_size = struct.calcsize(header_format)
+
+
+def get_bg_grid_path(csv_path):
+    """Get the path of the BG grid that's saved alongside a TaskGetBGData output csv"""
+    return splitext(csv_path)[0] + ".bggrid"
+
+
+def write_bg_grid(path, bgs, bg_interval=5):
+    """
+    Save BGs to a grid file
+
+    path: path to save the grid to
+    bgs: df with "time" & "value" columns, where missing BGs are -1 or NaN
+    bg_interval: minutes between each grid point
+    """
+    times = pd.to_datetime(bgs["time"])
+    is_utc = times.dt.tz is not None
+    times = times.dt.tz_convert("UTC").dt.tz_localize(None) if is_utc else times
+
+    start = times.min().floor(str(bg_interval) + "min")
+    slots = ((times - start) // pd.Timedelta(minutes=bg_interval)).values
+    values = np.full(slots.max() + 1 if len(slots) > 0 else 0, np.nan, dtype="<f4")
+    bg_values = bgs["value"].to_numpy(dtype=float)
+    values[slots] = np.where(bg_values == -1, np.nan, bg_values)
+
+    with open(path, "wb") as f:
+        f.write(
+            struct.pack(
+                header_format,
+                grid_format_name,
+                int(start.value // 10**9) if len(slots) > 0 else 0,
+                bg_interval,
+                len(values),
+                int(is_utc),
+            )
+        )
+        values.tofile(f)
+
+
+class BGGrid:
+    """Read-only, memory-mapped BG grid from a file saved with 'write_bg_grid'"""
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            name, start, bg_interval, length, is_utc = struct.unpack(
+                header_format, f.read(header_size)
+            )
+        if name != grid_format_name:
+            raise ValueError(path + " is not a BG grid file")
+
+        self.path = path
+        self.start = pd.Timestamp(start, unit="s", tz="UTC" if is_utc else None)
+        self.bg_interval = bg_interval
+        self.values = (
+            np.memmap(path, dtype="<f4", mode="r", offset=header_size, shape=(length,))
+            if length > 0
+            else np.array([], dtype="<f4")
+        )
+
+    def __len__(self):
+        return len(self.values)
+
+    def get_index(self, time):
+        """
+        Get the index of the grid point at or before a time
+
+        time: time or array of times
+
+        Returns: index or array of indices, which can be outside of the grid
+        """
+        offset = pd.to_datetime(time) - self.start
+        return np.floor(offset / pd.Timedelta(minutes=self.bg_interval)).astype(int)
+
+    def get_time(self, index):
+        """Get the time of a grid point"""
+        return self.start + pd.Timedelta(minutes=int(index) * self.bg_interval)
+
+    def get_times(self):
+        """Get the time of every grid point"""
+        return pd.date_range(
+            self.start, periods=len(self), freq=str(self.bg_interval) + "min"
+        )
+
+    def get_range(self, start, end):
+        """
+        Get the BGs from 'start' up to (but not including) 'end', without copying them
+
+        Returns: tuple of (time of the first returned BG, read-only array of the BGs)
+        """
+        interval = pd.Timedelta(minutes=self.bg_interval)
+        first, last = [
+            min(
+                max(int(np.ceil((pd.Timestamp(time) - self.start) / interval)), 0),
+                len(self),
+            )
+            for time in [start, end]
+        ]
+        return self.get_time(first), self.values[first : max(first, last)]
+
+    def get_values_at(self, times):
+        """
+        Get the BGs at the grid points at or before each of the times
+
+        times: array of times
+
+        Returns: array of BGs, which are NaN for missing BGs & times outside of the grid
+        """
+        indices = np.asarray(self.get_index(times))
+        in_grid = (indices >= 0) & (indices < len(self))
+        values = np.full(len(indices), np.nan, dtype=np.float32)
+        values[in_grid] = self.values[indices[in_grid]]
+        return values
+
+
+def load_task_bg_grid(task):
+    """
+    Open the BG grid of a TaskGetBGData task, running the task if needed, or saving the
+    grid if the task was run before it saved grids
+
+    task: TaskGetBGData instance
+
+    Returns: BGGrid
+    """
+    if not task.complete():
+        d6tflow.run(task)
+    grid_path = get_bg_grid_path(task.output().path)
+    if not exists(grid_path):
+        write_bg_grid(grid_path, task.output().load())
+    return BGGrid(grid_path)
@@ -3,8 +3,9 @@ import matplotlib.pyplot as plt
 import numpy as np
 
 from pathlib import Path
-from collections import deque
-from tslearn.clustering import TimeSeriesKMeans
+
+from utils import sliding_windows
+from motif_clustering import fit_motif_clusters, assign_motifs, save_motifs
 
 # Load data
 path = str(Path(__file__).parent.parent)
@@ -13,45 +14,50 @@ seed = 0
 
 # interval length is in mins
 def bin_into_intervals(bgs, interval_length, delta=5):
+    """
+    Get every window of 'interval_length' minutes of BGs, in mg/dL
+
+    bgs: df of BGs at a consistent interval of 'delta' minutes, with a "value" column in mmol/L
+    interval_length: length of each window in minutes
+    delta: minutes between each BG value
+
+    Returns: tuple of (2d read-only array with one window per row, where missing BGs are -1,
+                       2d boolean array of whether each BG in the windows is missing)
+    """
     intervals_per_window = round(interval_length / delta)
-    bg_list = bgs["value"].tolist()
-    bg_list = [i * 18 for i in bg_list]
 
-    if len(bg_list) < intervals_per_window:
-        Exception(
+    if len(bgs) < intervals_per_window:
+        raise Exception(
             "Cannot form",
             interval_length,
             "minute windows with",
-            len(bg_list) * delta,
+            len(bgs) * delta,
             "minutes of data",
         )
-    output_builder = []
-    curr = deque(bg_list[0:interval_length])  # initialize with interval_length BGs
-
-    for i in range(interval_length, len(bgs)):
-        output_builder.append(list(curr))
-        curr.popleft()
-        curr.append(bg_list[i])
 
-    return np.matrix(output_builder)
+    values = bgs["value"].to_numpy(dtype=np.float32)
+    bg_list = np.where(values == -1, values, values * 18)
+    return sliding_windows(bg_list, intervals_per_window)
 
 
-x = bin_into_intervals(bgs, 60)
-km = TimeSeriesKMeans(n_clusters=20, verbose=True, random_state=seed)
-y_pred = km.fit_predict(x)
+x, missing = bin_into_intervals(bgs, 60)
+km = fit_motif_clusters([(x, missing)], n_clusters=20, seed=seed)
+y_pred = assign_motifs(km, x, missing)
 
-np.savetxt("motif_output.csv", y_pred, delimiter=",")
+save_motifs(
+    "motif_output.npz",
+    km,
+    [y_pred],
+    [{"identifier": "random_person", "start": str(bgs["time"].iloc[0])}],
+    60,
+)
 
 sz = x.shape[1]
 plt.figure()
 for yi in range(20):
     plt.subplot(4, 5, yi + 1)
-    i = 0
-    for xx in x[y_pred == yi]:
-        if i > 5:
-            continue
+    for xx in x[np.flatnonzero(y_pred == yi)[:6]]:
         plt.plot(xx.ravel(), "k-", alpha=0.2)
-        i += 1
     plt.plot(km.cluster_centers_[yi].ravel(), "r-")
     plt.xlim(0, sz)
     plt.ylim(0, 400)
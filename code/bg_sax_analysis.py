@@ -10,6 +10,20 @@ from sklearn.preprocessing import StandardScaler
 all_alphabet = "abcdefghijklmnopqrstuvwxyz"
 
 
+def get_breakpoints(alphabet_size):
+    """
+    Get the SAX breakpoints that divide the standard normal distribution into
+    'alphabet_size' equally-likely regions
+
+    alphabet_size: number of letters that are used to represent data
+
+    Returns: array of the breakpoints, starting with -inf and ending with inf
+    """
+    breakpoints = norm.ppf(np.linspace(0, 1, alphabet_size + 1)[1:-1])
+    breakpoints = np.insert(breakpoints, 0, -np.inf)
+    return np.append(breakpoints, np.inf)
+
+
 def get_sax_encodings(bgs, alphabet_size=7, bin_time_interval="10min"):
     """
     Compute the SAX encoding for all BGs in a df, assigning rows with missing data a separate letter
@@ -30,10 +44,7 @@ def get_sax_encodings(bgs, alphabet_size=7, bin_time_interval="10min"):
         bgs.groupby(pd.Grouper(key="time", freq=bin_time_interval)).mean().reset_index()
     )
 
-    # Get breakpoints
-    breakpoints = norm.ppf(np.linspace(0, 1, alphabet_size + 1)[1:-1])
-    breakpoints = np.insert(breakpoints, 0, -np.inf)
-    breakpoints = np.append(breakpoints, np.inf)
+    breakpoints = get_breakpoints(alphabet_size)
     alphabet = list(all_alphabet[0:alphabet_size])
     nan_letter = all_alphabet[alphabet_size : alphabet_size + 1]
 
@@ -47,3 +58,112 @@ def get_sax_encodings(bgs, alphabet_size=7, bin_time_interval="10min"):
     averaged_times["bin"].fillna(nan_letter, inplace=True)
 
     return averaged_times
+
+
+def get_sax_pyramid(
+    bgs, interval_lengths=(10, 15, 30), alphabet_sizes=(5, 7, 10), bg_interval=5
+):
+    """
+    Compute the SAX encodings of a BG time series at several interval lengths & alphabet sizes in one pass
+
+    The BGs are normalized once, and the Piecewise Aggregate Approximation (PAA) of each interval
+    length is built from the sums of the finest interval length that divides it (ex: 5-minute
+    sums make the 10- & 15-minute sums, and the 15-minute sums make the 30-minute sums).
+    Each interval length is then encoded with every alphabet size from the same PAA.
+    The encodings match 'get_sax_encodings' for the same interval length & alphabet size.
+
+    bgs: df of BG values with a "time" column & a "log_bg" column that is the log10(BG value)
+    interval_lengths: interval lengths (in minutes) to group data by; must be multiples of bg_interval
+    alphabet_sizes: numbers of letters that are used to represent data; cannot be more than 23
+    bg_interval: minutes between each BG value
+
+    Returns: dict of arrays:
+        - "codes_<interval length>min_<alphabet size>": uint8 array of the SAX letters as
+          numbers, where 0 is "a" & missing data is the alphabet size (the separate letter)
+        - "start_<interval length>min": time of the first interval, in ns since the epoch
+        - "mean" & "std": the mean & standard deviation used to normalize the log BGs
+        - "tz": timezone of the BG times (None if they don't have one), since the start
+          times are saved in UTC
+    """
+    times = pd.to_datetime(bgs["time"])
+    log_bgs = bgs["log_bg"].values.astype(float)
+    mean = np.nanmean(log_bgs)
+    std = np.nanstd(log_bgs)
+    normalized = (log_bgs - mean) / std
+    is_present = ~np.isnan(normalized)
+
+    # Sum the values in each bg_interval, starting at midnight like pd.Grouper does
+    origin = times.iloc[0].normalize()
+    base_length = pd.Timedelta(minutes=bg_interval)
+    base_bins = ((times - origin) // base_length).values.astype(int)
+    sums = {bg_interval: np.bincount(base_bins, np.where(is_present, normalized, 0))}
+    counts = {bg_interval: np.bincount(base_bins, is_present)}
+    first_base_bin = base_bins.min()
+
+    pyramid = {"mean": np.array(mean), "std": np.array(std), "tz": times.dt.tz}
+    for interval_length in sorted(interval_lengths):
+        if interval_length % bg_interval != 0:
+            raise ValueError("Interval lengths must be multiples of the BG interval")
+        # Build from the longest interval length so far that divides this one
+        finer_length = max(length for length in sums if interval_length % length == 0)
+        bins_per_interval = interval_length // finer_length
+        sums[interval_length] = sum_groups(sums[finer_length], bins_per_interval)
+        counts[interval_length] = sum_groups(counts[finer_length], bins_per_interval)
+
+        # Like pd.Grouper, start at the interval containing the first BG
+        first_bin = first_base_bin * bg_interval // interval_length
+        interval_sums = sums[interval_length][first_bin:]
+        interval_counts = counts[interval_length][first_bin:]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            paa = interval_sums / interval_counts
+
+        for alphabet_size in alphabet_sizes:
+            inner_breakpoints = get_breakpoints(alphabet_size)[1:-1]
+            codes = np.searchsorted(inner_breakpoints, paa).astype(np.uint8)
+            codes[interval_counts == 0] = alphabet_size
+            pyramid["codes_" + str(interval_length) + "min_" + str(alphabet_size)] = (
+                codes
+            )
+        pyramid["start_" + str(interval_length) + "min"] = np.array(
+            (origin + pd.Timedelta(minutes=first_bin * interval_length)).value
+        )
+
+    return pyramid
+
+
+def sum_groups(values, group_size):
+    """Sum each consecutive group of 'group_size' values, padding the last group with zeros"""
+    padding = -len(values) % group_size
+    return np.pad(values, (0, padding)).reshape(-1, group_size).sum(axis=1)
+
+
+def get_pyramid_start(pyramid, interval_length):
+    """Get the time of the first interval of a pyramid's encodings, in the BGs' timezone"""
+    start = pd.Timestamp(int(pyramid["start_" + str(interval_length) + "min"]))
+    tz = pyramid.get("tz")
+    return start.tz_localize("UTC").tz_convert(tz) if tz is not None else start
+
+
+def get_sax_from_pyramid(pyramid, interval_length, alphabet_size):
+    """
+    Get one SAX encoding from a pyramid in the same format as 'get_sax_encodings',
+    so it can be used with 'annotate_with_sax'
+
+    pyramid: dict of arrays from 'get_sax_pyramid'
+    interval_length: interval length (in minutes) of the encoding
+    alphabet_size: alphabet size of the encoding
+
+    Returns: df with the "time" of each interval & its SAX letter in the "bin" column
+    """
+    codes = pyramid["codes_" + str(interval_length) + "min_" + str(alphabet_size)]
+    start = get_pyramid_start(pyramid, interval_length)
+    letters = np.array(list(all_alphabet[0 : alphabet_size + 1]))
+
+    return pd.DataFrame(
+        {
+            "time": pd.date_range(
+                start, periods=len(codes), freq=str(interval_length) + "min"
+            ),
+            "bin": letters[codes],
+        }
+    )
@@ -11,9 +11,44 @@ from pathlib import Path
 from mpl_toolkits.mplot3d import Axes3D
 from datetime import datetime, timedelta
 from utils import extract_array
+from bg_features import fill_missing_bg_features
+from model_store import save_model, load_model, update_stored_model
+from knn_outlier_detection import KNNOutlierDetector, knn_detector_model_types
+from streaming_anomaly_detection import SlidingWindowKNNDetector, streaming_model_types
 
+# Columns that are passed into the bolus model
+bolus_features = [
+    "totalBolusAmount",
+    "carbInput",
+    "insulinCarbRatio",
+    "bgInput",
+    "insulinSensitivity",
+    "TDD",
+    "bg_30_min_before",
+    "bg_75_min_after",
+    "smoothed_bg",
+    "bg_rate_of_change",
+    "bg_acceleration",
+    "bg_variability",
+    "iob",
+    "cob",
+]
 
-def find_abnormal_boluses(processed_df, bgs, model_type="knn"):
+
+def find_abnormal_boluses(
+    processed_df, bgs, model_type="knn", model_path=None, score_only=False
+):
+    """
+    Identify the abnormal boluses in a df of processed doses
+
+    processed_df: df of processed dose data
+    bgs: df of BG data
+    model_type: type of model to use; see 'train_model' for the options
+    model_path: path to save the trained model to, or to load it from if "score_only" is True
+    score_only: whether to score the boluses with the stored model at "model_path" instead of training a new one
+
+    Returns: df of the abnormal boluses
+    """
     df = extract_and_process_boluses(processed_df)
 
     # Print some summary statistics
@@ -23,23 +58,12 @@ def find_abnormal_boluses(processed_df, bgs, model_type="knn"):
     print("Shape", shape)
     print(df.describe().apply(lambda s: s.apply(lambda x: format(x, "f"))))
 
-    data_to_predict = df[
-        [
-            "totalBolusAmount",
-            "carbInput",
-            "insulinCarbRatio",
-            "bgInput",
-            "insulinSensitivity",
-            "TDD",
-            "bg_30_min_before",
-            "bg_75_min_after",
-        ]
-    ]
-    model = train_model(data_to_predict, model_type)
-    predictions = model.predict(data_to_predict)
+    data_to_predict = df[bolus_features]
+    predictions, scores = get_model_predictions(
+        data_to_predict, model_type, model_path, score_only, df["time"]
+    )
     df["abnormal"] = predictions
-    if model_type == "isolation_forest":
-        df["abnormality_score"] = model.decision_function(data_to_predict)
+    df["abnormality_score"] = scores
 
     # Plot the results
     # Note that this plot only incorporates 3 dimensions of the data, so there are other
@@ -99,21 +123,127 @@ def find_abnormal_boluses(processed_df, bgs, model_type="knn"):
     return abnormals
 
 
-def train_model(data_to_predict, model_type):
-    """ Train the specified model type (either knn or isolation_forest) and return the trained model """
+def train_model(data_to_predict, model_type, **model_params):
+    """
+    Train the specified model type and return the trained model
+
+    data_to_predict: df with the features to train the model on
+    model_type: type of model to train, either:
+        - "knn": pyod's k-nearest neighbors model on the unscaled features
+        - "isolation_forest": an isolation forest model
+        - "knn_kd_tree" or "knn_ball_tree": a k-nearest neighbors model on standardized
+           features with an exact KD-tree or ball-tree neighbor search
+        - "knn_approximate": a k-nearest neighbors model on standardized features that
+           searches for neighbors within a sample of the doses, which scales to large datasets
+        - "streaming_knn": a k-nearest neighbors model that scores the doses one at a time
+           against a sliding window of the most recent doses
+    model_params: parameters to create the model with (ex: contamination, n_neighbors),
+                  which override the defaults below
+    """
     if model_type == "isolation_forest":
         # Set a random state for reproducable results
         rng = np.random.RandomState(42)
-        model = IsolationForest(random_state=rng, contamination=0.05)
-    # will want to play around with parameter tuning once dataset is labeled
+        params = {"random_state": rng, "contamination": 0.05}
+        model = IsolationForest(**{**params, **model_params})
+    elif model_type in knn_detector_model_types:
+        params = knn_detector_model_types[model_type]
+        model = KNNOutlierDetector(**{**params, **model_params})
+    elif model_type in streaming_model_types:
+        params = streaming_model_types[model_type]
+        model = SlidingWindowKNNDetector(**{**params, **model_params})
+    # will want to play around with parameter tuning once dataset is labeled;
+    # see 'hyperparameter_sweep.py' to compare parameters across patients
     else:
-        model = KNN()
+        model = KNN(**model_params)
 
     model.fit(data_to_predict)
 
     return model
 
 
+def get_training_predictions(model, data_to_predict):
+    """
+    Get the predictions & scores of the doses a model was just trained on
+
+    A KNNOutlierDetector's "predict" would find each training dose at distance 0 from
+    itself, so its labels & scores from training (which leave each dose out of its own
+    neighbors) are used instead
+
+    Returns: tuple of (predictions, abnormality scores)
+    """
+    if isinstance(model, KNNOutlierDetector):
+        return model.labels_, model.decision_scores_
+    return model.predict(data_to_predict), model.decision_function(data_to_predict)
+
+
+def get_model_predictions(
+    data_to_predict, model_type, model_path=None, score_only=False, times=None
+):
+    """
+    Get the abnormality predictions & scores for a set of doses, either by training a new
+    model or by scoring them with a stored model
+
+    Streaming models score the doses one at a time in the order they occurred, and a stored
+    streaming model is updated with the doses it scores, so it can keep scoring new doses
+    without being refit on the full history. The time of the last dose it scored is saved
+    with it, so doses at or before that time (which are already in its window) aren't
+    scored again, and get NaN predictions & scores
+
+    data_to_predict: df with the features to pass into the model
+    model_type: type of model to use; see 'train_model' for the options
+    model_path: path to save the trained model to, or to load it from if "score_only" is True
+    score_only: whether to use the stored model at "model_path" instead of training a new one
+    times: series of the times of the doses, sorted; required to save the time of the last
+           dose a streaming model scored
+
+    Returns: tuple of (predictions, abnormality scores)
+    """
+    if score_only:
+        if model_path is None:
+            raise ValueError(
+                "A model path is required to score doses with a stored model"
+            )
+        stored_model = load_model(model_path, model_type, data_to_predict.columns)
+        model = stored_model["model"]
+        # A day with no new doses has nothing to score
+        if len(data_to_predict) == 0:
+            return [], []
+    elif model_type in streaming_model_types:
+        model = SlidingWindowKNNDetector(**streaming_model_types[model_type])
+    else:
+        model = train_model(data_to_predict, model_type)
+        if model_path is not None:
+            save_model(model, model_path, model_type, data_to_predict)
+        return get_training_predictions(model, data_to_predict)
+
+    if model_type in streaming_model_types:
+        is_new = np.ones(len(data_to_predict), dtype=bool)
+        last_scored_time = stored_model.get("last_scored_time") if score_only else None
+        if times is not None and last_scored_time is not None:
+            is_new = (times > pd.Timestamp(last_scored_time)).values
+        predictions, scores = model.update(data_to_predict[is_new])
+        if not is_new.all():
+            # Doses the model already scored aren't scored again
+            all_predictions = np.full(len(data_to_predict), np.nan)
+            all_scores = np.full(len(data_to_predict), np.nan)
+            all_predictions[is_new] = predictions
+            all_scores[is_new] = scores
+            predictions, scores = all_predictions, all_scores
+
+        if times is not None and is_new.any():
+            last_scored_time = times[is_new].max().isoformat()
+        if score_only:
+            # Keep the feature statistics of the data the model was trained on
+            update_stored_model(stored_model, model_path, last_scored_time)
+        elif model_path is not None:
+            save_model(
+                model, model_path, model_type, data_to_predict, last_scored_time
+            )
+        return predictions, scores
+
+    return model.predict(data_to_predict), model.decision_function(data_to_predict)
+
+
 def extract_and_process_boluses(processed_df):
     """ Take a dataframe of processed dose values and extract/further process the boluses from it """
     # Create a df with the data relevent to boluses
@@ -143,6 +273,12 @@ def extract_and_process_boluses(processed_df):
             "after_event_strings",
             "bg_30_min_before",
             "bg_75_min_after",
+            "smoothed_bg",
+            "bg_rate_of_change",
+            "bg_acceleration",
+            "bg_variability",
+            "iob",
+            "cob",
         ]
     ]
 
@@ -162,7 +298,10 @@ def extract_and_process_boluses(processed_df):
         ],
         inplace=True,
     )
+    df = fill_missing_bg_features(df)
     # Convert the time strings to pandas datetime format
     df["time"] = pd.to_datetime(df["time"], infer_datetime_format=True)
+    # Streaming models score the doses in the order they occurred
+    df = df.sort_values("time", kind="stable")
 
     return df
@@ -1,14 +1,21 @@
+import time
+import traceback
 import multiprocessing
+import luigi
 import d6tflow
 import d6tcollect
 
 from os import listdir
+from pathlib import Path
 from os.path import exists, isdir, join
 import optimized_analysis_pipeline as p
+from run_journal import RunJournal
 
 d6tcollect.submit = False  # Turn off automatic error reporting
 d6tflow.settings.log_level = "ERROR"  # Decrease console printout
 d6tflow.set_dir("../results")  # Save output to a results folder
+journal_path = "../results/bulk_run_journal.json"  # Record of which files have finished
+task_errors = []  # Tracebacks of the tasks that failed while processing the current file
 
 def find_csv_filenames(path_to_dir, suffix=".csv"):
     """ Find all csv filenames in given dir """
@@ -32,6 +39,55 @@ def is_directory(path):
     return True
 
 
+def read_file_paths(input_file_path):
+    """ Read the file paths in a txt file, which has one file path per line """
+    with open(input_file_path) as f:
+        # Each file path is in its own line; get rid of whitespace/new lines
+        return [file_path.rstrip() for file_path in f if file_path.strip()]
+
+
+def add_file_arguments(parser, file_description="raw data"):
+    """
+    Add the '--dir' & '--files' arguments to an argparse parser, to choose the files to process
+    with either a directory of csv files or a txt file with one file path per line
+
+    parser: argparse.ArgumentParser
+    file_description: description of the files, ex: "raw data"
+    """
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--dir", help="directory containing the " + file_description + " csv files")
+    source.add_argument("--files", help="txt file with the path to one " + file_description + " csv file per line")
+
+
+def get_file_paths(args):
+    """
+    Get the paths of the files chosen with the arguments from 'add_file_arguments',
+    leaving out (& printing) the paths that don't exist
+
+    args: parsed arguments
+
+    Returns: list of file paths
+    """
+    if args.dir is not None:
+        file_paths = find_csv_filenames(args.dir)
+    else:
+        assert exists(args.files)
+        file_paths = read_file_paths(args.files)
+    return [file_path for file_path in file_paths if is_valid(file_path)]
+
+
+def load_task(task):
+    """ Load the output of a pipeline task, running the task first if it hasn't been run """
+    if not task.complete():
+        d6tflow.run(task)
+    return task.output().load()
+
+
+def get_results_path(name):
+    """ Get the path of a file or folder within the results folder at the top of the repo """
+    return str(Path(__file__).parent.parent) + "/results/" + name
+
+
 def process_one_file(file_path):
     """ Run the processing pipeline on one file """
     # Create a identifier based on the file path
@@ -62,50 +118,123 @@ def process_one_file(file_path):
     # d6tflow.run(p.TaskPreprocessData(path=file_path, identifier=identifier))
 
 
+@luigi.Task.event_handler(luigi.Event.FAILURE)
+def record_task_failure(task, exception):
+    """ Record the traceback of a task that failed, since d6tflow only raises a generic error """
+    task_errors.append(
+        str(task) + " failed:\n" + "".join(traceback.format_exception(type(exception), exception, exception.__traceback__))
+    )
+
+
+def try_process_one_file(file_path):
+    """ Run the processing pipeline on one file, returning the file path & the traceback if it failed """
+    task_errors.clear()
+    try:
+        process_one_file(file_path)
+        return file_path, None
+    except Exception:
+        # Record the exceptions of the tasks that failed, rather than d6tflow's generic error
+        return file_path, "\n".join(task_errors) or traceback.format_exc()
+
+
+def run_files(journal, max_attempts=3, backoff=60):
+    """ 
+    Run the processing pipeline on the files in a run journal that haven't finished, 
+    recording each file's completion in the journal as soon as it finishes
+
+    journal: RunJournal of the run
+    max_attempts: number of times to try each file in this run before giving up on it
+    backoff: seconds to wait before retrying a failed file; doubles after each failure in a row
+    """
+    file_paths = journal.get_file_paths()
+    missing = [file_path for file_path in file_paths if not is_valid(file_path)]
+    pending = [
+        file_path
+        for file_path in file_paths
+        if file_path not in missing and not journal.is_complete(file_path)
+    ]
+    print(
+        len(file_paths) - len(missing) - len(pending), "files already finished,",
+        len(missing), "missing,",
+        len(pending), "to process"
+    )
+    attempts = {file_path: 0 for file_path in pending}
+
+    # Use multiprocessing to decrease processing time
+    with multiprocessing.Pool() as pool:
+        while len(pending) > 0:
+            # Wait until at least one file is due to be (re)tried
+            next_attempt_times = {file_path: journal.get_next_attempt_time(file_path, backoff) for file_path in pending}
+            wait = min(next_attempt_times.values()) - time.time()
+            if wait > 0:
+                print("Waiting", round(wait), "seconds to retry failed files")
+                time.sleep(wait)
+            due = [file_path for file_path in pending if next_attempt_times[file_path] <= time.time()]
+
+            for file_path in due:
+                journal.mark_started(file_path)
+                attempts[file_path] += 1
+            journal.save()
+
+            for file_path, error in pool.imap_unordered(try_process_one_file, due):
+                if error is None:
+                    journal.mark_done(file_path)
+                    print("Finished", file_path)
+                else:
+                    journal.mark_failed(file_path, error)
+                    print("Failed", file_path, "(attempt", str(attempts[file_path]) + ")\n", error)
+                journal.save()
+
+            pending = [
+                file_path
+                for file_path in pending
+                if not journal.is_complete(file_path) and attempts[file_path] < max_attempts
+            ]
+
+    print("Run summary:", journal.get_summary())
+
+
 def process_files(input_file_path):
     """ Run the processing pipeline on the files contained in the txt file at 'input_file_path' """
-    with open(input_file_path) as f:
-        # Each file path is in its own line
-        for file_path in f:
-            # Get rid of whitespace/new lines
-            file_path = file_path.rstrip()
-            if is_valid(file_path):
-                pool.apply_async(process_one_file, [file_path])
+    run_files(RunJournal.start(journal_path, read_file_paths(input_file_path)))
+
 
 def process_files_from_dir(input_dir):
-    """ Run the processing pipeline on the files contained in the txt file at 'input_file_path' """
-    files = find_csv_filenames(input_dir)
-    for file_path in files:
-        # Get rid of whitespace/new lines
-        file_path = file_path.rstrip()
-        if is_valid(file_path):
-            pool.apply_async(process_one_file, [file_path])
+    """ Run the processing pipeline on the csv files in the directory at 'input_dir' """
+    run_files(RunJournal.start(journal_path, find_csv_filenames(input_dir)))
+
+
+def resume_files():
+    """ Resume the last run, skipping the files that finished & retrying the ones that failed """
+    run_files(RunJournal(journal_path))
 
 
 
 if __name__ == "__main__":
     """
-    Two options: either specify a directory to pull the files from,
-    or a file containing all the paths to the .csvs to process
+    Three options: either specify a directory to pull the files from,
+    a file containing all the paths to the .csvs to process,
+    or resume the last run from its journal
     """
-    option = input("Process all files in directory (1) or file paths in an input file (2)? ")
-    while option not in ["1", "2"]:
-        print("Invalid input; you must enter '1' or '2'")
-        option = input("Process all files in directory (1) or file paths in an input file (2)? ")
+    prompt = "Process all files in directory (1), file paths in an input file (2), or resume the last run (3)? "
+    option = input(prompt)
+    while option not in ["1", "2", "3"]:
+        print("Invalid input; you must enter '1', '2' or '3'")
+        option = input(prompt)
     
-    # Use multiprocessing to decrease processing time
-    pool = multiprocessing.Pool()
     if option == "1": # Files in directory
         input_dir = "/Users/annaquinlan/Downloads/csv"#input("Input file path: ")
         while not is_directory(input_dir):
             input_dir = input("Input directory path: ")
         process_files_from_dir(input_dir)
-    else: # Files paths from input file
+    elif option == "2": # Files paths from input file
         # Get the input file path
         input_file = "/Users/annaquinlan/Desktop/diabetes-risk-analysis/data/files_to_process.txt"#input("Input file path: ")
-        while not is_valid(input_dir):
+        while not is_valid(input_file):
             input_file = input("Input file path: ")
         process_files(input_file)
-
-    pool.close()
-    pool.join()
+    else: # Files that didn't finish in the last run
+        if not exists(journal_path):
+            print("No run to resume; there's no journal at", journal_path)
+        else:
+            resume_files()
@@ -0,0 +1,240 @@
+import argparse
+import numpy as np
+import pandas as pd
+
+import optimized_analysis_pipeline as p
+from bulk_processor import (
+    add_file_arguments,
+    get_file_paths,
+    get_results_path,
+    load_task,
+)
+from bolus_risk_analysis import (
+    bolus_features,
+    extract_and_process_boluses,
+    train_model,
+)
+from basal_risk_analysis import temp_basal_features, extract_and_process_temp_basals
+from model_store import get_model_path, save_model
+
+"""
+Train one anomaly model across every patient in a cohort, rather than one model per patient.
+
+The cohort is streamed through twice, loading one patient at a time:
+1) Sample the patients' doses into a fixed-size training sample & train the model on it
+2) Score every patient's doses against the cohort model in fixed-size batches
+"""
+
+# Columns from the processed doses that are kept in the scored output
+output_columns = ["identifier", "jsonRowIndex", "time"]
+
+
+def load_processed_doses(file_path):
+    """Load the merged preprocessing output for a raw data file, running the pipeline if needed"""
+    identifier = file_path.split("/")[-1]
+    return load_task(
+        p.TaskMergePreprocessingTogether(path=file_path, identifier=identifier)
+    )
+
+
+def get_cohort_features(processed_df, dose_type, patient_normalization=False):
+    """
+    Extract the model features for one patient's doses
+
+    processed_df: df of one patient's processed doses
+    dose_type: type of doses to extract, either "bolus" or "basal"
+    patient_normalization: whether to add features that are normalized to the patient's own
+                           mean & standard deviation, labeled as "<feature>_patient_z"
+
+    Returns: tuple of (df of the extracted doses, df of the features to pass into the model)
+    """
+    if dose_type == "bolus":
+        df = extract_and_process_boluses(processed_df)
+        features = df[bolus_features]
+    elif dose_type == "basal":
+        df = extract_and_process_temp_basals(processed_df)
+        features = df[temp_basal_features]
+    else:
+        raise ValueError("Invalid dose type; must be 'bolus' or 'basal'")
+
+    features = features.astype(float)
+    if patient_normalization:
+        std = features.std(ddof=0).replace(0, 1)
+        normalized = (features - features.mean()) / std
+        features = features.join(normalized.add_suffix("_patient_z"))
+
+    return df, features
+
+
+def update_sample(sample, rows_seen, new_rows, max_rows, rng):
+    """
+    Add rows to a uniform random sample of fixed maximum size (reservoir sampling),
+    so that every row streamed through has the same chance of being in the sample
+
+    sample: array of the currently-sampled rows
+    rows_seen: number of rows that have been streamed through so far
+    new_rows: array of the rows to stream through
+    max_rows: maximum number of rows to keep in the sample
+    rng: numpy RandomState
+
+    Returns: tuple of (updated sample, updated number of rows seen)
+    """
+    # Fill the sample until it reaches its maximum size
+    free_space = max(0, max_rows - len(sample))
+    sample = np.concatenate([sample, new_rows[:free_space]])
+    rows_seen += min(free_space, len(new_rows))
+    new_rows = new_rows[free_space:]
+
+    # After that, row i replaces a random sampled row with probability max_rows / (i + 1)
+    if len(new_rows) > 0:
+        positions = rng.randint(0, rows_seen + np.arange(1, len(new_rows) + 1))
+        for row, position in zip(new_rows, positions):
+            if position < max_rows:
+                sample[position] = row
+        rows_seen += len(new_rows)
+
+    return sample, rows_seen
+
+
+def train_cohort_model(
+    file_paths,
+    dose_type="bolus",
+    model_type="isolation_forest",
+    max_training_rows=100000,
+    patient_normalization=False,
+    model_path=None,
+    seed=42,
+):
+    """
+    Train one model on the doses of every patient in a cohort, keeping at most
+    'max_training_rows' doses in memory at a time
+
+    file_paths: list of paths to the raw data files of the patients in the cohort
+    dose_type: type of doses to train on, either "bolus" or "basal"
+    model_type: type of model to train; see 'bolus_risk_analysis.train_model' for the options
+    max_training_rows: maximum number of doses to train the model on
+    patient_normalization: whether to add features normalized to each patient's own doses
+    model_path: path to save the trained model to, if any
+    seed: seed for the random sampling of the doses
+
+    Returns: the trained model
+    """
+    rng = np.random.RandomState(seed)
+    columns = None
+    sample = None
+    rows_seen = 0
+
+    for file_path in file_paths:
+        _, features = get_cohort_features(
+            load_processed_doses(file_path), dose_type, patient_normalization
+        )
+        if columns is None:
+            columns = features.columns
+            sample = np.empty((0, len(columns)))
+        sample, rows_seen = update_sample(
+            sample, rows_seen, features.values, max_training_rows, rng
+        )
+        print("Sampled", file_path, "-", rows_seen, "doses seen so far")
+
+    if rows_seen == 0:
+        raise ValueError("No " + dose_type + " doses found in the cohort")
+
+    training_data = pd.DataFrame(sample, columns=columns)
+    print("Training on", len(training_data), "of", rows_seen, "doses")
+    model = train_model(training_data, model_type)
+    if model_path is not None:
+        save_model(model, model_path, model_type, training_data)
+
+    return model
+
+
+def score_cohort(
+    file_paths,
+    model,
+    output_path,
+    dose_type="bolus",
+    patient_normalization=False,
+    batch_size=10000,
+):
+    """
+    Score every patient's doses against a cohort model, writing the results to a csv
+
+    file_paths: list of paths to the raw data files of the patients in the cohort
+    model: model trained with 'train_cohort_model'
+    output_path: path of the csv file to write the scores to
+    dose_type: type of doses to score, either "bolus" or "basal"
+    patient_normalization: whether the model was trained with patient-normalized features
+    batch_size: number of doses to score at once
+
+    Returns: number of doses that were scored
+    """
+    total_scored = 0
+    write_header = True
+
+    for file_path in file_paths:
+        df, features = get_cohort_features(
+            load_processed_doses(file_path), dose_type, patient_normalization
+        )
+        if len(features) == 0:
+            continue
+
+        predictions = []
+        scores = []
+        for start in range(0, len(features), batch_size):
+            batch = features.iloc[start : start + batch_size]
+            predictions.append(model.predict(batch))
+            scores.append(model.decision_function(batch))
+
+        df["identifier"] = file_path.split("/")[-1]
+        scored = df[output_columns].join(features)
+        scored["abnormal"] = np.concatenate(predictions)
+        scored["abnormality_score"] = np.concatenate(scores)
+
+        scored.to_csv(
+            output_path,
+            mode="w" if write_header else "a",
+            header=write_header,
+            index=False,
+        )
+        write_header = False
+        total_scored += len(scored)
+        print("Scored", file_path, "-", len(scored), "doses")
+
+    return total_scored
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Train one anomaly model across a cohort & score every patient with it"
+    )
+    add_file_arguments(parser)
+    parser.add_argument("--dose-type", default="bolus", choices=["bolus", "basal"])
+    parser.add_argument("--model-type", default="isolation_forest")
+    parser.add_argument("--max-training-rows", type=int, default=100000)
+    parser.add_argument("--batch-size", type=int, default=10000)
+    parser.add_argument(
+        "--patient-normalization",
+        action="store_true",
+        help="add features normalized to each patient's own doses",
+    )
+    parser.add_argument("--output", default=get_results_path("cohort_scores.csv"))
+    args = parser.parse_args()
+
+    file_paths = get_file_paths(args)
+
+    cohort_model = train_cohort_model(
+        file_paths,
+        args.dose_type,
+        args.model_type,
+        args.max_training_rows,
+        args.patient_normalization,
+        get_model_path("cohort", args.dose_type, args.model_type),
+    )
+    score_cohort(
+        file_paths,
+        cohort_model,
+        args.output,
+        args.dose_type,
+        args.patient_normalization,
+        args.batch_size,
+    )
@@ -0,0 +1,282 @@
+import os
+import argparse
+import numba
+import numpy as np
+import pandas as pd
+import stumpy
+
+from pathlib import Path
+from itertools import combinations
+from os.path import join
+from concurrent.futures import ProcessPoolExecutor
+
+import optimized_analysis_pipeline as p
+from bulk_processor import add_file_arguments, get_file_paths, get_results_path
+from bg_grid_store import BGGrid, load_task_bg_grid
+
+"""
+Matrix profiles across a cohort, computed in parallel.
+
+1) Get every patient's BG grid file (see 'bg_grid_store.py'), which the worker processes
+   memory-map instead of each loading the patient files
+2) Run the joins across a process pool:
+    - self-joins, which find each patient's own motifs (most repeated windows)
+      & discords (most unusual windows)
+    - AB-joins between pairs of patients, which find the windows of one patient that
+      are the most similar to any window of the other
+    - AB-joins against a reference library of known risky BG traces, which find the
+      windows of each patient that are the most similar to each risky trace
+3) Write the top-k locations of each join to one csv per patient
+"""
+
+default_output_dir = get_results_path("cohort_matrix_profiles")
+
+output_columns = [
+    "identifier",
+    "join",
+    "other",
+    "kind",
+    "rank",
+    "time",
+    "other_index",
+    "other_time",
+    "distance",
+]
+
+
+def get_bg_grid_paths(file_paths):
+    """
+    Get the path to each patient's BG grid file, running the pipeline if needed
+
+    file_paths: list of paths to the raw data files of the patients
+
+    Returns: dict of identifier -> path to the patient's BG grid
+    """
+    grid_paths = {}
+    for file_path in file_paths:
+        identifier = file_path.split("/")[-1]
+        task = p.TaskGetBGData(path=file_path, identifier=identifier)
+        grid_paths[identifier] = load_task_bg_grid(task).path
+    return grid_paths
+
+
+def load_reference_library(library_path):
+    """
+    Load a library of known risky BG traces
+
+    library_path: path to a csv with "name" & "value" columns, with one row per BG
+                  (in mmol/L) of each trace, in order
+
+    Returns: dict of trace name -> array of the trace's log BGs
+    """
+    library = pd.read_csv(library_path)
+    return {
+        name: np.log10(trace["value"].to_numpy(dtype=float))
+        for name, trace in library.groupby("name", sort=False)
+    }
+
+
+def get_top_k_locations(profile, k, exclusion_zone, largest=False, neighbors=None):
+    """
+    Get the locations of the k smallest (or largest) values of a matrix profile, skipping
+    locations within 'exclusion_zone' of a location that was already picked, so that
+    one event isn't reported k times
+
+    neighbors: matrix profile indices; if passed, locations near the nearest neighbor of a
+               picked location are also skipped, so both windows of a motif aren't reported
+
+    Returns: list of the locations, from best to worst
+    """
+    profile = np.asarray(profile, dtype=float)
+    order = np.argsort(-profile if largest else profile, kind="stable")
+    order = order[np.isfinite(profile[order])]
+
+    locations = []
+    excluded = []
+    for location in order:
+        if all(abs(location - picked) > exclusion_zone for picked in excluded):
+            locations.append(location)
+            excluded.append(location)
+            if neighbors is not None:
+                excluded.append(neighbors[location])
+            if len(locations) == k:
+                break
+    return locations
+
+
+def run_join(job):
+    """
+    Run one matrix profile join
+
+    job: tuple of (identifier of patient A, path to patient A's BG grid, name of the other
+         series or None for a self-join, path to the other patient's BG grid or the
+         other trace's log BGs, window length, number of locations to report)
+
+    Returns: list of dicts with the top-k locations, with the keys in 'output_columns'
+    """
+    identifier, grid_path, other_name, other, window_length, k = job
+    grid = BGGrid(grid_path)
+    series = np.log10(grid.values, dtype=float)
+
+    # Self-joins report motifs & discords; AB-joins report the windows closest to the other series
+    if other_name is None:
+        join_type = "self"
+        other_series = None
+        other_grid = grid
+        kinds = [("motif", False), ("discord", True)]
+    elif isinstance(other, str):
+        join_type = "patient"
+        other_grid = BGGrid(other)
+        other_series = np.log10(other_grid.values, dtype=float)
+        kinds = [("motif", False)]
+    else:
+        join_type = "reference"
+        other_series = other
+        other_grid = None
+        kinds = [("motif", False)]
+
+    if len(series) < window_length or (
+        other_series is not None and len(other_series) < window_length
+    ):
+        return []
+    matrix_profile = stumpy.stump(
+        series,
+        window_length,
+        other_series,
+        ignore_trivial=other_series is None,
+    )
+    profile = matrix_profile[:, 0].astype(float)
+    neighbors = matrix_profile[:, 1].astype(int)
+
+    rows = []
+    for kind, largest in kinds:
+        locations = get_top_k_locations(
+            profile,
+            k,
+            window_length // 2,
+            largest,
+            neighbors if join_type == "self" and kind == "motif" else None,
+        )
+        for rank, location in enumerate(locations):
+            rows.append(
+                {
+                    "identifier": identifier,
+                    "join": join_type,
+                    "other": other_name,
+                    "kind": kind,
+                    "rank": rank + 1,
+                    "time": grid.get_time(location),
+                    "other_index": neighbors[location],
+                    "other_time": (
+                        other_grid.get_time(neighbors[location])
+                        if other_grid is not None
+                        else None
+                    ),
+                    "distance": profile[location],
+                }
+            )
+    return rows
+
+
+def _set_numba_threads(threads):
+    """Split the cores between the worker processes, since stumpy also runs in parallel"""
+    numba.set_num_threads(threads)
+
+
+def run_cohort_joins(
+    grids,
+    window_length=20,
+    k=5,
+    patient_pairs=False,
+    reference_library=None,
+    output_dir=default_output_dir,
+    max_workers=None,
+):
+    """
+    Run self-joins for every patient, and optionally AB-joins between patients &
+    against a reference library, writing the top-k locations to one csv per patient
+
+    grids: dict of identifier -> path to the patient's BG grid, from 'get_bg_grid_paths'
+    window_length: number of BGs in each window
+    k: number of locations to report for each join
+    patient_pairs: whether to run AB-joins between every pair of patients (in both directions)
+    reference_library: dict of trace name -> log BGs, from 'load_reference_library'
+    output_dir: folder to write the csvs to
+    max_workers: number of processes to use (defaults to the number of cores)
+
+    Returns: df of every reported location
+    """
+    jobs = [
+        (identifier, grid, None, None, window_length, k)
+        for identifier, grid in grids.items()
+    ]
+    if patient_pairs:
+        for first, second in combinations(grids, 2):
+            jobs.append((first, grids[first], second, grids[second], window_length, k))
+            jobs.append((second, grids[second], first, grids[first], window_length, k))
+    for name, trace in (reference_library or {}).items():
+        jobs.extend(
+            (identifier, grid, name, trace, window_length, k)
+            for identifier, grid in grids.items()
+        )
+
+    max_workers = max_workers or os.cpu_count()
+    threads = max(1, numba.config.NUMBA_NUM_THREADS // max_workers)
+    with ProcessPoolExecutor(
+        max_workers=max_workers,
+        initializer=_set_numba_threads,
+        initargs=(threads,),
+    ) as executor:
+        results = executor.map(run_join, jobs)
+        locations = pd.DataFrame(
+            [row for rows in results for row in rows], columns=output_columns
+        )
+
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    for identifier, patient_locations in locations.groupby("identifier"):
+        patient_locations.to_csv(
+            join(output_dir, identifier + "_matrix_profile.csv"), index=False
+        )
+
+    return locations
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compute BG matrix profile joins across a cohort in parallel"
+    )
+    add_file_arguments(parser)
+    parser.add_argument(
+        "--window-length", type=int, default=20, help="number of BGs in each window"
+    )
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument(
+        "--patient-pairs",
+        action="store_true",
+        help="run AB-joins between every pair of patients",
+    )
+    parser.add_argument(
+        "--reference-library",
+        help="csv of risky BG traces, with 'name' & 'value' columns",
+    )
+    parser.add_argument("--output-dir", default=default_output_dir)
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    file_paths = get_file_paths(args)
+
+    grids = get_bg_grid_paths(file_paths)
+    reference_library = None
+    if args.reference_library is not None:
+        reference_library = load_reference_library(args.reference_library)
+
+    locations = run_cohort_joins(
+        grids,
+        args.window_length,
+        args.top_k,
+        args.patient_pairs,
+        reference_library,
+        args.output_dir,
+        args.workers,
+    )
+    print(locations.to_string(index=False))
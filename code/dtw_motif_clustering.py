@@ -0,0 +1,287 @@
+import os
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor
+from scipy.ndimage import maximum_filter1d, minimum_filter1d
+from sklearn.cluster import kmeans_plusplus
+
+"""
+Dynamic time warping (DTW) k-means for clustering windows of BG data into motifs.
+
+DTW lets two windows match even if the same BG shape happens a few readings earlier in one
+of them, but every DTW distance takes time proportional to the window length times the band
+width. To find each window's closest motif, cheap lower bounds on the DTW distance
+(LB_Kim & LB_Keogh) are computed to every motif first, and the full DTW distance is only
+computed for motifs whose lower bound is less than the closest DTW distance found so far.
+The result is the same as computing DTW to every motif.
+
+Distances are the square root of the summed squared differences along the warping path,
+like tslearn's DTW.
+"""
+
+
+def dtw_distances(X, Y, band):
+    """
+    Get the DTW distance between each row of X & the same row of Y
+
+    X: 2d array with one window per row
+    Y: 2d array the same shape as X
+    band: Sakoe-Chiba band; the warping path can't match readings more than 'band' readings apart
+
+    Returns: array of the distances
+    """
+    n, length = X.shape
+    previous = np.full((n, length + 1), np.inf)
+    previous[:, 0] = 0
+
+    for i in range(1, length + 1):
+        current = np.full((n, length + 1), np.inf)
+        for j in range(max(1, i - band), min(length, i + band) + 1):
+            current[:, j] = (X[:, i - 1] - Y[:, j - 1]) ** 2 + np.minimum(
+                np.minimum(previous[:, j], current[:, j - 1]), previous[:, j - 1]
+            )
+        previous = current
+
+    return np.sqrt(previous[:, length])
+
+
+def dtw_cost_matrices(X, Y, band):
+    """
+    Get the cumulative DTW cost matrices between each row of X & the same row of Y
+
+    Returns: 3d array where [k, i, j] is the squared cost of the best path matching the
+        first i readings of X[k] to the first j readings of Y[k]
+    """
+    n, length = X.shape
+    cost = np.full((n, length + 1, length + 1), np.inf)
+    cost[:, 0, 0] = 0
+
+    for i in range(1, length + 1):
+        for j in range(max(1, i - band), min(length, i + band) + 1):
+            cost[:, i, j] = (X[:, i - 1] - Y[:, j - 1]) ** 2 + np.minimum(
+                np.minimum(cost[:, i - 1, j], cost[:, i, j - 1]), cost[:, i - 1, j - 1]
+            )
+
+    return cost
+
+
+def lb_kim(X, centers):
+    """
+    Lower bound on the DTW distance from each window to each center, from the first
+    & last readings (which every warping path matches to each other)
+
+    Returns: 2d array of (number of windows x number of centers)
+    """
+    first = (X[:, np.newaxis, 0] - centers[np.newaxis, :, 0]) ** 2
+    last = (X[:, np.newaxis, -1] - centers[np.newaxis, :, -1]) ** 2
+    return np.sqrt(first + last)
+
+
+def get_envelopes(centers, band):
+    """
+    Get the upper & lower envelopes of each center: the maximum & minimum of the
+    center within 'band' readings of each reading
+
+    Returns: tuple of (2d array of upper envelopes, 2d array of lower envelopes)
+    """
+    size = 2 * band + 1
+    return (
+        maximum_filter1d(centers, size, axis=1, mode="nearest"),
+        minimum_filter1d(centers, size, axis=1, mode="nearest"),
+    )
+
+
+def lb_keogh(X, upper, lower):
+    """
+    Lower bound on the DTW distance from each window to each center, from how far
+    the window goes outside of the center's envelopes
+
+    Returns: 2d array of (number of windows x number of centers)
+    """
+    X = X[:, np.newaxis, :]
+    above = np.maximum(X - upper[np.newaxis, :, :], 0)
+    below = np.maximum(lower[np.newaxis, :, :] - X, 0)
+    return np.sqrt((above**2 + below**2).sum(axis=2))
+
+
+def find_nearest_centers(X, centers, band):
+    """
+    Find the center with the smallest DTW distance to each window, skipping the full DTW
+    computation for centers whose lower bound is already larger than the best distance
+
+    X: 2d array with one window per row
+    centers: 2d array with one center per row
+    band: Sakoe-Chiba band, in readings
+
+    Returns: tuple of (array of the index of the nearest center to each window,
+                       array of the DTW distance to that center,
+                       number of full DTW distances that were computed)
+    """
+    X = np.asarray(X, dtype=float)
+    upper, lower = get_envelopes(centers, band)
+    lower_bounds = np.maximum(lb_kim(X, centers), lb_keogh(X, upper, lower))
+
+    # Try the centers in order of their lower bounds, so the closest center is likely
+    # found first & the rest of the centers can be skipped
+    order = np.argsort(lower_bounds, axis=1)
+    rows = np.arange(len(X))
+    labels = np.zeros(len(X), dtype=int)
+    distances = np.full(len(X), np.inf)
+    computed = 0
+
+    for rank in range(len(centers)):
+        candidates = order[:, rank]
+        to_check = np.flatnonzero(lower_bounds[rows, candidates] < distances)
+        if len(to_check) == 0:
+            break
+        candidate_distances = dtw_distances(
+            X[to_check], centers[candidates[to_check]], band
+        )
+        computed += len(to_check)
+
+        is_closer = candidate_distances < distances[to_check]
+        distances[to_check[is_closer]] = candidate_distances[is_closer]
+        labels[to_check[is_closer]] = candidates[to_check[is_closer]]
+
+    return labels, distances, computed
+
+
+def _find_nearest_centers_of_chunk(chunk):
+    """Unpack a chunk of windows for the process pool"""
+    X, centers, band = chunk
+    return find_nearest_centers(X, centers, band)
+
+
+def dba_update(center, members, band, batch_size=5000):
+    """
+    Update a center with DTW barycenter averaging (DBA): every reading of the center becomes
+    the mean of the member readings that the members' DTW paths match to it
+
+    center: array of the current center
+    members: 2d array of the windows assigned to the center
+    band: Sakoe-Chiba band, in readings
+    batch_size: number of members to find the DTW paths of at once
+
+    Returns: array of the updated center
+    """
+    length = len(center)
+    sums = np.zeros(length)
+    counts = np.zeros(length)
+
+    for start in range(0, len(members), batch_size):
+        batch = np.asarray(members[start : start + batch_size], dtype=float)
+        cost = dtw_cost_matrices(batch, np.tile(center, (len(batch), 1)), band)
+
+        # Walk every member's path back from the last readings to the first ones
+        rows = np.arange(len(batch))
+        i = np.full(len(batch), length)
+        j = np.full(len(batch), length)
+        while (i > 0).any():
+            on_path = np.flatnonzero(i > 0)
+            path_i = i[on_path]
+            path_j = j[on_path]
+            np.add.at(sums, path_j - 1, batch[rows[on_path], path_i - 1])
+            np.add.at(counts, path_j - 1, 1)
+
+            steps = np.stack(
+                [
+                    cost[on_path, path_i - 1, path_j - 1],
+                    cost[on_path, path_i - 1, path_j],
+                    cost[on_path, path_i, path_j - 1],
+                ]
+            ).argmin(axis=0)
+            i[on_path] = path_i - (steps != 2)
+            j[on_path] = path_j - (steps != 1)
+
+    return np.where(counts > 0, sums / np.maximum(counts, 1), center)
+
+
+class DTWKMeans:
+    """
+    K-means clustering of windows that uses the DTW distance to assign windows to clusters,
+    and DTW barycenter averaging to update the cluster centers.
+
+    Follows sklearn's KMeans interface, so it can be used in place of MiniBatchKMeans
+    in 'motif_clustering.py'.
+    """
+
+    def __init__(
+        self,
+        n_clusters=20,
+        band=2,
+        max_iter=10,
+        dba_iter=3,
+        chunk_size=2000,
+        n_jobs=-1,
+        random_state=0,
+    ):
+        """
+        n_clusters: number of clusters
+        band: Sakoe-Chiba band; the number of readings that a window can be shifted by
+        max_iter: maximum number of k-means iterations
+        dba_iter: number of DBA updates of the centers per k-means iteration
+        chunk_size: number of windows each process assigns at a time
+        n_jobs: number of processes to assign windows with (-1 uses all cores)
+        random_state: seed for picking the initial centers
+        """
+        self.n_clusters = n_clusters
+        self.band = band
+        self.max_iter = max_iter
+        self.dba_iter = dba_iter
+        self.chunk_size = chunk_size
+        self.n_jobs = n_jobs
+        self.random_state = random_state
+
+    def _assign(self, X):
+        """Get the nearest center & DTW distance of every window, spreading the chunks across processes"""
+        chunks = [
+            (X[start : start + self.chunk_size], self.cluster_centers_, self.band)
+            for start in range(0, len(X), self.chunk_size)
+        ]
+        if self.n_jobs == 1 or len(chunks) <= 1:
+            results = [_find_nearest_centers_of_chunk(chunk) for chunk in chunks]
+        else:
+            max_workers = os.cpu_count() if self.n_jobs == -1 else self.n_jobs
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                results = list(executor.map(_find_nearest_centers_of_chunk, chunks))
+
+        if len(results) == 0:
+            return np.array([], dtype=int), np.array([])
+        labels, distances, computed = zip(*results)
+        self.dtw_computations_ = sum(computed)
+        return np.concatenate(labels), np.concatenate(distances)
+
+    def fit(self, X):
+        """Find the cluster centers of the windows, starting from k-means++ centers"""
+        X = np.asarray(X, dtype=float)
+        # Euclidean distance is an upper bound on DTW distance, so k-means++ still spreads the centers out
+        self.cluster_centers_, _ = kmeans_plusplus(
+            X, self.n_clusters, random_state=self.random_state
+        )
+
+        labels = None
+        for self.n_iter_ in range(1, self.max_iter + 1):
+            new_labels, distances = self._assign(X)
+            if labels is not None and (new_labels == labels).all():
+                break
+            labels = new_labels
+
+            for cluster in range(self.n_clusters):
+                members = X[labels == cluster]
+                if len(members) == 0:
+                    # Restart empty clusters at the window that's farthest from its center
+                    self.cluster_centers_[cluster] = X[distances.argmax()]
+                    distances[distances.argmax()] = 0
+                    continue
+                for _ in range(self.dba_iter):
+                    self.cluster_centers_[cluster] = dba_update(
+                        self.cluster_centers_[cluster], members, self.band
+                    )
+
+        self.labels_, distances = self._assign(X)
+        self.inertia_ = (distances**2).sum()
+        return self
+
+    def predict(self, X):
+        """Get the index of the nearest cluster center to each window"""
+        return self._assign(np.asarray(X, dtype=float))[0]
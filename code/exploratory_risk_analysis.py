@@ -7,7 +7,7 @@ import seaborn as sns
 from sklearn.ensemble import IsolationForest
 from pathlib import Path
 
-# Load in data
+# Load in data (for exports too large to load at once, see 'streaming_profiler.py')
 path = str(Path(__file__).parent.parent)
 initial_df = pd.read_csv(path + "/data/risk-data-sample.csv")
 
@@ -1,59 +1,369 @@
+import matplotlib
+
+# Render the plots to files, without a display
+matplotlib.use("Agg")
+
+import os
 import shap
+import argparse
 import numpy as np
 import pandas as pd
 import matplotlib.pylab as plt
 
-from sklearn.ensemble import IsolationForest
-from os.path import exists
+from pathlib import Path
+from os.path import exists, join, splitext
+from concurrent.futures import ProcessPoolExecutor
 
-from bolus_risk_analysis import extract_and_process_boluses, train_model
-from basal_risk_analysis import extract_and_process_temp_basals
+from model_store import get_model_path, save_model, load_model
+from bolus_risk_analysis import extract_and_process_boluses, train_model, bolus_features
+from basal_risk_analysis import extract_and_process_temp_basals, temp_basal_features
 
+"""
+Explain which features make a patient's doses abnormal, using SHAP values.
 
-# Path to the file of processed doses - YOU MUST FILL THIS IN
-path_to_file = "TO_FILL_IN.csv"
-assert exists(path_to_file)
-# YOU MUST CHANGE THIS TO CHANGE THE DOSE TYPE THAT IS ANALYZED
-dose_type = "boluses"  # either "basals" or "boluses"
+1) Get the patient's stored model (see 'model_store.py'), or train & store one if there isn't one
+2) Pick the doses to explain: a random sample of them, only the ones the model flags as abnormal, or all of them
+3) Compute the SHAP values of the doses in chunks spread across processes, reusing the
+   values that are cached next to the model from earlier runs with the same model
+4) Save the SHAP values, the features ranked by their mean impact on the abnormality score,
+   and a summary plot & one dependence plot per feature as image files
 
-if dose_type == "boluses":
-    df = extract_and_process_boluses(pd.read_csv(path_to_file))
-    # Get trained model
-    data_to_predict = df[
-        [
-            "totalBolusAmount",
-            "carbInput",
-            "insulinCarbRatio",
-            "bgInput",
-            "insulinSensitivity",
-            "TDD",
-            "bg_30_min_before",
-            "bg_75_min_after",
-        ]
+Isolation forests are explained with shap's TreeExplainer, which is exact & fast. Other model
+types are explained with shap's KernelExplainer on the model's abnormality scores, against a
+k-means summary of the doses; this is much slower, so a small sample is recommended.
+"""
+
+default_output_dir = str(Path(__file__).parent.parent) + "/results/feature_importance"
+
+dose_type_features = {"bolus": bolus_features, "basal": temp_basal_features}
+
+# Default number of doses to explain if 'rows' is "sample"; the KernelExplainer that's used
+# for models other than isolation forests takes seconds per dose, so it gets a small sample
+default_sample_sizes = {"isolation_forest": 1000}
+default_kernel_sample_size = 50
+
+
+def get_doses_to_explain(processed_df, dose_type):
+    """
+    Get the doses of a type & the features that are passed into the model for them
+
+    processed_df: df of processed doses, from TaskMergePreprocessingTogether
+    dose_type: either "bolus" or "basal"
+
+    Returns: tuple of (df of the doses, df of their model features)
+    """
+    if dose_type == "bolus":
+        df = extract_and_process_boluses(processed_df)
+    elif dose_type == "basal":
+        df = extract_and_process_temp_basals(processed_df)
+    else:
+        raise ValueError("Invalid dose type " + dose_type + "; use 'bolus' or 'basal'")
+    return df, df[dose_type_features[dose_type]]
+
+
+def get_stored_model(data_to_predict, identifier, dose_type, model_type):
+    """
+    Load the patient's stored model, or train & store a new one if there isn't one
+
+    Returns: tuple of (stored model dict from 'model_store.load_model', path to the model)
+    """
+    model_path = get_model_path(identifier, dose_type, model_type)
+    if not exists(model_path):
+        model = train_model(data_to_predict, model_type)
+        save_model(model, model_path, model_type, data_to_predict)
+    return load_model(model_path, model_type, data_to_predict.columns), model_path
+
+
+def get_shap_cache_path(model_path):
+    """Get the path of the SHAP values that are cached next to a model"""
+    return splitext(model_path)[0] + "_shap.npz"
+
+
+def load_shap_cache(cache_path, stored_model):
+    """
+    Load the cached SHAP values of a model, ignoring them if the model was retrained or
+    updated (ex: a streaming model that scored new doses) since
+
+    Returns: dict of row identifier -> array of SHAP values, and the explainer's expected value
+    """
+    if not exists(cache_path):
+        return {}, None
+    cache = np.load(cache_path, allow_pickle=False)
+    if (
+        "updated_at" not in cache
+        or str(cache["trained_at"]) != stored_model["trained_at"]
+        or str(cache["updated_at"]) != stored_model.get("updated_at", "")
+        or list(cache["features"]) != list(stored_model["features"])
+    ):
+        return {}, None
+    return (
+        dict(zip(cache["row_ids"].tolist(), cache["shap_values"])),
+        float(cache["expected_value"]),
+    )
+
+
+def save_shap_cache(cache_path, stored_model, cached_values, expected_value):
+    """Save the SHAP values of every row that has been explained with a model"""
+    row_ids = sorted(cached_values)
+    np.savez(
+        cache_path,
+        trained_at=stored_model["trained_at"],
+        updated_at=stored_model.get("updated_at", ""),
+        features=np.array(stored_model["features"]),
+        row_ids=np.array(row_ids),
+        shap_values=np.array([cached_values[row_id] for row_id in row_ids]),
+        expected_value=expected_value,
+    )
+
+
+def get_explainer(model, model_type, background):
+    """
+    Create a SHAP explainer for a model
+
+    background: data the KernelExplainer compares rows against; not used for isolation forests
+    """
+    if model_type == "isolation_forest":
+        return shap.TreeExplainer(model)
+    return shap.KernelExplainer(model.decision_function, background)
+
+
+_explainer = None
+
+
+def _init_explainer(model, model_type, background):
+    """Create the explainer once per worker process, instead of once per chunk"""
+    global _explainer
+    _explainer = get_explainer(model, model_type, background)
+
+
+def _explain_chunk(chunk):
+    if isinstance(_explainer, shap.KernelExplainer):
+        shap_values = _explainer.shap_values(chunk, silent=True)
+    else:
+        shap_values = _explainer.shap_values(chunk)
+    return np.asarray(shap_values), float(np.ravel(_explainer.expected_value)[0])
+
+
+def explain_rows(
+    model, model_type, data, chunk_size=200, max_workers=None, background_size=10
+):
+    """
+    Compute the SHAP values of every row of a df, in chunks spread across processes
+
+    model: trained model
+    model_type: type of model, ex: "knn" or "isolation_forest"
+    data: df of the model features of the rows to explain
+    chunk_size: number of rows each process explains at a time
+    max_workers: number of processes to use (defaults to the number of cores)
+    background_size: number of k-means centers that summarize the data for the KernelExplainer
+
+    Returns: tuple of (2d array of SHAP values with one row per row of 'data',
+                       the explainer's expected value)
+    """
+    values = data.to_numpy(dtype=float)
+    chunks = [
+        values[start : start + chunk_size]
+        for start in range(0, len(values), chunk_size)
     ]
-elif dose_type == "basals":
-    df = extract_and_process_temp_basals(pd.read_csv(path_to_file))
-    data_to_predict = df[
+    if len(chunks) == 0:
+        return np.empty((0, data.shape[1])), None
+    background = None
+    if model_type != "isolation_forest":
+        background = shap.kmeans(values, min(background_size, len(values)))
+
+    max_workers = max_workers or os.cpu_count()
+    if max_workers == 1 or len(chunks) == 1:
+        _init_explainer(model, model_type, background)
+        results = [_explain_chunk(chunk) for chunk in chunks]
+    else:
+        with ProcessPoolExecutor(
+            max_workers=min(max_workers, len(chunks)),
+            initializer=_init_explainer,
+            initargs=(model, model_type, background),
+        ) as executor:
+            results = list(executor.map(_explain_chunk, chunks))
+
+    shap_values, expected_values = zip(*results)
+    return np.concatenate(shap_values), expected_values[0]
+
+
+def save_shap_plots(shap_values, data, output_prefix, image_format="png"):
+    """
+    Save a bar plot of the features ranked by their impact on the abnormality score, and
+    for each feature, a plot of the impact on the abnormality score vs the feature's value
+
+    output_prefix: path & start of the file name of the plots
+    image_format: file format of the plots, ex: "png" or "svg"
+
+    Returns: list of the paths of the saved plots
+    """
+    paths = []
+    shap.summary_plot(shap_values, data, plot_type="bar", show=False)
+    paths.append(output_prefix + "_summary." + image_format)
+    plt.savefig(paths[-1], bbox_inches="tight")
+    plt.close("all")
+
+    # Negative SHAP values -> more abnormal
+    for column in data.columns:
+        shap.dependence_plot(column, shap_values, data, show=False)
+        paths.append(output_prefix + "_dependence_" + column + "." + image_format)
+        plt.savefig(paths[-1], bbox_inches="tight")
+        plt.close("all")
+    return paths
+
+
+def explain_doses(
+    processed_df,
+    identifier,
+    dose_type="bolus",
+    model_type="knn",
+    rows="sample",
+    sample_size=None,
+    seed=0,
+    chunk_size=200,
+    max_workers=None,
+    output_dir=default_output_dir,
+    image_format="png",
+):
+    """
+    Explain a patient's doses with SHAP values, saving the values, the feature ranking & the plots
+
+    processed_df: df of processed doses, from TaskMergePreprocessingTogether
+    identifier: identifier of the patient, which the stored model is saved under
+    dose_type: either "bolus" or "basal"
+    model_type: type of model to explain; see 'bolus_risk_analysis.train_model' for the options
+    rows: which doses to explain: "sample" (a random sample of 'sample_size' doses),
+          "abnormal" (the doses the model flags as abnormal), or "all"
+    sample_size: number of doses to explain if 'rows' is "sample"; defaults to 1000 for
+                 isolation forests & 50 for the other model types, which use the slow
+                 KernelExplainer
+    seed: seed for picking the sample
+    chunk_size: number of doses each process explains at a time
+    max_workers: number of processes to use (defaults to the number of cores)
+    output_dir: folder to save the outputs to
+    image_format: file format of the plots, ex: "png" or "svg"
+
+    Returns: df of the feature ranking, with the "feature" & its "mean_abs_shap"
+    """
+    df, data_to_predict = get_doses_to_explain(processed_df, dose_type)
+    stored_model, model_path = get_stored_model(
+        data_to_predict, identifier, dose_type, model_type
+    )
+    model = stored_model["model"]
+
+    if rows == "abnormal":
+        # Isolation forest: -1 is abnormal; KNN: 1 is abnormal
+        abnormal_label = -1 if model_type == "isolation_forest" else 1
+        selected = data_to_predict[model.predict(data_to_predict) == abnormal_label]
+    elif rows == "sample":
+        if sample_size is None:
+            sample_size = default_sample_sizes.get(
+                model_type, default_kernel_sample_size
+            )
+        selected = data_to_predict.sample(
+            n=min(sample_size, len(data_to_predict)), random_state=seed
+        )
+    elif rows == "all":
+        selected = data_to_predict
+    else:
+        raise ValueError("Invalid rows " + rows + "; use 'sample', 'abnormal' or 'all'")
+    row_ids = df.loc[selected.index, "jsonRowIndex"].to_numpy()
+
+    # Only explain the rows that aren't already cached for this model
+    cache_path = get_shap_cache_path(model_path)
+    cached_values, expected_value = load_shap_cache(cache_path, stored_model)
+    is_new = np.array([row_id not in cached_values for row_id in row_ids], dtype=bool)
+    print("Explaining", is_new.sum(), "of", len(row_ids), "doses")
+    new_values, new_expected_value = explain_rows(
+        model, model_type, selected[is_new], chunk_size, max_workers
+    )
+    cached_values.update(zip(row_ids[is_new].tolist(), new_values))
+    if new_expected_value is not None:
+        expected_value = new_expected_value
+        save_shap_cache(cache_path, stored_model, cached_values, expected_value)
+
+    shap_values = np.array(
+        [cached_values[row_id] for row_id in row_ids.tolist()]
+    ).reshape(len(row_ids), selected.shape[1])
+    output_prefix = join(output_dir, "_".join([identifier, dose_type, model_type]))
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+
+    explained = df.loc[selected.index, ["jsonRowIndex", "time"]].reset_index(drop=True)
+    explained = pd.concat(
         [
-            "duration",
-            "percent",
-            "rate",
-            "bgInput",
-            "bg_30_min_before",
-            "bg_75_min_after",
-        ]
-    ]
-else:
-    ValueError("Invalid dose type selected")
+            explained,
+            pd.DataFrame(
+                shap_values, columns=["shap_" + column for column in selected.columns]
+            ),
+        ],
+        axis=1,
+    )
+    explained.to_csv(output_prefix + "_shap_values.csv", index=False)
+
+    importance = pd.DataFrame(
+        {
+            "feature": selected.columns,
+            "mean_abs_shap": (
+                np.abs(shap_values).mean(axis=0) if len(shap_values) > 0 else np.nan
+            ),
+        }
+    ).sort_values("mean_abs_shap", ascending=False)
+    importance.to_csv(output_prefix + "_importance.csv", index=False)
+
+    if len(shap_values) > 0:
+        save_shap_plots(shap_values, selected, output_prefix, image_format)
+
+    return importance
 
-trained_model = train_model(data_to_predict, "isolation_forest")
-# Explain the model's predictions using SHAP
-explainer = shap.TreeExplainer(trained_model)
-shap_values = explainer.shap_values(data_to_predict)
 
-# Plot the variables, ranked by impact on abnormality score
-shap.summary_plot(shap_values, data_to_predict, plot_type="bar")
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Explain which features make a patient's doses abnormal with SHAP values"
+    )
+    parser.add_argument(
+        "--file",
+        required=True,
+        help="csv of processed doses, from TaskMergePreprocessingTogether",
+    )
+    parser.add_argument(
+        "--identifier",
+        required=True,
+        help="identifier the pipeline ran the patient's raw data file with (usually the raw file's name), which the stored model is saved under",
+    )
+    parser.add_argument("--dose-type", choices=["bolus", "basal"], default="bolus")
+    parser.add_argument(
+        "--model-type",
+        default="knn",
+        help="type of model to explain (default: knn, like the pipeline); isolation_forest models use shap's fast TreeExplainer, while other model types use the much slower KernelExplainer",
+    )
+    parser.add_argument(
+        "--rows", choices=["sample", "abnormal", "all"], default="sample"
+    )
+    parser.add_argument(
+        "--sample-size",
+        type=int,
+        default=None,
+        help="number of doses to explain with '--rows sample' (default: 1000 for isolation_forest & 50 for other model types)",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--chunk-size", type=int, default=200)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--output-dir", default=default_output_dir)
+    parser.add_argument("--image-format", choices=["png", "svg"], default="png")
+    args = parser.parse_args()
 
-# For each data feature, plot the impact on abnormality score vs value (negative -> more abnormal)
-for col in data_to_predict.columns:
-    shap.dependence_plot(col, shap_values, data_to_predict)
+    assert exists(args.file)
+    importance = explain_doses(
+        pd.read_csv(args.file),
+        args.identifier,
+        args.dose_type,
+        args.model_type,
+        args.rows,
+        args.sample_size,
+        args.seed,
+        args.chunk_size,
+        args.workers,
+        args.output_dir,
+        args.image_format,
+    )
+    print(importance.to_string(index=False))
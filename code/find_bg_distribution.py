@@ -1,17 +1,284 @@
-import matplotlib.pyplot as plt
+import os
+import argparse
+import numpy as np
 import pandas as pd
+import matplotlib.pyplot as plt
+
+from pathlib import Path
+from os.path import join
+from concurrent.futures import ProcessPoolExecutor
+
+import optimized_analysis_pipeline as p
+from bulk_processor import add_file_arguments, get_file_paths, get_results_path
+from bg_grid_store import BGGrid, load_task_bg_grid
+from utils import mg_dl_per_mmol
+
+"""
+Distributions of BG values, for one patient or a whole cohort.
+
+BGs are counted into fixed bins, either of equal width in mg/dL or of equal width in log(BG),
+by computing each BG's bin with arithmetic & counting the bins with 'np.bincount'. Missing
+BGs (-1 or NaN) are counted separately instead of going into a bin, and BGs outside of the
+bins are counted as below or above the range. Histograms with the same bins can be added
+together, so each patient's BG grid (see 'bg_grid_store.py') is streamed through in blocks
+in a separate process, and the patients' histograms are merged into a cohort histogram.
+"""
+
+default_output_dir = get_results_path("bg_distributions")
+
+
+class BGHistogram:
+    """Counts of BGs in fixed bins, which can be merged with other histograms with the same bins"""
+
+    def __init__(self, scale="linear", low=40, high=400, n_bins=72):
+        """
+        scale: "linear" for bins of equal width in mg/dL, or "log" for bins of equal width in log(BG)
+        low: lower edge of the first bin, in mg/dL
+        high: upper edge of the last bin, in mg/dL
+        n_bins: number of bins
+        """
+        if scale not in ["linear", "log"]:
+            raise ValueError("Invalid scale " + scale + "; use 'linear' or 'log'")
+        self.scale = scale
+        self.low = low
+        self.high = high
+        self.n_bins = n_bins
+        # The first & last counts are the BGs below & above the bins
+        self.counts = np.zeros(n_bins + 2, dtype=np.int64)
+        self.missing = 0
+
+    def _transform(self, values):
+        return np.log10(values) if self.scale == "log" else values
+
+    def get_bin_edges(self):
+        """Get the edges of the bins, in mg/dL"""
+        edges = np.linspace(
+            self._transform(self.low), self._transform(self.high), self.n_bins + 1
+        )
+        return 10**edges if self.scale == "log" else edges
+
+    def update(self, values):
+        """
+        Count BGs
+
+        values: array of BGs in mmol/L, where missing BGs are -1 or NaN
+        """
+        values = np.asarray(values, dtype=float)
+        is_present = values > 0
+        self.missing += len(values) - np.count_nonzero(is_present)
+
+        start, end = self._transform(self.low), self._transform(self.high)
+        positions = (self._transform(values[is_present] * mg_dl_per_mmol) - start) / (
+            (end - start) / self.n_bins
+        )
+        # Bin 0 is below the range & bin n_bins + 1 is above it
+        indices = np.clip(np.floor(positions) + 1, 0, self.n_bins + 1).astype(np.int64)
+        self.counts += np.bincount(indices, minlength=self.n_bins + 2)
+        return self
+
+    def _has_same_bins(self, other):
+        return (self.scale, self.low, self.high, self.n_bins) == (
+            other.scale,
+            other.low,
+            other.high,
+            other.n_bins,
+        )
+
+    def merge(self, other):
+        """Add the counts of another histogram with the same bins"""
+        if not self._has_same_bins(other):
+            raise ValueError("Can't merge histograms with different bins")
+        self.counts += other.counts
+        self.missing += other.missing
+        return self
+
+    def get_bin_counts(self):
+        """Get the counts of the BGs in each bin, not including the BGs outside of the range"""
+        return self.counts[1:-1]
+
+    def get_below_range(self):
+        return int(self.counts[0])
+
+    def get_above_range(self):
+        return int(self.counts[-1])
+
+    def to_df(self):
+        """
+        Get the histogram as a df, with the "bin_start" & "bin_end" (in mg/dL), the
+        "count" of BGs in the bin & the "fraction" of the present BGs that are in it
+        """
+        edges = self.get_bin_edges()
+        total = self.counts.sum()
+        return pd.DataFrame(
+            {
+                "bin_start": edges[:-1],
+                "bin_end": edges[1:],
+                "count": self.get_bin_counts(),
+                "fraction": self.get_bin_counts() / total if total > 0 else np.nan,
+            }
+        )
+
+    def save(self, path):
+        """Save the histogram, so that it can be loaded & merged later"""
+        np.savez(
+            path,
+            scale=self.scale,
+            low=self.low,
+            high=self.high,
+            counts=self.counts,
+            missing=self.missing,
+        )
+
+    @classmethod
+    def load(cls, path):
+        """Load a histogram saved with 'save'"""
+        saved = np.load(path, allow_pickle=False)
+        histogram = cls(
+            str(saved["scale"]),
+            saved["low"].item(),
+            saved["high"].item(),
+            len(saved["counts"]) - 2,
+        )
+        histogram.counts = saved["counts"]
+        histogram.missing = int(saved["missing"])
+        return histogram
+
+
+def get_grid_histogram(grid_path, bins=None, block_size=2**20):
+    """
+    Count the BGs in a BG grid file, reading 'block_size' BGs at a time
+
+    grid_path: path to a grid saved with 'bg_grid_store.write_bg_grid'
+    bins: dict of the arguments to create the BGHistogram with
+
+    Returns: BGHistogram
+    """
+    grid = BGGrid(grid_path)
+    histogram = BGHistogram(**(bins or {}))
+    for start in range(0, len(grid), block_size):
+        histogram.update(grid.values[start : start + block_size])
+    return histogram
+
+
+def _get_grid_histogram(job):
+    return get_grid_histogram(*job)
+
+
+def get_cohort_histograms(grid_paths, bins=None, max_workers=None):
+    """
+    Count the BGs of every patient in a cohort, in parallel across processes
+
+    grid_paths: dict of identifier -> path to the patient's BG grid
+    bins: dict of the arguments to create the BGHistograms with
+    max_workers: number of processes to use (defaults to the number of cores)
+
+    Returns: tuple of (dict of identifier -> patient's BGHistogram, cohort BGHistogram)
+    """
+    identifiers = list(grid_paths)
+    with ProcessPoolExecutor(max_workers=max_workers or os.cpu_count()) as executor:
+        histograms = dict(
+            zip(
+                identifiers,
+                executor.map(
+                    _get_grid_histogram,
+                    [(grid_paths[identifier], bins) for identifier in identifiers],
+                ),
+            )
+        )
+
+    cohort_histogram = BGHistogram(**(bins or {}))
+    for histogram in histograms.values():
+        cohort_histogram.merge(histogram)
+    return histograms, cohort_histogram
+
+
+def save_histograms(histograms, cohort_histogram, output_dir=default_output_dir):
+    """
+    Save each patient's & the cohort's histograms, to be merged later, & all of the
+    counts to one csv with an "identifier" column ("cohort" for the cohort's counts)
+
+    Returns: path to the csv
+    """
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    all_histograms = dict(histograms, cohort=cohort_histogram)
+    dfs = []
+    for identifier, histogram in all_histograms.items():
+        histogram.save(join(output_dir, identifier + ".npz"))
+        df = histogram.to_df()
+        df.insert(0, "identifier", identifier)
+        dfs.append(df)
+
+    csv_path = join(output_dir, "bg_histograms.csv")
+    pd.concat(dfs).to_csv(csv_path, index=False)
+    return csv_path
+
+
+def plot_bg_frequencies(bgs, ax=None, title="BG Distribution"):
+    """
+    Plot the number of BGs in each bin
+
+    bgs: BGHistogram, or df from 'read_bgs_from_df' (which is counted into the default bins)
+    ax: matplotlib axes to plot on; defaults to the current axes
+
+    Returns: the axes
+    """
+    if isinstance(bgs, pd.DataFrame):
+        bgs = BGHistogram().update(bgs["value"])
+    ax = ax if ax is not None else plt.gca()
+    edges = bgs.get_bin_edges()
+
+    ax.stairs(bgs.get_bin_counts(), edges, fill=True)
+    if bgs.scale == "log":
+        ax.set_xscale("log")
+    ax.set_title(title)
+    ax.set_xlabel("BG (mg/dL)")
+    ax.set_ylabel("Count of Occurances")
+    return ax
+
 
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Count the BGs of every patient in a cohort into histograms"
+    )
+    add_file_arguments(parser)
+    parser.add_argument("--scale", choices=["linear", "log"], default="linear")
+    parser.add_argument("--low", type=float, default=40, help="lowest BG in mg/dL")
+    parser.add_argument("--high", type=float, default=400, help="highest BG in mg/dL")
+    parser.add_argument("--bins", type=int, default=72, help="number of bins")
+    parser.add_argument("--output-dir", default=default_output_dir)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument(
+        "--plot", action="store_true", help="show the cohort's distribution"
+    )
+    args = parser.parse_args()
 
-def plot_bg_frequencies(bg_df):
-    df = bg_df.groupby("log_bg").count()
-    # Include the line below if you want to exclude signal loss values from the plot
-    df = df.iloc[1:]
+    file_paths = get_file_paths(args)
 
-    # Convert mmol -> mg/dL
-    values = [18 * x for x in list(df.index)]
+    grid_paths = {}
+    for file_path in file_paths:
+        identifier = file_path.split("/")[-1]
+        task = p.TaskGetBGData(path=file_path, identifier=identifier)
+        grid_paths[identifier] = load_task_bg_grid(task).path
 
-    plt.scatter(values, df["time"])
-    plt.title("BG Distribution")
-    plt.xlabel("Log BG (mg/dL)")
-    plt.ylabel("Count of Occurances")
-    plt.show()
+    histograms, cohort_histogram = get_cohort_histograms(
+        grid_paths,
+        {"scale": args.scale, "low": args.low, "high": args.high, "n_bins": args.bins},
+        args.workers,
+    )
+    print(
+        "Saved the histograms to",
+        save_histograms(histograms, cohort_histogram, args.output_dir),
+    )
+    print(
+        cohort_histogram.get_bin_counts().sum(),
+        "BGs in range,",
+        cohort_histogram.get_below_range(),
+        "below,",
+        cohort_histogram.get_above_range(),
+        "above &",
+        cohort_histogram.missing,
+        "missing",
+    )
+    if args.plot:
+        plot_bg_frequencies(cohort_histogram)
+        plt.show()
@@ -0,0 +1,292 @@
+import argparse
+import numpy as np
+import pandas as pd
+
+from pathlib import Path
+
+from utils import mg_dl_per_mmol
+
+"""
+Standard glycemic metrics of a patient's BGs, computed over calendar days or weeks, or over a
+rolling window ending at every point of the BG grid.
+
+Every metric is computed from sums over the BGs in a period, like the number of BGs in each
+range & the sum of the BGs & their squares. These sums are found for every grid point in one
+vectorized pass, and then added up per period with a groupby, or per rolling window with
+cumulative sums. Since sums can also be added across patients, the metrics of a cohort come
+from the patients' sums the same way.
+
+Missing BGs (-1 or NaN) are left out of every metric, and the fraction of the period's grid
+points that have a BG is reported as the "coverage"; periods with less than 'min_coverage'
+have no metrics. The grid points of a period include the times before the first BG & after
+the last BG, so a day with only an hour of BGs has a coverage of 1/24.
+A hypoglycemic event is counted once BGs have been below the threshold for 'event_duration'
+minutes in a row, so it's counted at the time it's confirmed rather than when it started,
+and a missing BG ends an event.
+"""
+
+# Sums over the grid points of a period that the metrics are computed from
+glycemic_sum_columns = [
+    "n_points",  # grid points in the period, whether or not there's a BG row for them
+    "n_present",
+    "bg_sum",  # mg/dL
+    "bg_squared_sum",
+    "n_below_54",
+    "n_54_to_70",
+    "n_70_to_180",
+    "n_180_to_250",
+    "n_above_250",
+    "low_risk_sum",
+    "high_risk_sum",
+    "hypo_events",  # below 70 mg/dL
+    "severe_hypo_events",  # below 54 mg/dL
+]
+
+# Metrics computed from the sums, in the order 'get_glycemic_metrics' returns them
+glycemic_metric_columns = [
+    "coverage",  # fraction of the grid points with a BG
+    "mean_bg",  # mg/dL
+    "cv",  # coefficient of variation, in %
+    "gmi",  # glucose management indicator, in %
+    "percent_below_54",
+    "percent_54_to_70",
+    "percent_70_to_180",  # time in range
+    "percent_180_to_250",
+    "percent_above_250",
+    "lbgi",  # low blood glucose index
+    "hbgi",  # high blood glucose index
+    "hypo_events",
+    "severe_hypo_events",
+]
+
+
+def find_confirmed_events(is_below, min_points):
+    """
+    Find where runs of consecutive True values reach 'min_points' long
+
+    is_below: boolean array of whether each BG is below the event threshold
+
+    Returns: boolean array that's True at the 'min_points'-th point of each run
+    """
+    indices = np.arange(len(is_below))
+    last_not_below = np.maximum.accumulate(np.where(is_below, -1, indices))
+    return (indices - last_not_below) == min_points
+
+
+def get_glycemic_sums(bgs, bg_interval=5, event_duration=15):
+    """
+    Get the sums that the glycemic metrics are computed from, for every grid point
+
+    bgs: df with "time" & "value" (in mmol/L) columns, at a consistent interval of
+         'bg_interval' minutes, like from 'read_bgs_from_df'; missing BGs are -1 or NaN
+    bg_interval: minutes between each BG value
+    event_duration: minutes BGs must be low in a row to count as a hypoglycemic event
+
+    Returns: df with the "time" of each grid point & the columns in 'glycemic_sum_columns'
+    """
+    values = bgs["value"].to_numpy(dtype=float)
+    is_present = values > 0
+    bg = np.where(is_present, values * mg_dl_per_mmol, np.nan)
+
+    # Keep the times as a Series, so timezone-aware times stay timezone-aware
+    sums = pd.DataFrame({"time": pd.to_datetime(bgs["time"]).reset_index(drop=True)})
+    sums["n_points"] = 1
+    sums["n_present"] = is_present.astype(int)
+    sums["bg_sum"] = np.where(is_present, bg, 0)
+    sums["bg_squared_sum"] = sums["bg_sum"] ** 2
+
+    # Ranges of the consensus CGM targets: <54, 54-69, 70-180, 181-250 & >250 mg/dL
+    with np.errstate(invalid="ignore"):
+        ranges = (bg >= 54).astype(int) + (bg >= 70) + (bg > 180) + (bg > 250)
+    for i, column in enumerate(glycemic_sum_columns[4:9]):
+        sums[column] = (is_present & (ranges == i)).astype(int)
+
+    # Risk of each BG (Kovatchev et al., 1997); negative for lows & positive for highs
+    with np.errstate(invalid="ignore"):
+        f = 1.509 * (np.log(bg) ** 1.084 - 5.381)
+    risk = 10 * np.where(is_present, f, 0) ** 2
+    sums["low_risk_sum"] = np.where(f < 0, risk, 0)
+    sums["high_risk_sum"] = np.where(f > 0, risk, 0)
+
+    min_points = max(int(np.ceil(event_duration / bg_interval)), 1)
+    with np.errstate(invalid="ignore"):
+        is_low, is_very_low = is_present & (bg < 70), is_present & (bg < 54)
+    sums["hypo_events"] = find_confirmed_events(is_low, min_points).astype(int)
+    sums["severe_hypo_events"] = find_confirmed_events(is_very_low, min_points).astype(
+        int
+    )
+    return sums
+
+
+def get_glycemic_metrics(sums, min_coverage=0.7):
+    """
+    Compute the glycemic metrics from sums over periods
+
+    sums: df with the columns in 'glycemic_sum_columns', with one row per period
+    min_coverage: minimum fraction of the grid points in a period that must have a BG
+                  for its metrics to be computed
+
+    Returns: df with the columns in 'glycemic_metric_columns', with the same index as 'sums'
+    """
+    n_present = sums["n_present"].to_numpy(dtype=float)
+    metrics = pd.DataFrame(index=sums.index)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        metrics["coverage"] = n_present / sums["n_points"]
+        mean = sums["bg_sum"] / n_present
+        variance = (sums["bg_squared_sum"] - n_present * mean**2) / (n_present - 1)
+        metrics["mean_bg"] = mean
+        metrics["cv"] = 100 * np.sqrt(np.maximum(variance, 0)) / mean
+        metrics["gmi"] = 3.31 + 0.02392 * mean
+        for sum_column in glycemic_sum_columns[4:9]:
+            metrics["percent" + sum_column[1:]] = 100 * sums[sum_column] / n_present
+        metrics["lbgi"] = sums["low_risk_sum"] / n_present
+        metrics["hbgi"] = sums["high_risk_sum"] / n_present
+    metrics["hypo_events"] = sums["hypo_events"]
+    metrics["severe_hypo_events"] = sums["severe_hypo_events"]
+
+    too_sparse = ~(metrics["coverage"] >= min_coverage)
+    metrics.loc[too_sparse, glycemic_metric_columns[1:]] = np.nan
+    return metrics
+
+
+def join_glycemic_metrics(sums, min_coverage=0.7):
+    """Add the glycemic metrics to a df of sums, keeping the summed event counts"""
+    metrics = get_glycemic_metrics(sums, min_coverage)
+    return sums.join(metrics.drop(columns=glycemic_sum_columns, errors="ignore"))
+
+
+def get_period_glycemic_metrics(
+    bgs, frequency="D", bg_interval=5, event_duration=15, min_coverage=0.7
+):
+    """
+    Compute the glycemic metrics of a patient per calendar period
+
+    bgs: df with "time" & "value" (in mmol/L) columns, like from 'read_bgs_from_df'
+    frequency: pandas frequency of the periods, ex: "D" for days or "W-MON" for weeks starting on Mondays
+
+    Returns: df with the start "time" of each period, the columns in 'glycemic_sum_columns'
+             (so the periods can be merged across patients with 'get_cohort_glycemic_metrics'),
+             & the columns in 'glycemic_metric_columns'
+    """
+    sums = get_glycemic_sums(bgs, bg_interval, event_duration)
+    period_sums = (
+        sums.groupby(
+            pd.Grouper(key="time", freq=frequency, label="left", closed="left")
+        )[glycemic_sum_columns]
+        .sum()
+        .reset_index()
+    )
+    # Count every grid point in the period, not only the ones in the BG grid, which
+    # starts at the first BG & ends at the last one
+    period_ends = period_sums["time"] + pd.tseries.frequencies.to_offset(frequency)
+    period_sums["n_points"] = (
+        (period_ends - period_sums["time"]) / pd.Timedelta(minutes=bg_interval)
+    ).astype(int)
+    return join_glycemic_metrics(period_sums, min_coverage)
+
+
+def get_rolling_glycemic_metrics(
+    bgs, window_minutes=1440, bg_interval=5, event_duration=15, min_coverage=0.7
+):
+    """
+    Compute the glycemic metrics over the window ending at every point of the BG grid,
+    which can be joined to doses with 'bg_features.join_bg_features'
+
+    bgs: df with "time" & "value" (in mmol/L) columns, like from 'read_bgs_from_df'
+    window_minutes: length of the window, in minutes
+
+    Returns: df with the "time" of each grid point & the columns in 'glycemic_metric_columns'
+    """
+    sums = get_glycemic_sums(bgs, bg_interval, event_duration)
+    cumulative = np.vstack(
+        [
+            np.zeros(len(glycemic_sum_columns)),
+            np.cumsum(sums[glycemic_sum_columns].to_numpy(dtype=float), axis=0),
+        ]
+    )
+    ends = np.arange(1, len(sums) + 1)
+    starts = np.maximum(ends - window_minutes // bg_interval, 0)
+    window_sums = pd.DataFrame(
+        cumulative[ends] - cumulative[starts], columns=glycemic_sum_columns
+    )
+    # Windows that start before the first BG still cover the whole window length
+    window_sums["n_points"] = window_minutes // bg_interval
+
+    metrics = get_glycemic_metrics(window_sums, min_coverage)
+    metrics.insert(0, "time", sums["time"])
+    return metrics
+
+
+def get_cohort_glycemic_metrics(patient_metrics, min_coverage=0.7):
+    """
+    Combine the period metrics of the patients in a cohort
+
+    patient_metrics: list of dfs from 'get_period_glycemic_metrics', with the same frequency
+
+    Returns: tuple of (df of the cohort's metrics per period, with the start "time" of each
+             period & the number of "patients" with BGs in it, df with one row of the
+             cohort's metrics over all of the periods)
+    """
+    all_metrics = pd.concat(patient_metrics, ignore_index=True)
+    all_metrics["patients"] = (all_metrics["n_present"] > 0).astype(int)
+    period_sums = (
+        all_metrics.groupby("time")[glycemic_sum_columns + ["patients"]]
+        .sum()
+        .reset_index()
+    )
+    period_metrics = join_glycemic_metrics(period_sums, min_coverage)
+
+    total_sums = all_metrics[glycemic_sum_columns].sum().to_frame().T
+    return period_metrics, get_glycemic_metrics(total_sums, min_coverage)
+
+
+if __name__ == "__main__":
+    # Imported here, since the pipeline imports this module for its tasks
+    import optimized_analysis_pipeline as p
+    from bulk_processor import (
+        add_file_arguments,
+        get_file_paths,
+        get_results_path,
+        load_task,
+    )
+
+    parser = argparse.ArgumentParser(
+        description="Compute the glycemic metrics of every patient in a cohort"
+    )
+    add_file_arguments(parser)
+    parser.add_argument(
+        "--frequency",
+        default="D",
+        help="pandas frequency of the periods, ex: 'D' for days or 'W-MON' for weeks",
+    )
+    parser.add_argument("--min-coverage", type=float, default=0.7)
+    parser.add_argument(
+        "--output-dir",
+        default=get_results_path("glycemic_metrics"),
+    )
+    args = parser.parse_args()
+
+    file_paths = get_file_paths(args)
+
+    patient_metrics = []
+    for file_path in file_paths:
+        identifier = file_path.split("/")[-1]
+        metrics = load_task(
+            p.TaskGetGlycemicMetrics(
+                path=file_path, identifier=identifier, frequency=args.frequency
+            )
+        )
+        metrics["time"] = pd.to_datetime(metrics["time"])
+        metrics.insert(0, "identifier", identifier)
+        patient_metrics.append(metrics)
+
+    period_metrics, cohort_metrics = get_cohort_glycemic_metrics(
+        patient_metrics, args.min_coverage
+    )
+    Path(args.output_dir).mkdir(parents=True, exist_ok=True)
+    pd.concat(patient_metrics).to_csv(
+        args.output_dir + "/patient_metrics.csv", index=False
+    )
+    period_metrics.to_csv(args.output_dir + "/cohort_period_metrics.csv", index=False)
+    cohort_metrics.to_csv(args.output_dir + "/cohort_metrics.csv", index=False)
+    print(cohort_metrics[glycemic_metric_columns].T.to_string(header=False))
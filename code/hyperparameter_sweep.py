@@ -0,0 +1,241 @@
+import os
+import json
+import argparse
+import numpy as np
+import pandas as pd
+
+from pathlib import Path
+from os.path import exists, join
+from concurrent.futures import ProcessPoolExecutor
+from sklearn.model_selection import ParameterGrid
+
+import optimized_analysis_pipeline as p
+from run_journal import get_fingerprint
+from bulk_processor import add_file_arguments, get_file_paths, get_results_path
+from bolus_risk_analysis import train_model, get_training_predictions
+from cohort_analysis import load_processed_doses, get_cohort_features
+
+"""
+Compare model parameters across patients without re-running the pipeline for each trial.
+
+1) Cache each patient's bolus & temp basal feature matrices once
+2) Train every configuration in a parameter grid on every patient's cached features,
+   spread across a process pool
+3) Summarize the outlier counts of each configuration, and how much its outliers
+   overlap with the outliers of a reference configuration
+"""
+
+default_cache_dir = get_results_path("feature_cache")
+
+# Grid in the format of sklearn's ParameterGrid; each "model_type" gets its own dict,
+# since the model types take different parameters
+default_grid = [
+    {
+        "model_type": ["knn"],
+        "contamination": [0.01, 0.05, 0.1],
+        "n_neighbors": [5, 10, 20],
+    },
+    {
+        "model_type": ["isolation_forest"],
+        "contamination": [0.01, 0.05, 0.1],
+        "n_estimators": [100, 200],
+    },
+]
+
+# The configuration the outliers of the other configurations are compared to
+default_reference_config = {"model_type": "knn"}
+
+dose_types = ["bolus", "basal"]
+
+
+def get_cache_key(file_path):
+    """Get the path & fingerprint of a raw data file, to tell if its cached features are stale"""
+    return json.dumps(
+        dict(path=os.path.abspath(file_path), **get_fingerprint(file_path)),
+        sort_keys=True,
+    )
+
+
+def is_cached(cache_path, cache_key):
+    """Check if feature matrices were cached from the same version of the same raw data file"""
+    if not exists(cache_path):
+        return False
+    with np.load(cache_path, allow_pickle=False) as cached:
+        return "cache_key" in cached and str(cached["cache_key"]) == cache_key
+
+
+def cache_feature_matrices(file_paths, cache_dir=default_cache_dir):
+    """
+    Save each patient's bolus & temp basal feature matrices, skipping patients whose
+    raw data file hasn't changed (or moved) since their features were cached; the
+    pipeline is re-run on files that changed
+
+    file_paths: list of paths to the raw data files of the patients
+    cache_dir: folder to save the feature matrices to
+
+    Returns: list of paths to the cached feature matrices
+    """
+    Path(cache_dir).mkdir(parents=True, exist_ok=True)
+    cache_paths = []
+
+    for file_path in file_paths:
+        cache_path = join(cache_dir, file_path.split("/")[-1] + ".npz")
+        cache_key = get_cache_key(file_path)
+        if not is_cached(cache_path, cache_key):
+            if exists(cache_path):
+                # The raw data file changed, so re-run the pipeline on it, rather than
+                # rebuilding the cache from the pipeline outputs of the old file
+                p.TaskGetInitialData(
+                    path=file_path, identifier=file_path.split("/")[-1]
+                ).invalidate(confirm=False)
+            processed_df = load_processed_doses(file_path)
+            arrays = {"cache_key": np.array(cache_key)}
+            for dose_type in dose_types:
+                df, features = get_cohort_features(processed_df, dose_type)
+                arrays[dose_type] = features.values
+                arrays[dose_type + "_columns"] = np.array(features.columns)
+                arrays[dose_type + "_rows"] = df["jsonRowIndex"].values
+            np.savez(cache_path, **arrays)
+            print("Cached features for", file_path)
+        cache_paths.append(cache_path)
+
+    return cache_paths
+
+
+def find_outlier_rows(cache_path, dose_type, config):
+    """
+    Train a model configuration on one patient's cached features
+
+    cache_path: path to the patient's cached feature matrices
+    dose_type: type of doses to train on, either "bolus" or "basal"
+    config: dict with the "model_type" & the parameters to create the model with
+
+    Returns: tuple of (number of doses, array of the jsonRowIndex of the outliers),
+        where the outliers are None if there were too few doses to train the model
+    """
+    cached = np.load(cache_path, allow_pickle=True)
+    features = pd.DataFrame(cached[dose_type], columns=cached[dose_type + "_columns"])
+    rows = cached[dose_type + "_rows"]
+
+    params = dict(config)
+    model_type = params.pop("model_type")
+    if len(features) <= params.get("n_neighbors", 5):
+        return len(features), None
+
+    predictions, _ = get_training_predictions(
+        train_model(features, model_type, **params), features
+    )
+    # Isolation forest: 1 is normal, -1 is abnormal
+    # KNN: 0 is normal, 1 is abnormal
+    abnormal = predictions == (-1 if model_type == "isolation_forest" else 1)
+
+    return len(features), rows[abnormal]
+
+
+def _run_trial(trial):
+    """Unpack a trial for the process pool"""
+    config_id, cache_path, dose_type, config = trial
+    doses, outliers = find_outlier_rows(cache_path, dose_type, config)
+    return config_id, cache_path, dose_type, doses, outliers
+
+
+def jaccard_index(first, second):
+    """Overlap of two sets of outliers, from 0 (no overlap) to 1 (identical)"""
+    union = np.union1d(first, second)
+    return len(np.intersect1d(first, second)) / len(union) if len(union) > 0 else 1.0
+
+
+def run_sweep(
+    cache_paths,
+    grid=default_grid,
+    reference_config=default_reference_config,
+    max_workers=None,
+):
+    """
+    Train every configuration in a parameter grid on every patient's cached features
+
+    cache_paths: list of paths to cached feature matrices, from 'cache_feature_matrices'
+    grid: parameter grid, in the format of sklearn's ParameterGrid
+    reference_config: configuration to compare the outliers of every configuration to
+    max_workers: number of processes to use (defaults to the number of cores)
+
+    Returns: tuple of (df with one row per configuration & dose type,
+                       df with one row per configuration, dose type & patient)
+    """
+    # Configuration 0 is the reference
+    configs = [reference_config] + list(ParameterGrid(grid))
+    trials = [
+        (config_id, cache_path, dose_type, config)
+        for config_id, config in enumerate(configs)
+        for cache_path in cache_paths
+        for dose_type in dose_types
+    ]
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(_run_trial, trials, chunksize=4))
+
+    reference_outliers = {
+        (cache_path, dose_type): outliers
+        for config_id, cache_path, dose_type, _, outliers in results
+        if config_id == 0
+    }
+
+    rows = []
+    for config_id, cache_path, dose_type, doses, outliers in results:
+        reference = reference_outliers[(cache_path, dose_type)]
+        trained = outliers is not None
+        rows.append(
+            {
+                "config_id": config_id,
+                "config": json.dumps(configs[config_id], sort_keys=True),
+                "dose_type": dose_type,
+                "identifier": os.path.basename(cache_path)[: -len(".npz")],
+                "doses": doses,
+                "outliers": len(outliers) if trained else np.nan,
+                "jaccard_vs_reference": (
+                    jaccard_index(outliers, reference)
+                    if trained and reference is not None
+                    else np.nan
+                ),
+            }
+        )
+    by_patient = pd.DataFrame(rows)
+
+    trained_patients = by_patient.dropna(subset=["outliers"])
+    summary = trained_patients.groupby(["config_id", "config", "dose_type"]).agg(
+        patients=("identifier", "count"),
+        doses=("doses", "sum"),
+        outliers=("outliers", "sum"),
+        mean_jaccard_vs_reference=("jaccard_vs_reference", "mean"),
+        min_jaccard_vs_reference=("jaccard_vs_reference", "min"),
+    )
+    summary["outlier_percent"] = summary["outliers"] / summary["doses"] * 100
+
+    return summary.reset_index(), by_patient
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare anomaly model configurations across patients"
+    )
+    add_file_arguments(parser)
+    parser.add_argument(
+        "--grid", help="json file with the parameter grid (defaults to 'default_grid')"
+    )
+    parser.add_argument("--cache-dir", default=default_cache_dir)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--output", default="../results/sweep_summary.csv")
+    args = parser.parse_args()
+
+    file_paths = get_file_paths(args)
+
+    grid = default_grid
+    if args.grid is not None:
+        with open(args.grid) as f:
+            grid = json.load(f)
+
+    cache_paths = cache_feature_matrices(file_paths, args.cache_dir)
+    summary, by_patient = run_sweep(cache_paths, grid, max_workers=args.workers)
+    summary.to_csv(args.output, index=False)
+    by_patient.to_csv(os.path.splitext(args.output)[0] + "_by_patient.csv", index=False)
+    print(summary.to_string(index=False))
@@ -0,0 +1,224 @@
+import argparse
+import numpy as np
+import pandas as pd
+import stumpy
+
+from pathlib import Path
+from os.path import exists, join
+
+from bulk_processor import add_file_arguments, get_file_paths, get_results_path
+from utils import read_bgs_from_df
+
+"""
+Matrix profiles of patients' log BGs that are updated as new BGs arrive, instead of being
+recomputed over the whole history.
+
+Each patient's profile is kept in a stumpy 'stumpi' object: appending one BG updates the
+profile in time proportional to the length of the history, rather than the square of it.
+The BGs & profile are saved to a npz file per patient between runs, so a run only has to
+process the BGs that arrived since the last run.
+"""
+
+default_state_dir = get_results_path("matrix_profiles")
+
+
+class PatientMatrixProfile:
+    """
+    Matrix profile of one patient's log BGs, at a consistent interval of 'bg_interval' minutes.
+    Missing BGs are NaN; windows that contain them are never motifs or discords.
+    """
+
+    def __init__(self, start, window_length=20, bg_interval=5):
+        """
+        start: time of the patient's first BG
+        window_length: number of BGs in each window that's compared (the 'm' of the matrix profile)
+        bg_interval: minutes between each BG value
+        """
+        self.start = pd.Timestamp(start)
+        self.window_length = window_length
+        self.bg_interval = bg_interval
+        self.log_bgs = np.array([])
+        self.stream = None
+
+    def get_time(self, index):
+        """Get the time of the BG at an index"""
+        return self.start + pd.Timedelta(minutes=int(index) * self.bg_interval)
+
+    def append(self, log_bgs):
+        """
+        Add the next BGs to the end of the profile
+
+        log_bgs: array of log BGs at 'bg_interval' minute intervals, where missing BGs are NaN
+        """
+        log_bgs = np.asarray(log_bgs, dtype=float)
+        if self.stream is not None:
+            for log_bg in log_bgs:
+                self.stream.update(log_bg)
+        self.log_bgs = np.concatenate([self.log_bgs, log_bgs])
+
+        # Wait until there are enough BGs for the windows to have neighbors
+        if self.stream is None and len(self.log_bgs) > 2 * self.window_length:
+            self.stream = stumpy.stumpi(self.log_bgs, self.window_length, egress=False)
+
+    def add_bgs(self, bgs):
+        """
+        Add the BGs that are newer than the last BG in the profile
+
+        bgs: df with "time" & "log_bg" columns, where the times are at 'bg_interval' minute intervals
+
+        Returns: number of BGs that were added, including missing BGs in gaps between them
+        """
+        bgs = bgs.dropna(subset=["log_bg"])
+        slots = (
+            np.round(
+                (pd.to_datetime(bgs["time"]) - self.start)
+                / pd.Timedelta(minutes=self.bg_interval)
+            )
+            .astype(int)
+            .values
+        )
+        is_new = slots >= len(self.log_bgs)
+        if not is_new.any():
+            return 0
+
+        new_slots = slots[is_new] - len(self.log_bgs)
+        new_bgs = np.full(new_slots.max() + 1, np.nan)
+        new_bgs[new_slots] = bgs["log_bg"].values[is_new]
+        self.append(new_bgs)
+
+        return len(new_bgs)
+
+    def get_top_discord(self):
+        """
+        Get the window that's the least similar to every other window
+
+        Returns: dict with the start "time" of the window & its "distance" to its nearest
+            neighbor, or None if there aren't windows without missing BGs
+        """
+        if self.stream is None or not np.isfinite(self.stream.P_).any():
+            return None
+        profile = np.where(np.isfinite(self.stream.P_), self.stream.P_, -np.inf)
+        index = profile.argmax()
+        return {"time": self.get_time(index), "distance": profile[index]}
+
+    def get_top_motif(self):
+        """
+        Get the pair of windows that are the most similar to each other
+
+        Returns: dict with the start "time" of the window, the start "neighbor_time" of its
+            nearest neighbor & the "distance" between them, or None if there isn't a pair
+        """
+        if self.stream is None or not np.isfinite(self.stream.P_).any():
+            return None
+        index = self.stream.P_.argmin()
+        return {
+            "time": self.get_time(index),
+            "neighbor_time": self.get_time(self.stream.I_[index]),
+            "distance": self.stream.P_[index],
+        }
+
+    def save(self, path):
+        """Save the BGs & profile to a npz file"""
+        profile = {}
+        if self.stream is not None:
+            profile = {
+                "profile": self.stream.P_,
+                "indices": self.stream.I_,
+                "left_indices": self.stream.left_I_,
+            }
+        np.savez(
+            path,
+            start=str(self.start),
+            window_length=self.window_length,
+            bg_interval=self.bg_interval,
+            log_bgs=self.log_bgs,
+            **profile
+        )
+
+    @classmethod
+    def load(cls, path):
+        """Load a profile saved with 'save', without recomputing it"""
+        saved = np.load(path)
+        profile = cls(
+            str(saved["start"]), int(saved["window_length"]), int(saved["bg_interval"])
+        )
+        profile.log_bgs = saved["log_bgs"]
+        if "profile" in saved:
+            # stumpi takes the profile, its indices, the left indices & the right indices,
+            # but the right indices aren't used to update the profile
+            mp = np.column_stack(
+                [
+                    saved["profile"],
+                    saved["indices"],
+                    saved["left_indices"],
+                    np.full(len(saved["profile"]), -1),
+                ]
+            ).astype(object)
+            profile.stream = stumpy.stumpi(
+                profile.log_bgs, profile.window_length, egress=False, mp=mp
+            )
+        return profile
+
+
+def update_patient_profile(file_path, state_dir=default_state_dir, window_length=20):
+    """
+    Add the BGs in a raw data file that are newer than the patient's saved profile
+
+    file_path: path to the raw data file of the patient
+    state_dir: folder the profiles are saved to
+    window_length: number of BGs in each window, if a new profile is created
+
+    Returns: tuple of (the updated profile, number of BGs that were added)
+    """
+    bgs = read_bgs_from_df(pd.read_csv(file_path))
+    state_path = join(state_dir, file_path.split("/")[-1] + ".npz")
+
+    if exists(state_path):
+        profile = PatientMatrixProfile.load(state_path)
+    else:
+        profile = PatientMatrixProfile(bgs["time"].iloc[0], window_length)
+    added = profile.add_bgs(bgs)
+
+    Path(state_dir).mkdir(parents=True, exist_ok=True)
+    profile.save(state_path)
+    return profile, added
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Update patients' BG matrix profiles & report their top discords & motifs"
+    )
+    add_file_arguments(parser)
+    parser.add_argument("--state-dir", default=default_state_dir)
+    parser.add_argument(
+        "--window-length", type=int, default=20, help="number of BGs in each window"
+    )
+    parser.add_argument("--output", default="../results/matrix_profile_summary.csv")
+    args = parser.parse_args()
+
+    file_paths = get_file_paths(args)
+
+    rows = []
+    for file_path in file_paths:
+        profile, added = update_patient_profile(
+            file_path, args.state_dir, args.window_length
+        )
+        discord = profile.get_top_discord() or {}
+        motif = profile.get_top_motif() or {}
+        rows.append(
+            {
+                "identifier": file_path.split("/")[-1],
+                "bgs": len(profile.log_bgs),
+                "bgs_added": added,
+                "discord_time": discord.get("time"),
+                "discord_distance": discord.get("distance"),
+                "motif_time": motif.get("time"),
+                "motif_neighbor_time": motif.get("neighbor_time"),
+                "motif_distance": motif.get("distance"),
+            }
+        )
+        print("Updated", file_path, "-", added, "BGs added")
+
+    summary = pd.DataFrame(rows)
+    summary.to_csv(args.output, index=False)
+    print(summary.to_string(index=False))
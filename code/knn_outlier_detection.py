@@ -0,0 +1,120 @@
+import numpy as np
+
+from sklearn.neighbors import NearestNeighbors
+
+
+class KNNOutlierDetector:
+    """
+    K-nearest neighbors outlier detector that standardizes the features before
+    searching for neighbors, so that features like "TDD" don't drown out the others.
+
+    The abnormality score of a dose is the distance to its k-th nearest neighbor, and the
+    "contamination" fraction of the training doses with the highest scores are outliers.
+    Like pyod's KNN, predictions are 0 for normal doses and 1 for abnormal doses.
+    """
+
+    def __init__(
+        self,
+        n_neighbors=5,
+        contamination=0.1,
+        algorithm="kd_tree",
+        leaf_size=30,
+        approximate=False,
+        sample_fraction=0.1,
+        min_sample_size=1000,
+        n_jobs=-1,
+        random_state=42,
+    ):
+        """
+        n_neighbors: the k in k-nearest neighbors
+        contamination: expected fraction of outliers in the training data
+        algorithm: neighbor search structure, either "kd_tree" or "ball_tree"
+        leaf_size: leaf size of the search tree; affects the speed of the search, not the result
+        approximate: whether to search for neighbors within a random sample of the training
+                     doses rather than all of them, which is faster but less accurate
+        sample_fraction: fraction of the training doses to sample in approximate mode;
+                         larger values are more accurate but slower
+        min_sample_size: minimum number of doses to sample in approximate mode
+        n_jobs: number of cores to use for the neighbor search (-1 uses all cores)
+        random_state: seed for the sampling in approximate mode
+        """
+        self.n_neighbors = n_neighbors
+        self.contamination = contamination
+        self.algorithm = algorithm
+        self.leaf_size = leaf_size
+        self.approximate = approximate
+        self.sample_fraction = sample_fraction
+        self.min_sample_size = min_sample_size
+        self.n_jobs = n_jobs
+        self.random_state = random_state
+
+    def fit(self, X):
+        """Build the neighbor search tree from the training doses & find the outlier threshold"""
+        X = np.asarray(X, dtype=float)
+        self.mean_ = X.mean(axis=0)
+        std = X.std(axis=0)
+        # Constant features would otherwise divide by 0
+        self.std_ = np.where(std > 0, std, 1)
+        X = self._standardize(X)
+
+        in_reference = np.ones(len(X), dtype=bool)
+        if self.approximate:
+            sample_size = max(self.min_sample_size, int(self.sample_fraction * len(X)))
+            if sample_size < len(X):
+                rng = np.random.RandomState(self.random_state)
+                in_reference[:] = False
+                in_reference[rng.choice(len(X), sample_size, replace=False)] = True
+        reference = X[in_reference]
+
+        self.neighbors_ = NearestNeighbors(
+            n_neighbors=min(self.n_neighbors, len(reference)),
+            algorithm=self.algorithm,
+            leaf_size=self.leaf_size,
+            n_jobs=self.n_jobs,
+        ).fit(reference)
+
+        # Doses in the search tree would find themselves at distance 0, so (like pyod)
+        # they're scored against the other doses in the tree instead. 'predict' can't
+        # leave the training doses out like this, so use 'labels_' & 'decision_scores_'
+        # for the doses the model was trained on.
+        self.decision_scores_ = np.zeros(len(X))
+        if (~in_reference).any():
+            self.decision_scores_[~in_reference] = self._kth_neighbor_distances(
+                X[~in_reference]
+            )
+        if len(reference) > 1:
+            distances, _ = self.neighbors_.kneighbors(
+                n_neighbors=min(self.n_neighbors, len(reference) - 1)
+            )
+            self.decision_scores_[in_reference] = distances[:, -1]
+        self.threshold_ = np.percentile(
+            self.decision_scores_, 100 * (1 - self.contamination)
+        )
+        self.labels_ = (self.decision_scores_ > self.threshold_).astype(int)
+
+        return self
+
+    def decision_function(self, X):
+        """Get the abnormality scores of doses; higher scores are more abnormal"""
+        return self._kth_neighbor_distances(
+            self._standardize(np.asarray(X, dtype=float))
+        )
+
+    def predict(self, X):
+        """Predict whether doses are abnormal (1) or normal (0)"""
+        return (self.decision_function(X) > self.threshold_).astype(int)
+
+    def _standardize(self, X):
+        return (X - self.mean_) / self.std_
+
+    def _kth_neighbor_distances(self, X):
+        distances, _ = self.neighbors_.kneighbors(X)
+        return distances[:, -1]
+
+
+# Model types that use the KNNOutlierDetector, and the parameters they're created with
+knn_detector_model_types = {
+    "knn_kd_tree": {"algorithm": "kd_tree"},
+    "knn_ball_tree": {"algorithm": "ball_tree"},
+    "knn_approximate": {"algorithm": "kd_tree", "approximate": True},
+}
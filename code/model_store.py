@@ -0,0 +1,111 @@
+import os
+import joblib
+import pandas as pd
+
+from pathlib import Path
+
+# Models are saved next to the task output in the results folder
+default_model_dir = str(Path(__file__).parent.parent) + "/results/models"
+
+
+def get_model_path(identifier, dose_type, model_type, model_dir=default_model_dir):
+    """
+    Get the path that the model for a particular patient & model type is saved to
+
+    identifier: identifier of the patient's data file (usually the file name)
+    dose_type: type of dose the model classifies, either "bolus" or "basal"
+    model_type: type of model, ex: "knn" or "isolation_forest"
+    model_dir: folder to save the models in
+
+    Returns: path to the model file
+    """
+    file_name = "_".join([identifier, dose_type, model_type]) + ".joblib"
+    return os.path.join(model_dir, file_name)
+
+
+def get_feature_stats(data_to_predict):
+    """
+    Compute the summary statistics of the features a model was trained on
+
+    data_to_predict: df with the features passed into the model
+
+    Returns: dict of the form {column: {"mean": x, "std": x, "median": x, "min": x, "max": x}}
+    """
+    stats = data_to_predict.agg(["mean", "std", "median", "min", "max"])
+    return {col: stats[col].to_dict() for col in stats.columns}
+
+
+def save_model(model, model_path, model_type, data_to_predict, last_scored_time=None):
+    """
+    Save a trained model along with the feature schema & statistics of the data it was trained on
+
+    model: trained model
+    model_path: path to save the model to
+    model_type: type of model, ex: "knn" or "isolation_forest"
+    data_to_predict: df with the features the model was trained on
+    last_scored_time: time of the last dose a streaming model scored, as an isoformat string
+    """
+    Path(model_path).parent.mkdir(parents=True, exist_ok=True)
+    stored_model = {
+        "model": model,
+        "model_type": model_type,
+        "features": list(data_to_predict.columns),
+        "feature_stats": get_feature_stats(data_to_predict),
+        "training_rows": len(data_to_predict),
+        "trained_at": pd.Timestamp.now().isoformat(),
+        "last_scored_time": last_scored_time,
+    }
+    joblib.dump(stored_model, model_path)
+
+
+def update_stored_model(stored_model, model_path, last_scored_time=None):
+    """
+    Save a stored model again after its model was updated with new doses (ex: a streaming
+    model that scored them), keeping the feature schema & statistics of its training data
+
+    stored_model: dict from 'load_model', with the updated model under "model"
+    model_path: path to save the model to
+    last_scored_time: time of the last dose the model scored, as an isoformat string
+    """
+    stored_model = {
+        **stored_model,
+        "updated_at": pd.Timestamp.now().isoformat(),
+        "last_scored_time": last_scored_time,
+    }
+    joblib.dump(stored_model, model_path)
+
+
+def load_model(model_path, model_type, features):
+    """
+    Load a model that was saved with 'save_model', checking it matches the data it will be used on
+
+    model_path: path the model was saved to
+    model_type: expected type of model, ex: "knn" or "isolation_forest"
+    features: list of feature columns that will be passed into the model
+
+    Returns: dict with the trained model under "model", the "model_type", the list of
+        "features", the "feature_stats" of the training data, and the number of "training_rows"
+    """
+    if not os.path.exists(model_path):
+        raise FileNotFoundError(
+            "No stored model at " + model_path + "; train the model before scoring"
+        )
+
+    stored_model = joblib.load(model_path)
+    if stored_model["model_type"] != model_type:
+        raise ValueError(
+            "Stored model has model type "
+            + stored_model["model_type"]
+            + ", but "
+            + model_type
+            + " was requested"
+        )
+    if stored_model["features"] != list(features):
+        raise ValueError(
+            "Stored model was trained on features "
+            + str(stored_model["features"])
+            + ", but got "
+            + str(list(features))
+        )
+
+    return stored_model
@@ -0,0 +1,293 @@
+import json
+import argparse
+import numpy as np
+import pandas as pd
+
+from pathlib import Path
+from sklearn.cluster import MiniBatchKMeans
+
+import optimized_analysis_pipeline as p
+from bulk_processor import add_file_arguments, get_file_paths, get_results_path
+from utils import sliding_windows
+from bg_grid_store import load_task_bg_grid
+from dtw_motif_clustering import DTWKMeans
+
+"""
+Cluster windows of BG data into motifs, for BG histories that are too large to cluster all at once.
+
+1) Train mini-batch k-means on a uniform random sample of the windows that have no missing BGs,
+   drawn across every patient
+2) Assign every window to its closest motif in fixed-size chunks, so that only one
+   chunk of windows is copied into memory at a time
+3) Save the motif centers & the motif of every window to one compressed npz file
+
+Windows are read-only views into each patient's BG array (see 'utils.sliding_windows'),
+so a window's BGs are never copied unless the window is sampled or in the current chunk.
+"""
+
+default_motif_path = get_results_path("motifs.npz")
+
+# Label of windows that weren't assigned a motif because they have missing BGs
+missing_label = -1
+
+
+def load_bgs(file_path):
+    """
+    Load the BG grid for a raw data file, running the pipeline if needed
+
+    Returns: tuple of (time of the first BG, array of BGs in mg/dL where missing BGs are NaN)
+    """
+    identifier = file_path.split("/")[-1]
+    grid = load_task_bg_grid(p.TaskGetBGData(path=file_path, identifier=identifier))
+    return grid.start, grid.values * 18
+
+
+def sample_complete_windows(window_sets, max_windows, rng):
+    """
+    Get a uniform random sample of the windows with no missing BGs, across several patients
+
+    window_sets: list of (windows, missing) tuples from 'utils.sliding_windows'
+    max_windows: maximum number of windows to sample
+    rng: numpy RandomState
+
+    Returns: 2d array with one sampled window per row
+    """
+    complete_rows = [np.flatnonzero(~missing.any(axis=1)) for _, missing in window_sets]
+    set_starts = np.cumsum([0] + [len(rows) for rows in complete_rows])
+    total = set_starts[-1]
+
+    chosen = np.sort(rng.choice(total, min(max_windows, total), replace=False))
+    set_of_chosen = np.searchsorted(set_starts, chosen, side="right") - 1
+
+    return np.concatenate(
+        [
+            window_sets[i][0][
+                complete_rows[i][chosen[set_of_chosen == i] - set_starts[i]]
+            ]
+            for i in range(len(window_sets))
+        ]
+        + [np.empty((0, window_sets[0][0].shape[1]), dtype=np.float32)]
+    )
+
+
+def fit_motif_clusters(
+    window_sets,
+    n_clusters=20,
+    max_training_windows=100000,
+    batch_size=4096,
+    seed=0,
+    metric="euclidean",
+    band=2,
+):
+    """
+    Train k-means on a sample of the windows
+
+    window_sets: list of (windows, missing) tuples from 'utils.sliding_windows'
+    n_clusters: number of motifs to find
+    max_training_windows: maximum number of windows to train on
+    batch_size: number of windows in each k-means mini-batch
+    seed: seed for the sampling & the k-means initialization
+    metric: "euclidean" to train mini-batch k-means, or "dtw" to train DTW k-means,
+            which matches windows with the same shape even if it's shifted by a few readings
+    band: number of readings DTW can shift a window by
+
+    Returns: the trained MiniBatchKMeans or DTWKMeans model
+    """
+    rng = np.random.RandomState(seed)
+    sample = sample_complete_windows(window_sets, max_training_windows, rng)
+    if len(sample) < n_clusters:
+        raise ValueError(
+            "Cannot find "
+            + str(n_clusters)
+            + " motifs with "
+            + str(len(sample))
+            + " windows without missing data"
+        )
+
+    print("Training on", len(sample), "windows")
+    if metric == "dtw":
+        return DTWKMeans(n_clusters=n_clusters, band=band, random_state=seed).fit(
+            sample
+        )
+    elif metric != "euclidean":
+        raise ValueError("Invalid metric; must be 'euclidean' or 'dtw'")
+    return MiniBatchKMeans(
+        n_clusters=n_clusters, batch_size=batch_size, n_init=3, random_state=seed
+    ).fit(sample)
+
+
+def assign_motifs(model, windows, missing, chunk_size=100000):
+    """
+    Find the closest motif to every window, one chunk of windows at a time
+
+    model: model trained with 'fit_motif_clusters'
+    windows: 2d array with one window per row
+    missing: 2d boolean array of whether each BG in the windows is missing
+    chunk_size: number of windows to assign at once
+
+    Returns: array of the motif of each window, which is 'missing_label' for windows with missing BGs
+    """
+    labels = np.full(len(windows), missing_label, dtype=np.int16)
+    for start in range(0, len(windows), chunk_size):
+        chunk = windows[start : start + chunk_size]
+        is_complete = ~missing[start : start + chunk_size].any(axis=1)
+        if is_complete.any():
+            labels[start : start + chunk_size][is_complete] = model.predict(
+                chunk[is_complete]
+            )
+    return labels
+
+
+def save_motifs(output_path, model, labels, patients, interval_length, bg_interval=5):
+    """
+    Save the motif centers & every window's motif to a compressed npz file
+
+    output_path: path to save the file to
+    model: model trained with 'fit_motif_clusters'
+    labels: list of arrays with the motif of each window, one array per patient
+    patients: list of dicts with the "identifier" & "start" time of each patient's first window
+    interval_length: length of each window in minutes
+    bg_interval: minutes between each BG value
+    """
+    Path(output_path).parent.mkdir(parents=True, exist_ok=True)
+    np.savez_compressed(
+        output_path,
+        centers=model.cluster_centers_.astype(np.float32),
+        labels=np.concatenate(labels + [np.array([], dtype=np.int16)]),
+        label_starts=np.cumsum(
+            [0] + [len(patient_labels) for patient_labels in labels]
+        ),
+        metadata=json.dumps(
+            {
+                "interval_length": interval_length,
+                "bg_interval": bg_interval,
+                "patients": patients,
+            }
+        ),
+    )
+
+
+def load_motifs(motif_path, identifier=None):
+    """
+    Load motifs saved with 'save_motifs'
+
+    identifier: patient to get the motifs of the windows of, or None for every patient
+
+    Returns: tuple of (array of the motif centers in mg/dL,
+                       df with the start "time" & "identifier" of each window & its "motif")
+    """
+    saved = np.load(motif_path)
+    metadata = json.loads(str(saved["metadata"]))
+    label_starts = saved["label_starts"]
+
+    dfs = []
+    for i, patient in enumerate(metadata["patients"]):
+        if identifier is not None and patient["identifier"] != identifier:
+            continue
+        labels = saved["labels"][label_starts[i] : label_starts[i + 1]]
+        dfs.append(
+            pd.DataFrame(
+                {
+                    "identifier": patient["identifier"],
+                    "time": pd.Timestamp(patient["start"])
+                    + pd.to_timedelta(
+                        np.arange(len(labels)) * metadata["bg_interval"], unit="min"
+                    ),
+                    "motif": labels,
+                }
+            )
+        )
+
+    return (
+        saved["centers"],
+        (
+            pd.concat(dfs, ignore_index=True)
+            if dfs
+            else pd.DataFrame(columns=["identifier", "time", "motif"])
+        ),
+    )
+
+
+def cluster_motifs(
+    file_paths,
+    output_path=default_motif_path,
+    interval_length=60,
+    n_clusters=20,
+    max_training_windows=100000,
+    chunk_size=100000,
+    bg_interval=5,
+    seed=0,
+    metric="euclidean",
+    band=2,
+):
+    """
+    Find the BG motifs across a cohort & save them with 'save_motifs'
+
+    file_paths: list of paths to the raw data files of the patients
+    interval_length: length of each window in minutes
+    metric: distance between windows, either "euclidean" or "dtw"
+    band: number of readings DTW can shift a window by
+
+    Returns: the trained clustering model: MiniBatchKMeans, or DTWKMeans if "metric" is "dtw"
+    """
+    patients = []
+    window_sets = []
+    for file_path in file_paths:
+        start, bg_values = load_bgs(file_path)
+        window_sets.append(
+            sliding_windows(bg_values, round(interval_length / bg_interval))
+        )
+        patients.append(
+            {"identifier": file_path.split("/")[-1], "start": start.isoformat()}
+        )
+
+    model = fit_motif_clusters(
+        window_sets,
+        n_clusters,
+        max_training_windows,
+        seed=seed,
+        metric=metric,
+        band=band,
+    )
+    labels = [
+        assign_motifs(model, windows, missing, chunk_size)
+        for windows, missing in window_sets
+    ]
+    save_motifs(output_path, model, labels, patients, interval_length, bg_interval)
+
+    return model
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Cluster windows of BG data into motifs across a cohort"
+    )
+    add_file_arguments(parser)
+    parser.add_argument(
+        "--interval-length", type=int, default=60, help="window length in minutes"
+    )
+    parser.add_argument("--clusters", type=int, default=20)
+    parser.add_argument("--max-training-windows", type=int, default=100000)
+    parser.add_argument("--chunk-size", type=int, default=100000)
+    parser.add_argument("--metric", default="euclidean", choices=["euclidean", "dtw"])
+    parser.add_argument(
+        "--band",
+        type=int,
+        default=2,
+        help="number of readings DTW can shift a window by",
+    )
+    parser.add_argument("--output", default=default_motif_path)
+    args = parser.parse_args()
+
+    file_paths = get_file_paths(args)
+
+    cluster_motifs(
+        file_paths,
+        args.output,
+        args.interval_length,
+        args.clusters,
+        args.max_training_windows,
+        args.chunk_size,
+        metric=args.metric,
+        band=args.band,
+    )
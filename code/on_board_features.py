@@ -0,0 +1,222 @@
+import numpy as np
+import pandas as pd
+
+from scipy.signal import oaconvolve
+
+"""
+Insulin on board (IOB) & carbs on board (COB), computed over a patient's whole history at once
+& looked up at each dose time.
+
+All of the insulin (boluses, the extended parts of boluses & basals) and carbs are put onto
+a 5-minute grid, and the amount on board at every grid point is the convolution of the
+deliveries with a curve of the fraction of a delivery that's still on board after each
+number of minutes. The convolution is computed with FFTs, so it takes time proportional
+to n log n in the length of the history instead of summing over every earlier dose.
+
+The amount on board at a grid point only counts the deliveries in the grid intervals before
+it, so the IOB & COB at a dose time don't include the dose itself, like the pump-reported
+"insulinOnBoard".
+"""
+
+# Columns of the on-board features, in the order 'get_on_board_features_df' returns them
+on_board_feature_columns = [
+    "iob",  # units of insulin
+    "cob",  # grams of carbs
+]
+
+milliseconds_per_minute = 60 * 1000
+
+
+def get_insulin_curve(action_duration=360, peak_time=75, interval=5):
+    """
+    Get the fraction of an insulin dose that's still on board after each grid interval,
+    using the exponential insulin model from Loop
+    (https://github.com/LoopKit/Loop/issues/388#issuecomment-317938473)
+
+    action_duration: minutes until all of the insulin has been absorbed
+    peak_time: minutes until the insulin activity peaks
+    interval: minutes between each grid point
+
+    Returns: array of the fraction on board at 0, 'interval', 2 * 'interval', ... minutes,
+             up to 'action_duration'
+    """
+    t = np.arange(0, action_duration + interval, interval, dtype=float)
+    tau = (
+        peak_time
+        * (1 - peak_time / action_duration)
+        / (1 - 2 * peak_time / action_duration)
+    )
+    a = 2 * tau / action_duration
+    s = 1 / (1 - a + (1 + a) * np.exp(-action_duration / tau))
+    curve = 1 - s * (1 - a) * (
+        (t**2 / (tau * action_duration * (1 - a)) - t / tau - 1) * np.exp(-t / tau) + 1
+    )
+    return np.clip(np.where(t < action_duration, curve, 0), 0, 1)
+
+
+def get_carb_curve(absorption_time=180, interval=5):
+    """
+    Get the fraction of a carb entry that's still on board after each grid interval,
+    assuming the carbs are absorbed at a constant rate
+
+    absorption_time: minutes until all of the carbs have been absorbed
+    interval: minutes between each grid point
+
+    Returns: array of the fraction on board at 0, 'interval', 2 * 'interval', ... minutes,
+             up to 'absorption_time'
+    """
+    t = np.arange(0, absorption_time + interval, interval, dtype=float)
+    return np.clip(1 - t / absorption_time, 0, 1)
+
+
+def _get_delivered_by(boundaries, starts, ends, rates):
+    """
+    Get the total amount delivered by each boundary time by deliveries at constant rates
+
+    boundaries: sorted array of times
+    starts, ends: arrays of the times that each delivery starts & ends
+    rates: array of the amount each delivery delivers per unit of time
+
+    Returns: array of the cumulative amount delivered at each boundary
+    """
+    keep = ends > starts
+    if not keep.any():
+        return np.zeros(len(boundaries))
+    # The total rate only changes where a delivery starts or ends, so the cumulative
+    # amount is linear between those times
+    times = np.concatenate([starts[keep], ends[keep]])
+    changes = np.concatenate([rates[keep], -rates[keep]])
+    order = np.argsort(times, kind="stable")
+    times = times[order]
+    rate_after = np.cumsum(changes[order])
+    delivered = np.concatenate([[0], np.cumsum(rate_after[:-1] * np.diff(times))])
+    return np.interp(boundaries, times, delivered, left=0, right=delivered[-1])
+
+
+def get_deliveries(doses, start, length, interval=5):
+    """
+    Put the insulin & carbs of a df of doses onto a grid
+
+    Basals deliver their rate until the end of their duration or the start of the next
+    basal, whichever comes first; basals without a duration deliver until the next basal
+    (or the last dose, for the last basal). The "extended" part of a bolus is delivered
+    evenly over the bolus' duration.
+
+    doses: df from 'preprocess_data.make_dose_df', with "time", "type" (0 for basals &
+           1 for boluses), "normal", "extended", "rate", "carbInput" & "duration" (in ms) columns
+    start: time of the first grid point
+    length: number of grid points
+    interval: minutes between each grid point
+
+    Returns: tuple of (array of the units of insulin delivered in each grid interval,
+                       array of the grams of carbs eaten in each grid interval)
+    """
+    doses = doses.sort_values("time", kind="stable")
+    minutes = (
+        (pd.to_datetime(doses["time"]) - start) / pd.Timedelta(minutes=1)
+    ).to_numpy(dtype=float)
+    duration = (
+        pd.to_numeric(doses["duration"], errors="coerce").to_numpy(dtype=float)
+        / milliseconds_per_minute
+    )
+    is_basal = (doses["type"] == 0).to_numpy()
+    is_bolus = (doses["type"] == 1).to_numpy()
+
+    def get_amounts(column):
+        if column not in doses:
+            return np.zeros(len(doses))
+        values = pd.to_numeric(doses[column], errors="coerce").to_numpy(dtype=float)
+        return np.nan_to_num(values)
+
+    normal, extended, rate, carbs = [
+        get_amounts(column) for column in ["normal", "extended", "rate", "carbInput"]
+    ]
+
+    # Boluses & carbs are counted in the grid interval they happen in
+    slots = np.floor(minutes / interval)
+    in_grid = (slots >= 0) & (slots < length)
+    slot_indices = slots[in_grid].astype(int)
+    is_normal = is_bolus & ~((extended > 0) & (duration > 0))
+    insulin = np.bincount(
+        slot_indices,
+        weights=np.where(is_bolus, normal, 0)[in_grid]
+        + np.where(is_normal, extended, 0)[in_grid],
+        minlength=length,
+    )
+    carbs_eaten = np.bincount(
+        slot_indices, weights=np.where(is_bolus, carbs, 0)[in_grid], minlength=length
+    )
+
+    # Basals & extended boluses are spread over the grid intervals they overlap
+    basal_starts = minutes[is_basal]
+    next_starts = np.append(basal_starts[1:], np.inf)
+    basal_ends = np.fmin(basal_starts + duration[is_basal], next_starts)
+    if len(basal_ends) > 0 and np.isinf(basal_ends[-1]):
+        basal_ends[-1] = max(minutes.max(), basal_starts[-1])
+    is_extended = is_bolus & ~is_normal
+    starts = np.concatenate([basal_starts, minutes[is_extended]])
+    ends = np.concatenate([basal_ends, minutes[is_extended] + duration[is_extended]])
+    rates = np.concatenate(
+        [
+            rate[is_basal] / 60,
+            extended[is_extended] / np.maximum(duration[is_extended], 1e-9),
+        ]
+    )
+    boundaries = np.arange(length + 1) * interval
+    insulin += np.diff(_get_delivered_by(boundaries, starts, ends, rates))
+
+    return insulin, carbs_eaten
+
+
+def get_on_board(deliveries, curve):
+    """
+    Get the amount on board at every grid point
+
+    deliveries: array of the amount delivered in each grid interval
+    curve: array of the fraction of a delivery that's still on board after 0, 1, 2, ...
+           grid intervals, like from 'get_insulin_curve' or 'get_carb_curve'
+
+    Returns: array of the amount on board at each grid point, from the deliveries before it
+    """
+    deliveries = np.asarray(deliveries, dtype=float)
+    if len(deliveries) == 0:
+        return deliveries
+    # A delivery is first counted at the grid point after its interval
+    kernel = np.concatenate([[0], np.asarray(curve, dtype=float)[1:]])
+    on_board = oaconvolve(deliveries, kernel)[: len(deliveries)]
+    # Round-off from the FFTs leaves tiny amounts where nothing is on board
+    return np.where(on_board > 1e-9, on_board, 0)
+
+
+def get_on_board_features_df(doses, interval=5, insulin_curve=None, carb_curve=None):
+    """
+    Compute the IOB & COB at every point of a grid that covers a patient's doses
+
+    doses: df from 'preprocess_data.make_dose_df'
+    interval: minutes between each grid point
+    insulin_curve: fraction of insulin on board after each grid interval; defaults to 'get_insulin_curve()'
+    carb_curve: fraction of carbs on board after each grid interval; defaults to 'get_carb_curve()'
+
+    Returns: df with the "time" of each grid point & the columns in 'on_board_feature_columns'
+    """
+    insulin_curve = (
+        get_insulin_curve(interval=interval) if insulin_curve is None else insulin_curve
+    )
+    carb_curve = get_carb_curve(interval=interval) if carb_curve is None else carb_curve
+
+    times = pd.to_datetime(doses["time"])
+    if len(times) == 0:
+        return pd.DataFrame(columns=["time"] + on_board_feature_columns)
+    frequency = str(interval) + "min"
+    start = times.min().floor(frequency)
+    last_minute = (times.max() - start) / pd.Timedelta(minutes=1)
+    length = int(last_minute // interval) + 1
+
+    insulin, carbs = get_deliveries(doses, start, length, interval)
+    return pd.DataFrame(
+        {
+            "time": pd.date_range(start, periods=length, freq=frequency),
+            "iob": get_on_board(insulin, insulin_curve),
+            "cob": get_on_board(carbs, carb_curve),
+        }
+    )
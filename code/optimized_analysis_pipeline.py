@@ -7,8 +7,18 @@ from pathlib import Path
 from os.path import exists
 
 from utils import read_bgs_from_df
-from bg_sax_analysis import get_sax_encodings
-from preprocess_data import preprocess_dose_data, find_bgs_before_and_after
+from bg_grid_store import get_bg_grid_path, write_bg_grid
+from model_store import get_model_path
+from bg_sax_analysis import get_sax_encodings, get_sax_pyramid
+from bg_features import get_bg_features_df, join_bg_features
+from on_board_features import get_on_board_features_df, on_board_feature_columns
+from glycemic_metrics import get_period_glycemic_metrics
+from preprocess_data import (
+    preprocess_dose_data,
+    find_bgs_before_and_after,
+    find_bgs_for_horizons,
+    make_dose_df,
+)
 from bolus_risk_analysis import find_abnormal_boluses
 from basal_risk_analysis import find_abnormal_temp_basals
 
@@ -20,7 +30,7 @@ d6tflow.set_dir("../results")  # Save output to a results folder
 Task Flow:
 1) Get initial df
 2) Get BG df                
-3) Get SAX encodings   
+3) Get SAX encodings        Get BG features             Get IOB & COB
 4) Pre-process the data     Pre-process the BGs used for visualizations   
 5) Merge preprocessing data together
 6) Run bolus analysis       Run basal analysis
@@ -28,7 +38,7 @@ Task Flow:
 
 
 class TaskGetInitialData(d6tflow.tasks.TaskCSVPandas):
-    """ 
+    """
     Load the data at "path" into a Pandas dataframe,
     extracting the first "days_to_process" days of data
     """
@@ -57,12 +67,14 @@ class TaskGetInitialData(d6tflow.tasks.TaskCSVPandas):
 
 
 class TaskGetBGData(d6tflow.tasks.TaskCSVPandas):
-    """ 
+    """
     Load the blood glucose data into a Pandas dataframe 
     This script also:
         - normalizes the BG data to a particular time interval (defaults to 5 minutes)
         - fills missing values with -1
         - takes the base 10 log of the BG values for use in further analysis
+        - saves the BGs as a memory-mapped grid file next to the output csv
+          (see 'bg_grid_store.py')
     """
 
     identifier = luigi.Parameter(default="")
@@ -75,6 +87,7 @@ class TaskGetBGData(d6tflow.tasks.TaskCSVPandas):
         df = self.input().load()
         bgs = read_bgs_from_df(df)
         self.save(bgs)
+        write_bg_grid(get_bg_grid_path(self.output().path), bgs)
 
 
 class TaskGetSAX(d6tflow.tasks.TaskCSVPandas):
@@ -93,8 +106,84 @@ class TaskGetSAX(d6tflow.tasks.TaskCSVPandas):
         self.save(sax_encodings)
 
 
+class TaskGetSAXPyramid(d6tflow.tasks.TaskPickle):
+    """
+    Compute the SAX encodings of the BG data at several interval lengths & alphabet sizes in one pass.
+    The encodings are saved as a dict of compact uint8 arrays; use 'get_sax_from_pyramid'
+    in 'bg_sax_analysis.py' to get one of the encodings in the same format as TaskGetSAX
+    """
+
+    identifier = luigi.Parameter(default="")
+    path = luigi.Parameter()
+    interval_lengths = luigi.ListParameter(default=[10, 15, 30])
+    alphabet_sizes = luigi.ListParameter(default=[5, 7, 10])
+
+    def requires(self):
+        return TaskGetBGData(path=self.path, identifier=self.identifier)
+
+    def run(self):
+        bgs = self.input().load()
+        bgs["time"] = pd.to_datetime(bgs["time"], infer_datetime_format=True)
+        pyramid = get_sax_pyramid(bgs, self.interval_lengths, self.alphabet_sizes)
+        self.save(pyramid)
+
+
+class TaskGetBGFeatures(d6tflow.tasks.TaskCSVPandas):
+    """
+    Compute the smoothed BG, its rate of change & acceleration, and the BG variability
+    at every point of the BG grid (see 'bg_features.py')
+    """
+
+    identifier = luigi.Parameter(default="")
+    path = luigi.Parameter()
+
+    def requires(self):
+        return TaskGetBGData(path=self.path, identifier=self.identifier)
+
+    def run(self):
+        bgs = self.input().load()
+        bgs["time"] = pd.to_datetime(bgs["time"], infer_datetime_format=True)
+        self.save(get_bg_features_df(bgs))
+
+
+class TaskGetGlycemicMetrics(d6tflow.tasks.TaskCSVPandas):
+    """
+    Compute the glycemic metrics (time in ranges, GMI, CV, LBGI/HBGI & hypoglycemic events)
+    of the BGs per calendar period (see 'glycemic_metrics.py')
+    """
+
+    identifier = luigi.Parameter(default="")
+    path = luigi.Parameter()
+    frequency = luigi.Parameter(default="D")
+
+    def requires(self):
+        return TaskGetBGData(path=self.path, identifier=self.identifier)
+
+    def run(self):
+        bgs = self.input().load()
+        bgs["time"] = pd.to_datetime(bgs["time"], infer_datetime_format=True)
+        self.save(get_period_glycemic_metrics(bgs, self.frequency))
+
+
+class TaskGetOnBoardFeatures(d6tflow.tasks.TaskCSVPandas):
+    """
+    Compute the insulin on board & carbs on board at every point of a 5-minute grid
+    that covers the doses (see 'on_board_features.py')
+    """
+
+    identifier = luigi.Parameter(default="")
+    path = luigi.Parameter()
+
+    def requires(self):
+        return TaskGetInitialData(path=self.path, identifier=self.identifier)
+
+    def run(self):
+        initial_df = self.input().load()
+        self.save(get_on_board_features_df(make_dose_df(initial_df)))
+
+
 class TaskPreprocessData(d6tflow.tasks.TaskCSVPandas):
-    """ 
+    """
     Preprocess dose data for use in machine learning 
 
     This script:
@@ -132,7 +221,7 @@ class TaskPreprocessData(d6tflow.tasks.TaskCSVPandas):
 
 
 class TaskPreprocessBGs(d6tflow.tasks.TaskCSVPandas):
-    """ 
+    """
     Find specific BG values for each dose in a dataset. 
     This task:
         - Finds the BGs from 3 hours before and after the doses
@@ -158,9 +247,36 @@ class TaskPreprocessBGs(d6tflow.tasks.TaskCSVPandas):
         self.save(annotated_doses)
 
 
+class TaskGetBGsForHorizons(d6tflow.tasks.TaskCSVPandas):
+    """
+    Find the BGs, minutes of missing BG data, SAX strings & BG summaries before & after
+    each dose for several BG consideration intervals, saved side by side in columns
+    ending in the number of minutes (like "bgs_after_120").
+    The windows are looked up once at the longest interval, and sliced for the others.
+    """
+
+    identifier = luigi.Parameter(default="")
+    path = luigi.Parameter()
+    horizons = luigi.ListParameter(default=[60, 120, 180, 240])
+
+    def requires(self):
+        return {
+            "raw_df": TaskGetInitialData(path=self.path, identifier=self.identifier),
+            "bg_df": TaskGetBGData(path=self.path, identifier=self.identifier),
+            "sax_df": TaskGetSAX(path=self.path, identifier=self.identifier),
+        }
+
+    def run(self):
+        initial_df, bgs, sax_df = self.inputLoad()
+        bgs["time"] = pd.to_datetime(bgs["time"], infer_datetime_format=True)
+        sax_df["time"] = pd.to_datetime(sax_df["time"], infer_datetime_format=True)
+        self.save(find_bgs_for_horizons(initial_df, bgs, sax_df, self.horizons))
+
+
 class TaskMergePreprocessingTogether(d6tflow.tasks.TaskCSVPandas):
-    """ 
-    Merge the relevent columns from the 2 preprocessing tasks together. 
+    """
+    Merge the relevent columns from the 2 preprocessing tasks together,
+    and add the BG features, IOB & COB at the time of each dose.
     These tasks were split to allow for multithreading of tasks, if enabled.
     """
 
@@ -175,10 +291,16 @@ class TaskMergePreprocessingTogether(d6tflow.tasks.TaskCSVPandas):
             "processed_part_2": TaskPreprocessBGs(
                 path=self.path, identifier=self.identifier
             ),
+            "bg_features": TaskGetBGFeatures(
+                path=self.path, identifier=self.identifier
+            ),
+            "on_board_features": TaskGetOnBoardFeatures(
+                path=self.path, identifier=self.identifier
+            ),
         }
 
     def run(self):
-        doses, bgs = self.inputLoad()
+        doses, bgs, bg_features, on_board_features = self.inputLoad()
         # Merge in the relevent BG data
         doses["bgs_before"] = bgs["bgs_before"]
         doses["bgs_after"] = bgs["bgs_after"]
@@ -186,20 +308,44 @@ class TaskMergePreprocessingTogether(d6tflow.tasks.TaskCSVPandas):
         doses["duration_gaps_after"] = bgs["duration_gaps_after"]
         doses["bg_30_min_before"] = bgs["bg_30_min_before"]
         doses["bg_75_min_after"] = bgs["bg_75_min_after"]
+        # Add the BG trends, IOB & COB at the time of each dose
+        doses = join_bg_features(doses, bg_features)
+        doses = join_bg_features(
+            doses, on_board_features, columns=on_board_feature_columns
+        )
 
         self.save(doses)
 
 
+def store_task_results(df, dataset, identifier):
+    """
+    Add a task's output to the results store (see 'results_store.py'); the store is an
+    extra copy of the outputs, so it's skipped if pyarrow isn't installed
+    """
+    try:
+        from results_store import store_results
+    except ImportError as e:
+        print("Skipping the results store, since pyarrow can't be imported:", e)
+        return
+    store_results(df, dataset, identifier)
+
+
 class TaskGetAbnormalBoluses(d6tflow.tasks.TaskCSVPandas):
     """
     Identify abnormal boluses using a k-nearest neighbors clustering algorithm.
     This script trains the model using the "totalBolusAmount", "carbInput", 
     "insulinCarbRatio", "bgInput", "insulinSensitivity", and "TDD" columns
+
+    The trained model is saved to "results/models"; if "score_only" is set,
+    the saved model for the identifier is used to score the boluses without retraining.
+    The abnormal boluses are also added to the "abnormal_boluses_<model_type>" dataset
+    of the results store (see 'results_store.py')
     """
 
     identifier = luigi.Parameter(default="")
     path = luigi.Parameter()
     model_type = luigi.Parameter(default="knn")
+    score_only = luigi.BoolParameter(default=False)
 
     def requires(self):
         return {
@@ -212,19 +358,35 @@ class TaskGetAbnormalBoluses(d6tflow.tasks.TaskCSVPandas):
     def run(self):
         doses, bgs = self.inputLoad()
         doses["time"] = pd.to_datetime(doses["time"], infer_datetime_format=True)
-        abnormal_boluses = find_abnormal_boluses(doses, bgs, self.model_type)
+        model_path = get_model_path(
+            self.identifier or Path(self.path).stem, "bolus", self.model_type
+        )
+        abnormal_boluses = find_abnormal_boluses(
+            doses, bgs, self.model_type, model_path, self.score_only
+        )
         self.save(abnormal_boluses)
+        store_task_results(
+            abnormal_boluses,
+            "abnormal_boluses_" + self.model_type,
+            self.identifier or Path(self.path).stem,
+        )
 
 
 class TaskGetAbnormalBasals(d6tflow.tasks.TaskCSVPandas):
     """
     Identify abnormal temporary basals using a k-nearest neighbors clustering algorithm.
     This script trains the model using the "duration", "percent", and "rate" columns
+
+    The trained model is saved to "results/models"; if "score_only" is set,
+    the saved model for the identifier is used to score the temp basals without retraining.
+    The abnormal temp basals are also added to the "abnormal_basals_<model_type>" dataset
+    of the results store (see 'results_store.py')
     """
 
     identifier = luigi.Parameter(default="")
     path = luigi.Parameter()
     model_type = luigi.Parameter(default="knn")
+    score_only = luigi.BoolParameter(default=False)
 
     def requires(self):
         return {
@@ -237,8 +399,18 @@ class TaskGetAbnormalBasals(d6tflow.tasks.TaskCSVPandas):
     def run(self):
         doses, bgs = self.inputLoad()
         doses["time"] = pd.to_datetime(doses["time"], infer_datetime_format=True)
-        abnormal_temp_basals = find_abnormal_temp_basals(doses, bgs, self.model_type)
+        model_path = get_model_path(
+            self.identifier or Path(self.path).stem, "basal", self.model_type
+        )
+        abnormal_temp_basals = find_abnormal_temp_basals(
+            doses, bgs, self.model_type, model_path, self.score_only
+        )
         self.save(abnormal_temp_basals)
+        store_task_results(
+            abnormal_temp_basals,
+            "abnormal_basals_" + self.model_type,
+            self.identifier or Path(self.path).stem,
+        )
 
 
 """ 
@@ -273,7 +445,15 @@ if __name__ == "__main__":
     )
     """ Uncomment line below to find the abnormal boluses using an Isolation Forest model """
     # d6tflow.run(TaskGetAbnormalBoluses(path=file_path, model_type="isolation_forest", identifier=identifier), workers=2)
+    """ Uncomment line below to score the boluses with the model saved from a previous run, without retraining it """
+    # d6tflow.run(TaskGetAbnormalBoluses(path=file_path, model_type="knn", identifier=identifier, score_only=True), workers=2)
     """ Uncomment line below to find the abnormal basals """
     # d6tflow.run(TaskGetAbnormalBasals(path=file_path, identifier=identifier), workers=2)
     """ Uncomment line below to process the dose data """
     # d6tflow.run(TaskPreprocessData(path=file_path, identifier=identifier), workers=2)
+    """ Uncomment line below to compute the SAX encodings at several interval lengths & alphabet sizes """
+    # d6tflow.run(TaskGetSAXPyramid(path=file_path, identifier=identifier), workers=2)
+    """ Uncomment line below to find the BGs & SAX strings around the doses for several BG consideration intervals """
+    # d6tflow.run(TaskGetBGsForHorizons(path=file_path, identifier=identifier, horizons=[60, 120, 180, 240]), workers=2)
+    """ Uncomment line below to compute the daily glycemic metrics (use frequency="W-MON" for weekly metrics) """
+    # d6tflow.run(TaskGetGlycemicMetrics(path=file_path, identifier=identifier, frequency="D"), workers=2)
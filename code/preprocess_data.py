@@ -67,7 +67,9 @@ def find_bgs_before_and_after(initial_df, bgs, bg_consideration_interval=180):
     doses["bgs_before"] = doses["time"].apply(
         find_values, args=(bgs, -bg_consideration_interval, 5, "value")
     )
-    doses["duration_gaps_before"] = doses["bgs_before"].apply(find_duration_of_gap)
+    doses["duration_gaps_before"] = doses["bgs_before"].apply(
+        find_duration_of_gap, list_duration=bg_consideration_interval
+    )
     doses["bg_30_min_before"] = doses["time"].apply(
         return_first_matching_bg, args=(doses, bgs, -31, -24)
     )
@@ -77,7 +79,9 @@ def find_bgs_before_and_after(initial_df, bgs, bg_consideration_interval=180):
     doses["bgs_after"] = doses["time"].apply(
         find_values, args=(bgs, -5, bg_consideration_interval, "value")
     )
-    doses["duration_gaps_after"] = doses["bgs_after"].apply(find_duration_of_gap)
+    doses["duration_gaps_after"] = doses["bgs_after"].apply(
+        find_duration_of_gap, list_duration=bg_consideration_interval
+    )
     # 75 mins because of insulin peak
     doses["bg_75_min_after"] = doses["time"].apply(
         return_first_matching_bg, args=(doses, bgs, 74, 79)
@@ -87,6 +91,173 @@ def find_bgs_before_and_after(initial_df, bgs, bg_consideration_interval=180):
     return doses
 
 
+def get_grid_ranges(
+    grid_start, interval, length, lower, upper, include_lower, include_upper
+):
+    """
+    Get the range of grid points between two times, for many pairs of times at once,
+    by arithmetic on the grid instead of searching a df
+
+    grid_start: time of the first grid point
+    interval: minutes between each grid point
+    length: number of grid points
+    lower: series of the earliest time of each range
+    upper: series of the latest time of each range
+    include_lower, include_upper: whether grid points at exactly 'lower' & 'upper' are in the range
+
+    Returns: tuple of (array of the first index of each range, array of the index after the last one)
+    """
+    lower_offset = ((lower - grid_start) / pd.Timedelta(minutes=interval)).to_numpy()
+    upper_offset = ((upper - grid_start) / pd.Timedelta(minutes=interval)).to_numpy()
+    starts = np.ceil(lower_offset) if include_lower else np.floor(lower_offset) + 1
+    ends = np.floor(upper_offset) + 1 if include_upper else np.ceil(upper_offset)
+    starts = np.clip(starts, 0, length).astype(int)
+    ends = np.maximum(np.clip(ends, 0, length).astype(int), starts)
+    return starts, ends
+
+
+def find_bgs_for_horizons(
+    initial_df,
+    bgs,
+    sax_df,
+    horizons=(60, 120, 180, 240),
+    bg_interval=5,
+    sax_interval=10,
+):
+    """
+    Find the BGs, minutes of CGM data loss, SAX strings & BG summaries before & after every
+    dose for several values of 'bg_consideration_interval' at once. The windows are only
+    looked up at the longest horizon; every shorter horizon is a slice of those windows.
+    The values for each horizon match 'find_bgs_before_and_after' & 'preprocess_dose_data'.
+
+    initial_df: df of the raw data
+    bgs: df from 'read_bgs_from_df', at a consistent interval of 'bg_interval' minutes
+    sax_df: df from 'get_sax_encodings', at a consistent interval of 'sax_interval' minutes
+    horizons: minutes of BGs before & after the doses to consider
+
+    Returns: df of doses with "bgs_before_<horizon>", "bgs_after_<horizon>",
+             "duration_gaps_before_<horizon>", "duration_gaps_after_<horizon>",
+             "before_event_strings_<horizon>", "after_event_strings_<horizon>",
+             and the "mean_bg", "min_bg" & "max_bg" of the BGs before & after
+             (like "min_bg_after_<horizon>") columns for each horizon
+    """
+    doses = make_dose_df(initial_df)
+    times = doses["time"]
+    longest = max(horizons)
+
+    bg_values = bgs["value"].to_numpy(dtype=float)
+    bg_start = bgs["time"].iloc[0] if len(bgs) > 0 else times.min()
+    sax_letters = "".join(sax_df["bin"].astype(str))
+    sax_start = sax_df["time"].iloc[0] if len(sax_df) > 0 else times.min()
+    rounded_times = times.dt.round(str(sax_interval) + "min")
+
+    def get_bg_ranges(lower_offset, upper_offset):
+        return get_grid_ranges(
+            bg_start,
+            bg_interval,
+            len(bg_values),
+            times + pd.Timedelta(minutes=lower_offset),
+            times + pd.Timedelta(minutes=upper_offset),
+            False,
+            False,
+        )
+
+    def get_sax_ranges(horizon):
+        before = get_grid_ranges(
+            sax_start,
+            sax_interval,
+            len(sax_letters),
+            (times - pd.Timedelta(minutes=horizon)).dt.round(str(sax_interval) + "min"),
+            rounded_times,
+            True,
+            False,
+        )
+        after = get_grid_ranges(
+            sax_start,
+            sax_interval,
+            len(sax_letters),
+            rounded_times,
+            (times + pd.Timedelta(minutes=horizon)).dt.round(str(sax_interval) + "min"),
+            False,
+            True,
+        )
+        return before, after
+
+    # Look up the windows at the longest horizon once
+    longest_before_starts, before_ends = get_bg_ranges(-longest, 5)
+    after_starts, longest_after_ends = get_bg_ranges(-5, longest)
+    longest_bgs_before = [
+        bg_values[start:end].tolist()
+        for start, end in zip(longest_before_starts, before_ends)
+    ]
+    longest_bgs_after = [
+        bg_values[start:end].tolist()
+        for start, end in zip(after_starts, longest_after_ends)
+    ]
+    (longest_sax_before_starts, sax_before_ends), (
+        sax_after_starts,
+        longest_sax_after_ends,
+    ) = get_sax_ranges(longest)
+    longest_strings_before = [
+        sax_letters[start:end]
+        for start, end in zip(longest_sax_before_starts, sax_before_ends)
+    ]
+    longest_strings_after = [
+        sax_letters[start:end]
+        for start, end in zip(sax_after_starts, longest_sax_after_ends)
+    ]
+
+    for horizon in sorted(horizons):
+        # The windows before a dose end at the same point for every horizon,
+        # & the windows after a dose start at the same point
+        before_starts, _ = get_bg_ranges(-horizon, 5)
+        _, after_ends = get_bg_ranges(-5, horizon)
+        (sax_before_starts, _), (_, sax_after_ends) = get_sax_ranges(horizon)
+
+        bgs_before = [
+            values[offset:]
+            for values, offset in zip(
+                longest_bgs_before, before_starts - longest_before_starts
+            )
+        ]
+        bgs_after = [
+            values[:length]
+            for values, length in zip(longest_bgs_after, after_ends - after_starts)
+        ]
+        suffix = "_" + str(horizon)
+        doses["bgs_before" + suffix] = bgs_before
+        doses["bgs_after" + suffix] = bgs_after
+        doses["duration_gaps_before" + suffix] = [
+            find_duration_of_gap(values, list_duration=horizon) for values in bgs_before
+        ]
+        doses["duration_gaps_after" + suffix] = [
+            find_duration_of_gap(values, list_duration=horizon) for values in bgs_after
+        ]
+        doses["before_event_strings" + suffix] = [
+            string[offset:]
+            for string, offset in zip(
+                longest_strings_before, sax_before_starts - longest_sax_before_starts
+            )
+        ]
+        doses["after_event_strings" + suffix] = [
+            string[:length]
+            for string, length in zip(
+                longest_strings_after, sax_after_ends - sax_after_starts
+            )
+        ]
+
+        for side, windows in [("before", bgs_before), ("after", bgs_after)]:
+            present = [[bg for bg in values if bg != -1] for values in windows]
+            for name, summarize in [("mean", np.mean), ("min", min), ("max", max)]:
+                doses[name + "_bg_" + side + suffix] = [
+                    summarize(values) if len(values) > 0 else np.nan
+                    for values in present
+                ]
+
+    print("Got BGs for horizons", sorted(horizons))
+    return doses
+
+
 def make_dose_df(initial_df):
     # This column is commonly missing
     if not "extended" in initial_df:
@@ -0,0 +1,711 @@
+import sys
+import json
+import time
+import asyncio
+import argparse
+import numpy as np
+import pandas as pd
+
+from os.path import exists
+from collections import deque
+
+from utils import find_duration_of_gap
+from bg_sax_analysis import all_alphabet, get_breakpoints
+from bg_features import bg_feature_columns, get_bg_features, fill_missing_bg_features
+from on_board_features import (
+    get_insulin_curve,
+    get_carb_curve,
+    get_deliveries,
+    get_on_board,
+)
+from bolus_risk_analysis import bolus_features
+from basal_risk_analysis import temp_basal_features
+from model_store import get_model_path, load_model
+from streaming_anomaly_detection import streaming_model_types
+
+"""
+Long-running service that scores doses as live CGM & dose events arrive.
+
+Events are dicts in the Tidepool data model (https://developer.tidepool.org/data-model/),
+with an extra "identifier" key for the patient they belong to. They can come from a local
+socket or a tailed file (one json event per line), or be replayed from a data export.
+
+For every patient, the service keeps a rolling 5-minute BG grid & a buffer of SAX letters,
+and computes the same dose features as 'preprocess_dose_data' & 'find_bgs_before_and_after'
+as the data they need arrives. Each bolus & temp basal is scored with the patient's stored
+model once the 75-minute post-dose window closes (when the BG 75 minutes after the dose is
+known), and its post-dose BG summary is emitted once the 180-minute window closes.
+
+Unlike the batch pipeline, only data up to the time a dose is scored is available, so:
+    - the TDD is the insulin delivered so far on the day of the dose
+    - the SAX letters are normalized with the patient's BG statistics so far
+    - missing insulin to carb ratios, insulin sensitivities & BGs are filled with
+      the medians & means of the data the stored model was trained on
+"""
+
+minutes_per_nanosecond = 1 / 6e10
+
+
+def to_minutes(timestamp):
+    """Convert a time to the number of minutes since the epoch"""
+    return pd.Timestamp(timestamp).value * minutes_per_nanosecond
+
+
+def round_minutes(minutes, interval):
+    """Round a time in minutes to the nearest 'interval' minutes, like pandas' Timestamp.round"""
+    return np.round(minutes / interval) * interval
+
+
+class LatencyMetrics:
+    """Counters & recent latencies for monitoring the service"""
+
+    def __init__(self, max_samples=10000):
+        self.events_received = 0
+        self.events_processed = 0
+        self.scores_emitted = 0
+        self.max_queue_depth = 0
+        self.backpressure_seconds = 0.0
+        self.latencies = deque(maxlen=max_samples)
+
+    def record_received(self, queue_depth, seconds_blocked):
+        self.events_received += 1
+        self.max_queue_depth = max(self.max_queue_depth, queue_depth)
+        self.backpressure_seconds += seconds_blocked
+
+    def record_emitted(self, received_at):
+        self.scores_emitted += 1
+        self.latencies.append(time.monotonic() - received_at)
+
+    def summary(self):
+        """Get the counters & the latency percentiles (in ms) from event arrival to score emission"""
+        latencies = np.array(self.latencies) * 1000
+        percentiles = (
+            np.percentile(latencies, [50, 95, 99])
+            if len(latencies) > 0
+            else [np.nan] * 3
+        )
+        return {
+            "events_received": self.events_received,
+            "events_processed": self.events_processed,
+            "scores_emitted": self.scores_emitted,
+            "max_queue_depth": self.max_queue_depth,
+            "backpressure_seconds": round(self.backpressure_seconds, 3),
+            "latency_ms_p50": percentiles[0],
+            "latency_ms_p95": percentiles[1],
+            "latency_ms_p99": percentiles[2],
+        }
+
+
+class PatientStream:
+    """
+    Rolling state for one patient's events: the BG grid, the SAX letters,
+    the insulin delivered per day, the recent doses (for the IOB & COB),
+    and the doses waiting for their windows to close
+    """
+
+    def __init__(
+        self,
+        identifier,
+        bg_interval=5,
+        sax_interval=10,
+        alphabet_size=7,
+        bg_consideration_interval=180,
+    ):
+        self.identifier = identifier
+        self.bg_interval = bg_interval
+        self.sax_interval = sax_interval
+        self.bg_consideration_interval = bg_consideration_interval
+        self.inner_breakpoints = get_breakpoints(alphabet_size)[1:-1]
+        self.nan_letter = all_alphabet[alphabet_size]
+
+        # BG grid: slot number (minutes since the epoch / bg_interval) -> BG value
+        self.grid = {}
+        self.first_slot = None
+        self.last_slot = None
+        # SAX letters: bin number (minutes since the epoch / sax_interval) -> letter
+        self.sax_letters = {}
+        self.next_sax_bin = None
+        # Running mean & variance of the log BGs, for normalizing the SAX values
+        self.log_bg_count = 0
+        self.log_bg_mean = 0.0
+        self.log_bg_sum_squared_differences = 0.0
+        # Histogram of BG values in 0.1 mmol/L bins, for the 25th-percentile BG
+        self.bg_histogram = np.zeros(400)
+
+        self.latest_event_minutes = -np.inf
+        self.insulin_per_day = {}
+        self.pending_doses = []
+        # Recent bolus & basal fields, in the format of 'preprocess_data.make_dose_df'
+        self.recent_doses = []
+        self.insulin_curve = get_insulin_curve(interval=bg_interval)
+        self.carb_curve = get_carb_curve(interval=bg_interval)
+
+    def _slots_between(self, start, end):
+        """Grid slots with times strictly between 'start' & 'end' (in minutes) that are within the grid"""
+        if self.first_slot is None:
+            return range(0)
+        first = max(int(np.floor(start / self.bg_interval)) + 1, self.first_slot)
+        last = min(int(np.ceil(end / self.bg_interval)) - 1, self.last_slot)
+        return range(first, last + 1)
+
+    def find_values(self, minutes, first_offset, second_offset):
+        """Grid equivalent of 'utils.find_values'; missing BGs are -1"""
+        slots = self._slots_between(minutes + first_offset, minutes + second_offset)
+        return [self.grid.get(slot, -1) for slot in slots]
+
+    def first_matching_bg(self, minutes, first_offset, second_offset, fill_value):
+        """Grid equivalent of 'utils.return_first_matching_bg'"""
+        values = self.find_values(minutes, first_offset, second_offset)
+        return values[0] if len(values) > 0 else fill_value
+
+    def sax_string(self, minutes, time_length_of_string):
+        """SAX-buffer equivalent of 'utils.annotate_with_sax'"""
+        event = round_minutes(minutes, self.sax_interval)
+        other = round_minutes(minutes + time_length_of_string, self.sax_interval)
+        if time_length_of_string < 0:
+            bins = range(int(other / self.sax_interval), int(event / self.sax_interval))
+        else:
+            bins = range(
+                int(event / self.sax_interval) + 1, int(other / self.sax_interval) + 1
+            )
+        return "".join(self.sax_letters[b] for b in bins if b in self.sax_letters)
+
+    def bg_features_at(self, minutes, history_length=12):
+        """
+        Grid equivalent of 'bg_features.join_bg_features': the BG features at the grid point
+        at or before 'minutes', computed from the last 'history_length' grid points
+        """
+        slot = int(np.floor(minutes / self.bg_interval))
+        values = [
+            self.grid.get(s, np.nan) for s in range(slot - history_length + 1, slot + 1)
+        ]
+        features = get_bg_features(values, self.bg_interval)[-1]
+        return dict(zip(bg_feature_columns, features))
+
+    def on_board_features_at(self, minutes):
+        """
+        Grid equivalent of joining the output of 'on_board_features.get_on_board_features_df':
+        the IOB & COB at the grid point at or before 'minutes', from the recent doses
+        """
+        slot = int(np.floor(minutes / self.bg_interval))
+        length = max(len(self.insulin_curve), len(self.carb_curve))
+        doses = pd.DataFrame(
+            self.recent_doses,
+            columns=[
+                "time",
+                "type",
+                "normal",
+                "extended",
+                "rate",
+                "carbInput",
+                "duration",
+            ],
+        )
+        doses["time"] = pd.to_datetime(doses["time"], unit="m")
+        insulin, carbs = get_deliveries(
+            doses,
+            pd.Timestamp((slot - length + 1) * self.bg_interval, unit="m"),
+            length,
+            self.bg_interval,
+        )
+        return {
+            "iob": get_on_board(insulin, self.insulin_curve)[-1],
+            "cob": get_on_board(carbs, self.carb_curve)[-1],
+        }
+
+    def add_dose(self, minutes, event):
+        """Keep the fields of a bolus or basal event that the IOB & COB are computed from"""
+        self.recent_doses.append(
+            [minutes, 0 if event["type"] == "basal" else 1]
+            + [
+                get_number(event, key, np.nan)
+                for key in ["normal", "extended", "rate", "carbInput", "duration"]
+            ]
+        )
+
+    def lower_bg_bound(self):
+        """BG threshold used to select doses followed by low BGs, as in 'find_abnormal_boluses'"""
+        cumulative = np.cumsum(self.bg_histogram)
+        if cumulative[-1] == 0:
+            return 70 / 18
+        quantile = np.searchsorted(cumulative, 0.25 * cumulative[-1]) * 0.1
+        return max(70 / 18, quantile)
+
+    def add_cbg(self, minutes, value):
+        slot = int(np.floor(minutes / self.bg_interval))
+        if self.last_slot is not None and slot < self.last_slot:
+            # Readings arriving after newer readings are ignored, since their windows may have closed
+            return
+        if self.first_slot is None:
+            self.first_slot = slot
+            self.next_sax_bin = int(np.floor(minutes / self.sax_interval))
+        self.last_slot = slot
+        self.grid[slot] = value
+
+        if value > 0:
+            log_bg = np.log10(value)
+            self.log_bg_count += 1
+            difference = log_bg - self.log_bg_mean
+            self.log_bg_mean += difference / self.log_bg_count
+            self.log_bg_sum_squared_differences += difference * (
+                log_bg - self.log_bg_mean
+            )
+            self.bg_histogram[min(int(value * 10), len(self.bg_histogram) - 1)] += 1
+
+        self.finalize_sax_bins((self.last_slot + 1) * self.bg_interval)
+
+    def finalize_sax_bins(self, until_minutes):
+        """Assign SAX letters to every bin that ends by 'until_minutes'"""
+        if self.next_sax_bin is None:
+            return
+        std = np.sqrt(self.log_bg_sum_squared_differences / max(1, self.log_bg_count))
+        slots_per_bin = self.sax_interval // self.bg_interval
+
+        while (self.next_sax_bin + 1) * self.sax_interval <= until_minutes:
+            first_slot = self.next_sax_bin * slots_per_bin
+            values = [self.grid.get(first_slot + i, -1) for i in range(slots_per_bin)]
+            log_bgs = [np.log10(value) for value in values if value > 0]
+            if len(log_bgs) > 0 and std > 0:
+                normalized = (np.mean(log_bgs) - self.log_bg_mean) / std
+                letter_index = np.searchsorted(self.inner_breakpoints, normalized)
+                self.sax_letters[self.next_sax_bin] = all_alphabet[letter_index]
+            else:
+                self.sax_letters[self.next_sax_bin] = self.nan_letter
+            self.next_sax_bin += 1
+
+    def add_insulin(self, minutes, amount):
+        day = int(minutes // (24 * 60))
+        self.insulin_per_day[day] = self.insulin_per_day.get(day, 0) + amount
+
+    def prune(self):
+        """Drop the grid slots, SAX letters & daily totals that no pending or future dose needs"""
+        if self.last_slot is None:
+            return
+        keep_minutes = 2 * self.bg_consideration_interval + 2 * self.sax_interval
+        oldest_dose_needed = min(
+            [dose["minutes"] for dose in self.pending_doses]
+            + [self.last_slot * self.bg_interval]
+        )
+        oldest_needed = oldest_dose_needed - keep_minutes
+        for slot in [s for s in self.grid if s * self.bg_interval < oldest_needed]:
+            del self.grid[slot]
+        for b in [b for b in self.sax_letters if b * self.sax_interval < oldest_needed]:
+            del self.sax_letters[b]
+        for day in [
+            d for d in self.insulin_per_day if (d + 2) * 24 * 60 < oldest_needed
+        ]:
+            del self.insulin_per_day[day]
+
+        # Keep the doses that can still be on board, and the latest basal before them,
+        # which can still be delivering
+        on_board_minutes = (
+            max(len(self.insulin_curve), len(self.carb_curve)) + 1
+        ) * self.bg_interval
+        oldest_on_board = oldest_dose_needed - on_board_minutes
+        basals = [
+            i
+            for i, dose in enumerate(self.recent_doses)
+            if dose[1] == 0 and dose[0] < oldest_on_board
+        ]
+        self.recent_doses = [
+            dose
+            for i, dose in enumerate(self.recent_doses)
+            if (basals and i == basals[-1])
+            or dose[0] + np.nan_to_num(dose[-1]) / 60000 >= oldest_on_board
+        ]
+
+
+class RealtimeScoringService:
+    """
+    Consumes events from a bounded queue, keeping a PatientStream per patient,
+    and emits scores as the doses' post-dose windows close
+    """
+
+    def __init__(
+        self,
+        get_model,
+        emit=None,
+        max_queue_size=10000,
+        window_grace_minutes=30,
+        bg_consideration_interval=180,
+    ):
+        """
+        get_model: function that takes a patient's identifier & a dose type ("bolus" or "basal")
+                   and returns the stored model from 'model_store.load_model', or None
+        emit: function that is called with every emitted record (defaults to printing it as json)
+        max_queue_size: number of events that can wait to be processed before producers are blocked
+        window_grace_minutes: how long after a window should have closed to wait for its
+                              CGM data before closing it anyway, in event time
+        bg_consideration_interval: minutes of BGs to summarize after each dose
+        """
+        self.get_model = get_model
+        self.emit = emit if emit is not None else print_record
+        self.queue = asyncio.Queue(maxsize=max_queue_size)
+        self.window_grace_minutes = window_grace_minutes
+        self.bg_consideration_interval = bg_consideration_interval
+        self.patients = {}
+        self.metrics = LatencyMetrics()
+
+    async def put(self, event):
+        """Add an event to the queue, waiting while the queue is full"""
+        start = time.monotonic()
+        await self.queue.put((start, event))
+        self.metrics.record_received(self.queue.qsize(), time.monotonic() - start)
+
+    async def close(self):
+        """Signal that no more events will arrive, closing every remaining window"""
+        await self.queue.put(None)
+
+    async def run(self):
+        """Process events until the queue is closed"""
+        while True:
+            item = await self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                break
+            received_at, event = item
+            self.process_event(event, received_at)
+            self.metrics.events_processed += 1
+            self.queue.task_done()
+
+        for stream in self.patients.values():
+            self.close_windows(stream, np.inf, time.monotonic())
+
+    def get_stream(self, identifier):
+        if identifier not in self.patients:
+            self.patients[identifier] = PatientStream(
+                identifier, bg_consideration_interval=self.bg_consideration_interval
+            )
+        return self.patients[identifier]
+
+    def process_event(self, event, received_at):
+        stream = self.get_stream(event.get("identifier", ""))
+        minutes = to_minutes(event["time"])
+        stream.latest_event_minutes = max(stream.latest_event_minutes, minutes)
+
+        if event["type"] in ["bolus", "basal"]:
+            stream.add_dose(minutes, event)
+
+        if event["type"] == "cbg":
+            stream.add_cbg(minutes, float(event["value"]))
+        elif event["type"] == "bolus":
+            amount = get_number(event, "normal", 0) + get_number(event, "extended", 0)
+            stream.add_insulin(minutes, amount)
+            self.add_pending_dose(stream, event, minutes, "bolus", received_at)
+        elif event["type"] == "basal":
+            stream.add_insulin(minutes, get_number(event, "rate", 0))
+            if event.get("deliveryType") == "temp":
+                self.add_pending_dose(stream, event, minutes, "basal", received_at)
+
+        self.close_windows(stream, stream.latest_event_minutes, received_at)
+        stream.prune()
+
+    def add_pending_dose(self, stream, event, minutes, dose_type, received_at):
+        stored_model = self.get_model(stream.identifier, dose_type)
+        stats = stored_model["feature_stats"] if stored_model is not None else {}
+        dose = {
+            "event": event,
+            "minutes": minutes,
+            "dose_type": dose_type,
+            "model": stored_model,
+            "fill_values": {
+                col: stats.get(col, {}).get("median", np.nan)
+                for col in ["insulinCarbRatio", "insulinSensitivity", "bg_variability"]
+            },
+            "bg_fill_value": stats.get("bgInput", {}).get("mean", np.nan),
+            "received_at": received_at,
+            "scored": False,
+        }
+        stream.pending_doses.append(dose)
+
+    def close_windows(self, stream, event_minutes, received_at):
+        """Score & summarize the pending doses whose post-dose windows have closed"""
+        grid_minutes = (
+            (stream.last_slot + 1) * stream.bg_interval
+            if stream.last_slot is not None
+            else -np.inf
+        )
+
+        def has_closed(closes_at):
+            return (
+                grid_minutes >= closes_at
+                or event_minutes >= closes_at + self.window_grace_minutes
+            )
+
+        still_pending = []
+        for dose in stream.pending_doses:
+            minutes = dose["minutes"]
+            if not dose["scored"] and has_closed(minutes + 79):
+                self.score_dose(stream, dose, received_at)
+
+            summary_closes_at = max(
+                minutes + self.bg_consideration_interval,
+                round_minutes(
+                    minutes + self.bg_consideration_interval, stream.sax_interval
+                )
+                + stream.sax_interval,
+            )
+            if dose["scored"] and has_closed(summary_closes_at):
+                stream.finalize_sax_bins(summary_closes_at)
+                self.summarize_dose(stream, dose, received_at)
+            else:
+                still_pending.append(dose)
+        stream.pending_doses = still_pending
+
+    def score_dose(self, stream, dose, received_at):
+        event = dose["event"]
+        minutes = dose["minutes"]
+        bg_input = get_number(event, "bgInput", np.nan)
+        if np.isnan(bg_input):
+            bg_input = stream.first_matching_bg(minutes, -5, 5, dose["bg_fill_value"])
+        processed = {
+            "bgInput": bg_input,
+            "TDD": stream.insulin_per_day.get(int(minutes // (24 * 60)), 0),
+            "bg_30_min_before": stream.first_matching_bg(
+                minutes, -31, -24, dose["bg_fill_value"]
+            ),
+            # 75 mins because of insulin peak
+            "bg_75_min_after": stream.first_matching_bg(
+                minutes, 74, 79, dose["bg_fill_value"]
+            ),
+            **stream.bg_features_at(minutes),
+            **stream.on_board_features_at(minutes),
+        }
+        filled = fill_missing_bg_features(
+            pd.DataFrame([processed]), dose["fill_values"]["bg_variability"]
+        )
+        processed = filled.iloc[0].to_dict()
+
+        if dose["dose_type"] == "bolus":
+            features = {
+                "totalBolusAmount": get_number(event, "normal", 0)
+                + get_number(event, "extended", 0),
+                "carbInput": get_number(event, "carbInput", 0),
+                "insulinCarbRatio": get_number(
+                    event, "insulinCarbRatio", dose["fill_values"]["insulinCarbRatio"]
+                ),
+                "insulinSensitivity": get_number(
+                    event,
+                    "insulinSensitivity",
+                    dose["fill_values"]["insulinSensitivity"],
+                ),
+            }
+            columns = bolus_features
+        else:
+            features = {
+                "duration": get_number(event, "duration", np.nan),
+                "percent": get_number(event, "percent", np.nan),
+                "rate": get_number(event, "rate", 0),
+            }
+            columns = temp_basal_features
+        features.update(processed)
+        features = {col: features[col] for col in columns}
+
+        abnormal, score = None, np.nan
+        stored_model = dose["model"]
+        if stored_model is not None and not any(np.isnan(list(features.values()))):
+            model = stored_model["model"]
+            if stored_model["model_type"] in streaming_model_types:
+                abnormal, score = model.score_one(list(features.values()))
+            else:
+                row = pd.DataFrame([features], columns=columns)
+                abnormal = model.predict(row)[0]
+                score = model.decision_function(row)[0]
+
+        dose["scored"] = True
+        dose["record"] = {
+            "identifier": stream.identifier,
+            "jsonRowIndex": event.get("jsonRowIndex"),
+            "time": str(event["time"]),
+            "dose_type": dose["dose_type"],
+            **features,
+            "abnormal": None if abnormal is None else int(abnormal),
+            "abnormality_score": float(score),
+        }
+        self.emit({"window": "75_min", **dose["record"]})
+        self.metrics.record_emitted(received_at)
+
+    def summarize_dose(self, stream, dose, received_at):
+        minutes = dose["minutes"]
+        interval = self.bg_consideration_interval
+        bgs_before = stream.find_values(minutes, -interval, 5)
+        bgs_after = stream.find_values(minutes, -5, interval)
+        lower_bg_bound = stream.lower_bg_bound()
+
+        self.emit(
+            {
+                "window": str(interval) + "_min",
+                **dose["record"],
+                "bgs_before": bgs_before,
+                "bgs_after": bgs_after,
+                "duration_gaps_before": find_duration_of_gap(bgs_before),
+                "duration_gaps_after": find_duration_of_gap(bgs_after),
+                "before_event_strings": stream.sax_string(minutes, -interval),
+                "after_event_strings": stream.sax_string(minutes, interval),
+                # Same filter as the batch anomaly functions: a low BG after the dose
+                "low_bg_after": any(2 < bg <= lower_bg_bound for bg in bgs_after),
+            }
+        )
+        self.metrics.record_emitted(received_at)
+
+
+def get_number(event, key, default):
+    """Get a numerical field from an event, using the default if it's missing"""
+    value = event.get(key)
+    if value is None or value == "":
+        return default
+    value = float(value)
+    return default if np.isnan(value) else value
+
+
+def print_record(record):
+    print(json.dumps(record, default=str))
+    sys.stdout.flush()
+
+
+def get_stored_model_loader(model_type):
+    """
+    Get a function that loads (and caches) the stored model of each patient & dose type,
+    returning None if the patient has no stored model
+    """
+    cache = {}
+
+    def get_model(identifier, dose_type):
+        if (identifier, dose_type) not in cache:
+            model_path = get_model_path(identifier, dose_type, model_type)
+            features = bolus_features if dose_type == "bolus" else temp_basal_features
+            cache[(identifier, dose_type)] = (
+                load_model(model_path, model_type, features)
+                if exists(model_path)
+                else None
+            )
+        return cache[(identifier, dose_type)]
+
+    return get_model
+
+
+async def serve_socket(service, host, port):
+    """Accept connections that send one json event per line, until cancelled"""
+
+    async def handle_connection(reader, writer):
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            if line.strip():
+                # Waiting on a full queue stops reading from the socket, which slows the sender
+                await service.put(json.loads(line))
+        writer.close()
+
+    server = await asyncio.start_server(handle_connection, host, port)
+    async with server:
+        await server.serve_forever()
+
+
+async def tail_file(service, path, poll_interval=1.0):
+    """Follow a file that has one json event appended per line, until cancelled"""
+    with open(path) as f:
+        while True:
+            line = f.readline()
+            if not line:
+                await asyncio.sleep(poll_interval)
+                continue
+            if line.strip():
+                await service.put(json.loads(line))
+
+
+def load_replay_events(path, identifier=""):
+    """
+    Load the events of a Tidepool data export to replay them through the service,
+    in the order they occurred
+
+    path: path to the data export csv
+    identifier: identifier of the patient the data belongs to
+
+    Returns: list of event dicts
+    """
+    df = pd.read_csv(path)
+    df = df.loc[df["type"].isin(["cbg", "basal", "bolus"])]
+    df = df.iloc[np.argsort(pd.to_datetime(df["time"]).values, kind="stable")]
+    events = []
+    for row in df.to_dict("records"):
+        event = {
+            k: v for k, v in row.items() if not (isinstance(v, float) and np.isnan(v))
+        }
+        event["identifier"] = identifier
+        events.append(event)
+    return events
+
+
+async def replay_events(service, events, speedup=None):
+    """
+    Stand-in for a live source: put events on the queue in order, then close the queue
+
+    events: list of event dicts, sorted by time
+    speedup: how many times faster than real time to replay the events;
+             if None, replay them as fast as the service can process them
+    """
+    previous_minutes = None
+    for event in events:
+        minutes = to_minutes(event["time"])
+        if speedup is not None and previous_minutes is not None:
+            await asyncio.sleep(max(0, minutes - previous_minutes) * 60 / speedup)
+        previous_minutes = minutes
+        await service.put(event)
+    await service.close()
+
+
+async def report_metrics(service, interval=10):
+    """Print the service's metrics every 'interval' seconds, until cancelled"""
+    while True:
+        await asyncio.sleep(interval)
+        print(json.dumps({"metrics": service.metrics.summary()}), file=sys.stderr)
+
+
+async def main(args):
+    service = RealtimeScoringService(
+        get_stored_model_loader(args.model_type), max_queue_size=args.max_queue_size
+    )
+    reporter = asyncio.ensure_future(report_metrics(service, args.metrics_interval))
+    consumer = asyncio.ensure_future(service.run())
+
+    if args.replay is not None:
+        events = load_replay_events(args.replay, args.identifier)
+        await replay_events(service, events, args.speedup)
+    else:
+        source = (
+            serve_socket(service, args.host, args.port)
+            if args.tail is None
+            else tail_file(service, args.tail)
+        )
+        try:
+            await source
+        except asyncio.CancelledError:
+            pass
+        await service.close()
+
+    await consumer
+    reporter.cancel()
+    print(json.dumps({"metrics": service.metrics.summary()}), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Score live CGM & dose events with the patients' stored models"
+    )
+    parser.add_argument("--model-type", default="knn")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--tail", help="file to follow for json events")
+    parser.add_argument("--replay", help="Tidepool data export csv to replay")
+    parser.add_argument(
+        "--identifier", default="", help="identifier of the replayed patient"
+    )
+    parser.add_argument("--speedup", type=float, default=None)
+    parser.add_argument("--max-queue-size", type=int, default=10000)
+    parser.add_argument("--metrics-interval", type=float, default=10)
+
+    try:
+        asyncio.run(main(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,176 @@
+import matplotlib
+
+# Render the plots to files, without a display
+matplotlib.use("Agg")
+
+import os
+import argparse
+import numpy as np
+import matplotlib.pyplot as plt
+
+from pathlib import Path
+from os.path import join
+from concurrent.futures import ProcessPoolExecutor
+
+from bulk_processor import add_file_arguments, get_file_paths, get_results_path
+from row_offset_index import IndexedCSV
+from visualize_bg_plots import get_bg_tracing, downsample_tracing
+
+"""
+Render the BG tracing around every dose in the output of TaskGetAbnormalBoluses or
+TaskGetAbnormalBasals to image files, so that a review packet of the flagged doses can be
+generated without viewing the plots one by one in 'visualize_bg_plots.py'.
+
+The rows of each file are split into chunks that are rendered across a process pool. Each
+process opens the files through their row indexes (see 'row_offset_index.py'), so only the
+rows it renders are parsed, and it draws every plot by updating the points of the same figure,
+instead of creating a new figure per plot. Tracings with more than 'max_points' BGs are
+downsampled, keeping the lowest & highest BGs.
+"""
+
+default_output_dir = get_results_path("bg_plots")
+
+
+class TracingFigure:
+    """
+    Figure in the style of 'visualize_bg_plots.plot_bg_tracing' that's reused for every
+    dose, by moving its points instead of redrawing the axes
+    """
+
+    def __init__(self, figure_size=(6.4, 4.8)):
+        self.figure = plt.figure(figsize=figure_size)
+        self.ax = self.figure.add_subplot()
+        self.bg_points = self.ax.scatter([], [])
+        # Plot the BG at the abnormal event as a star
+        self.event_point = self.ax.scatter([0], [0], marker="o", s=100)
+        self.ax.set_xlabel("Minutes since dose event")
+        self.ax.set_ylabel("BG (mg/dL)")
+
+    def draw(self, dose, title, max_points=None):
+        """Update the figure with the BGs around a dose"""
+        times, bg_values, event_bg = get_bg_tracing(dose)
+        if max_points is not None:
+            times, bg_values = downsample_tracing(times, bg_values, max_points)
+
+        self.bg_points.set_offsets(np.column_stack([times, bg_values]))
+        self.event_point.set_offsets([[0, event_bg]])
+        self.ax.set_ylim(30, max(150, max(bg_values, default=0) + 10))
+        # Leave the same margins around the times as matplotlib's autoscaling
+        first, last = min(min(times, default=0), 0), max(max(times, default=0), 0)
+        margin = 0.05 * max(last - first, 1)
+        self.ax.set_xlim(first - margin, last + margin)
+        self.ax.set_title(title)
+
+    def save(self, path):
+        self.figure.savefig(path)
+
+
+_figure = None
+
+
+def _init_figure(figure_size):
+    """Create the figure that a worker process reuses for all of its plots"""
+    global _figure
+    _figure = TracingFigure(figure_size)
+
+
+def get_plot_path(output_dir, csv_path, row_number, image_format):
+    """
+    Get the path of the plot of a dose
+
+    row_number: row number of the dose in the csv, including the header (like in 'visualize_bg_plots.py')
+    """
+    stem = Path(csv_path).stem
+    return join(output_dir, stem, stem + "_row_" + str(row_number) + "." + image_format)
+
+
+def render_rows(job):
+    """
+    Render the plots of a range of rows of one file
+
+    job: tuple of (path to the csv, first row, row after the last row, output folder,
+         image format, maximum number of BGs to plot)
+
+    Returns: list of the paths of the saved plots
+    """
+    csv_path, start, end, output_dir, image_format, max_points = job
+    doses = IndexedCSV(csv_path)
+    paths = []
+    for index, dose in doses.get_rows(start, end).iterrows():
+        title = "Dose at " + str(dose.get("time", "")) + " (row " + str(index + 2) + ")"
+        _figure.draw(dose, title, max_points)
+
+        paths.append(get_plot_path(output_dir, csv_path, index + 2, image_format))
+        _figure.save(paths[-1])
+    return paths
+
+
+def render_files(
+    file_paths,
+    output_dir=default_output_dir,
+    image_format="png",
+    max_points=200,
+    chunk_size=100,
+    max_workers=None,
+    figure_size=(6.4, 4.8),
+):
+    """
+    Render the BG tracing of every dose in a list of abnormal dose files
+
+    file_paths: list of paths to csvs from TaskGetAbnormalBoluses or TaskGetAbnormalBasals
+    output_dir: folder to save the plots to, in one sub-folder per file
+    image_format: file format of the plots, ex: "png" or "svg"
+    max_points: maximum number of BGs to plot per dose
+    chunk_size: number of rows each process renders at a time
+    max_workers: number of processes to use (defaults to the number of cores)
+    figure_size: size of the plots, in inches
+
+    Returns: list of the paths of the saved plots
+    """
+    jobs = []
+    for file_path in file_paths:
+        # Build the row index before the workers open the file
+        length = len(IndexedCSV(file_path))
+        Path(join(output_dir, Path(file_path).stem)).mkdir(parents=True, exist_ok=True)
+        jobs.extend(
+            (file_path, start, start + chunk_size, output_dir, image_format, max_points)
+            for start in range(0, length, chunk_size)
+        )
+
+    with ProcessPoolExecutor(
+        max_workers=max_workers or os.cpu_count(),
+        initializer=_init_figure,
+        initargs=(figure_size,),
+    ) as executor:
+        return [path for paths in executor.map(render_rows, jobs) for path in paths]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Render the BG tracings of abnormal doses to image files, from the "
+        "TaskGetAbnormalBoluses or TaskGetAbnormalBasals csv files"
+    )
+    add_file_arguments(parser, "abnormal dose")
+    parser.add_argument("--output-dir", default=default_output_dir)
+    parser.add_argument("--image-format", choices=["png", "svg"], default="png")
+    parser.add_argument(
+        "--max-points",
+        type=int,
+        default=200,
+        help="maximum number of BGs to plot per dose",
+    )
+    parser.add_argument("--chunk-size", type=int, default=100)
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    file_paths = get_file_paths(args)
+
+    paths = render_files(
+        file_paths,
+        args.output_dir,
+        args.image_format,
+        args.max_points,
+        args.chunk_size,
+        args.workers,
+    )
+    print("Saved", len(paths), "plots to", args.output_dir)
@@ -0,0 +1,228 @@
+import shutil
+import argparse
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+
+from pathlib import Path
+from urllib.parse import quote
+from os.path import exists, join
+
+"""
+One columnar dataset per type of pipeline output (ex: the abnormal boluses), with the rows
+of every patient, so questions about the whole cohort don't have to open each patient's csv.
+
+Each dataset is a folder of parquet files, partitioned into sub-folders by patient & month:
+    <store>/<dataset>/identifier=<identifier>/month=<YYYY-MM>/<dataset>-<n>.parquet
+Within each file, the rows are sorted by time & split into row groups, and parquet saves the
+min & max of every column of each row group. A query only opens the partition folders that
+match its identifiers & time range, only reads the columns it asks for, and skips the row
+groups whose min & max rule out its filters.
+
+A patient's partitions are replaced each time their output is stored, so re-running the
+pipeline for a patient doesn't duplicate their rows.
+"""
+
+default_store_dir = str(Path(__file__).parent.parent) + "/results/results_store"
+
+partition_columns = ["identifier", "month"]
+
+# Operators that can be used in the filters of 'query_results'
+filter_operators = {
+    "==": lambda field, value: field == value,
+    "!=": lambda field, value: field != value,
+    "<": lambda field, value: field < value,
+    "<=": lambda field, value: field <= value,
+    ">": lambda field, value: field > value,
+    ">=": lambda field, value: field >= value,
+    "in": lambda field, value: field.isin(value),
+    "not in": lambda field, value: ~field.isin(value),
+}
+
+partitioning = ds.partitioning(
+    pa.schema([("identifier", pa.string()), ("month", pa.string())]), flavor="hive"
+)
+
+
+def get_dataset_dir(dataset, store_dir=default_store_dir):
+    return join(store_dir, dataset)
+
+
+def normalize_results(df):
+    """
+    Convert the columns of an output df to types that are the same for every patient, so
+    the parquet files of a dataset share one schema: "time" becomes a timestamp, numeric
+    (& boolean) columns become floats, and all other columns become strings
+    """
+    df = df.copy()
+    for column in df.columns:
+        if column == "time":
+            df[column] = pd.to_datetime(df[column])
+        elif pd.api.types.is_numeric_dtype(df[column]):
+            df[column] = df[column].astype(float)
+        else:
+            df[column] = df[column].where(df[column].isna(), df[column].astype(str))
+    return df
+
+
+def store_results(
+    df, dataset, identifier, store_dir=default_store_dir, row_group_size=50000
+):
+    """
+    Save a patient's output to a dataset, replacing any rows of theirs that were already in it
+
+    df: output df with a "time" column
+    dataset: name of the dataset, ex: "abnormal_boluses_knn"
+    identifier: identifier of the patient
+    row_group_size: maximum number of rows in each row group
+
+    Returns: number of rows that were stored
+    """
+    dataset_dir = get_dataset_dir(dataset, store_dir)
+    # The partition folder names are URI-encoded, like pyarrow writes them
+    patient_dir = join(dataset_dir, "identifier=" + quote(identifier, safe=""))
+    if exists(patient_dir):
+        shutil.rmtree(patient_dir)
+    if len(df) == 0:
+        return 0
+
+    df = normalize_results(df).sort_values("time", kind="stable")
+    df = df.drop(columns=partition_columns, errors="ignore")
+    df["identifier"] = identifier
+    df["month"] = df["time"].dt.strftime("%Y-%m")
+
+    ds.write_dataset(
+        pa.Table.from_pandas(df, preserve_index=False),
+        dataset_dir,
+        format="parquet",
+        partitioning=partitioning,
+        basename_template=dataset + "-{i}.parquet",
+        existing_data_behavior="overwrite_or_ignore",
+        max_rows_per_group=row_group_size,
+    )
+    return len(df)
+
+
+def get_filter_expression(filters):
+    """
+    Convert filters to a pyarrow expression
+
+    filters: list of (column, operator, value) tuples that must all be true,
+             where the operator is one of the keys of 'filter_operators'
+
+    Returns: pyarrow expression, or None if there are no filters
+    """
+    expression = None
+    for column, operator, value in filters or []:
+        if operator not in filter_operators:
+            raise ValueError("Invalid filter operator " + operator)
+        condition = filter_operators[operator](pc.field(column), value)
+        expression = condition if expression is None else expression & condition
+    return expression
+
+
+def match_timezone(time, tz):
+    """
+    Convert a time to the timezone of the stored times, so they can be compared
+
+    time: time to convert; times without a timezone are assumed to be in UTC
+    tz: timezone of the stored times, or None if they don't have one (in which case
+        they're assumed to be in UTC, like the pipeline's times)
+
+    Returns: Timestamp
+    """
+    time = pd.Timestamp(time)
+    if time.tz is None:
+        time = time.tz_localize("UTC")
+    return time.tz_convert(tz) if tz is not None else time.tz_convert(None)
+
+
+def query_results(
+    dataset,
+    columns=None,
+    filters=None,
+    identifiers=None,
+    start=None,
+    end=None,
+    store_dir=default_store_dir,
+):
+    """
+    Get the rows of a dataset that match filters, across every patient
+
+    dataset: name of the dataset, ex: "abnormal_boluses_knn"
+    columns: columns to get (defaults to all of them)
+    filters: list of (column, operator, value) tuples that must all be true,
+             ex: [("bg_75_min_after", "<", 3.9)]
+    identifiers: identifiers of the patients to get the rows of (defaults to every patient)
+    start: only get rows at or after this time; times without a timezone are in UTC
+    end: only get rows before this time; times without a timezone are in UTC
+
+    Returns: df of the matching rows
+    """
+    dataset_dir = get_dataset_dir(dataset, store_dir)
+    if not exists(dataset_dir):
+        return pd.DataFrame(columns=columns)
+    results = ds.dataset(dataset_dir, format="parquet", partitioning=partitioning)
+    tz = results.schema.field("time").type.tz
+
+    filters = list(filters or [])
+    if identifiers is not None:
+        filters.append(("identifier", "in", list(identifiers)))
+    # Filtering by month lets whole partitions be skipped, before the row groups are checked
+    if start is not None:
+        start = match_timezone(start, tz)
+        filters += [("month", ">=", start.strftime("%Y-%m")), ("time", ">=", start)]
+    if end is not None:
+        end = match_timezone(end, tz)
+        filters += [("month", "<=", end.strftime("%Y-%m")), ("time", "<", end)]
+
+    table = results.to_table(columns=columns, filter=get_filter_expression(filters))
+    return table.to_pandas()
+
+
+def parse_filter(text):
+    """Parse a filter from the command line, ex: 'bg_75_min_after < 3.9'"""
+    column, operator, value = text.split(" ", 2)
+    try:
+        value = float(value)
+    except ValueError:
+        pass
+    return column, operator, value
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Query the pipeline outputs of every patient in the results store"
+    )
+    parser.add_argument(
+        "dataset",
+        help="name of the dataset: abnormal_boluses_<model type> or abnormal_basals_<model type>, ex: abnormal_boluses_knn",
+    )
+    parser.add_argument("--columns", nargs="+", help="columns to get")
+    parser.add_argument(
+        "--filter",
+        action="append",
+        default=[],
+        help="filter in the form '<column> <operator> <value>', ex: 'bg_75_min_after < 3.9'; can be repeated",
+    )
+    parser.add_argument("--identifiers", nargs="+")
+    parser.add_argument("--start", help="only get rows at or after this time (in UTC)")
+    parser.add_argument("--end", help="only get rows before this time (in UTC)")
+    parser.add_argument("--store-dir", default=default_store_dir)
+    parser.add_argument("--output", help="csv to save the rows to")
+    args = parser.parse_args()
+
+    rows = query_results(
+        args.dataset,
+        args.columns,
+        [parse_filter(text) for text in args.filter],
+        args.identifiers,
+        args.start,
+        args.end,
+        args.store_dir,
+    )
+    if args.output is not None:
+        rows.to_csv(args.output, index=False)
+    print(rows.to_string(index=False, max_rows=50))
+    print(len(rows), "rows")
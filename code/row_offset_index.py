@@ -0,0 +1,184 @@
+import io
+import os
+import csv
+import struct
+import numpy as np
+import pandas as pd
+
+from os.path import exists
+
+"""
+Random access to the rows of large csv files (like the processed doses), without loading them.
+
+The first time a csv is opened, its rows' byte offsets are found by one pass over the file
+in large binary chunks, and saved to an index file next to the csv. After that, opening the
+csv only memory-maps the index, and getting a row only reads & parses that row's bytes, so
+jumping to any row takes the same time at any file size. The index is rebuilt if the csv's
+size or modification time changes.
+
+Index file (little-endian):
+    - 8 bytes: the format name, "ROWIDX01"
+    - int64: size of the csv, in bytes
+    - int64: modification time of the csv, in nanoseconds
+    - int64: number of rows (not counting the header)
+    - 32 bytes of padding
+    - int64 per row: byte offset of the start of the row, followed by one more
+      int64 with the offset of the end of the last row
+"""
+
+index_format_name = b"ROWIDX01"
+header_format = "<8sqqq32x"
+header_size = struct.calcsize(header_format)
+
+
+def get_row_index_path(csv_path):
+    """Get the path of the row index that's saved next to a csv"""
+    return csv_path + ".rowidx"
+
+
+def find_row_offsets(csv_path, chunk_size=2**26):
+    """
+    Find the byte offset of the start of every line of a csv, skipping line breaks inside
+    quoted fields
+
+    csv_path: path to the csv
+    chunk_size: number of bytes to read at a time
+
+    Returns: array of the offsets of the lines (including the header), followed by the
+             offset of the end of the last line
+    """
+    offsets = [np.array([0], dtype=np.int64)]
+    position = 0
+    in_quotes = False
+    with open(csv_path, "rb") as f:
+        while True:
+            chunk = np.frombuffer(f.read(chunk_size), dtype=np.uint8)
+            if len(chunk) == 0:
+                break
+            # A line break ends a row if an even number of quotes came before it
+            quote_counts = np.cumsum(chunk == ord('"')) + in_quotes
+            is_row_end = (chunk == ord("\n")) & (quote_counts % 2 == 0)
+            offsets.append(np.flatnonzero(is_row_end).astype(np.int64) + position + 1)
+            in_quotes = bool(quote_counts[-1] % 2)
+            position += len(chunk)
+
+    offsets = np.concatenate(offsets)
+    # The last line may not end with a line break
+    if offsets[-1] != position:
+        offsets = np.append(offsets, position)
+    return offsets
+
+
+def write_row_index(csv_path, index_path=None):
+    """
+    Build & save the row index of a csv
+
+    csv_path: path to the csv
+    index_path: path to save the index to; defaults to 'get_row_index_path(csv_path)'
+    """
+    index_path = index_path or get_row_index_path(csv_path)
+    stat = os.stat(csv_path)
+    # Skip the header line; an empty file has no rows that end anywhere
+    offsets = find_row_offsets(csv_path)[1:]
+    if len(offsets) == 0:
+        offsets = np.array([stat.st_size], dtype=np.int64)
+    with open(index_path, "wb") as f:
+        f.write(
+            struct.pack(
+                header_format,
+                index_format_name,
+                stat.st_size,
+                stat.st_mtime_ns,
+                max(len(offsets) - 1, 0),
+            )
+        )
+        offsets.astype("<i8").tofile(f)
+
+
+def parse_value(value):
+    """Convert a csv field to a float if it's a number, NaN if it's empty, or leave it as a string"""
+    if value == "":
+        return np.nan
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+
+class IndexedCSV:
+    """Read-only csv with random access to its rows, from a row index saved next to it"""
+
+    def __init__(self, csv_path):
+        """
+        csv_path: path to the csv; its row index is built if it doesn't exist or is out of date
+        """
+        self.path = csv_path
+        index_path = get_row_index_path(csv_path)
+        if not self._is_up_to_date(index_path):
+            write_row_index(csv_path, index_path)
+
+        with open(index_path, "rb") as f:
+            _, _, _, length = struct.unpack(header_format, f.read(header_size))
+        self.offsets = np.memmap(
+            index_path, dtype="<i8", mode="r", offset=header_size, shape=(length + 1,)
+        )
+        with open(csv_path, newline="") as f:
+            self.columns = next(csv.reader(f), [])
+
+    def _is_up_to_date(self, index_path):
+        """Check that the index exists & was built from the current version of the csv"""
+        if not exists(index_path):
+            return False
+        with open(index_path, "rb") as f:
+            name, size, mtime, _ = struct.unpack(header_format, f.read(header_size))
+        stat = os.stat(self.path)
+        return (
+            name == index_format_name
+            and size == stat.st_size
+            and mtime == stat.st_mtime_ns
+        )
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def read_rows(self, start, end):
+        """Get the raw bytes of the rows from 'start' up to (but not including) 'end'"""
+        start, end = max(start, 0), min(end, len(self))
+        if start >= end:
+            return b""
+        with open(self.path, "rb") as f:
+            f.seek(self.offsets[start])
+            return f.read(self.offsets[end] - self.offsets[start])
+
+    def get_row(self, index):
+        """
+        Get one row, parsing only that row
+
+        index: zero-indexed row number, not counting the header; can be negative
+
+        Returns: Series of the row's values, indexed by the column names
+        """
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError("Row " + str(index) + " is outside of " + self.path)
+        line = self.read_rows(index, index + 1).decode("utf-8").rstrip("\r\n")
+        values = next(csv.reader([line]), [])
+        return pd.Series(
+            [parse_value(value) for value in values],
+            index=self.columns[: len(values)],
+            name=index,
+        )
+
+    def get_rows(self, start, end):
+        """
+        Get a range of rows as a df, parsing only those rows
+
+        Returns: df of the rows from 'start' up to (but not including) 'end'
+        """
+        data = self.read_rows(start, end)
+        if len(data) == 0:
+            return pd.DataFrame(columns=self.columns)
+        df = pd.read_csv(io.BytesIO(data), header=None, names=self.columns)
+        df.index = range(max(start, 0), max(start, 0) + len(df))
+        return df
@@ -0,0 +1,122 @@
+import os
+import json
+import time
+import tempfile
+
+from collections import Counter
+from os.path import dirname, exists
+
+"""
+Journal of a bulk run, so that a run that's stopped partway through can be resumed without
+redoing the files that finished.
+
+The journal is a json file with an entry for each file in the run:
+    - "status": "pending", "running", "done" or "failed"
+    - "fingerprint": size & modification time of the file when it was last started, so a
+      finished file that has changed since is processed again
+    - "attempts": number of times the file has been started
+    - "failures": number of times in a row the file has failed, which sets how long to wait
+      before retrying it
+    - "error": traceback of the last failure
+    - "updated_at": time of the last change to the entry
+
+The journal is saved after every change by writing it to a temporary file & renaming it over
+the old journal, so a crash leaves either the old or the new journal, never a partial one.
+Files that were "running" when a run crashed aren't "done", so they're processed again.
+"""
+
+
+def get_fingerprint(file_path):
+    """Get the size & modification time of a file, to tell if it has changed"""
+    stat = os.stat(file_path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+class RunJournal:
+    """Record of which files of a bulk run have finished, saved to a json file"""
+
+    def __init__(self, path):
+        """
+        path: path of the journal; an existing journal there is loaded
+        """
+        self.path = path
+        self.entries = {}
+        if exists(path):
+            with open(path) as f:
+                self.entries = json.load(f)["files"]
+
+    @classmethod
+    def start(cls, path, file_paths):
+        """Start a new journal for a run over 'file_paths', replacing any journal at 'path'"""
+        journal = cls.__new__(cls)
+        journal.path = path
+        journal.entries = {}
+        for file_path in file_paths:
+            journal._update(file_path, status="pending", attempts=0, failures=0)
+        journal.save()
+        return journal
+
+    def save(self):
+        """Save the journal atomically"""
+        directory = dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+            "w", dir=directory, suffix=".tmp", delete=False
+        ) as f:
+            json.dump({"files": self.entries}, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(f.name, self.path)
+
+    def _update(self, file_path, **values):
+        entry = self.entries.setdefault(file_path, {"attempts": 0, "failures": 0})
+        entry.update(values, updated_at=time.time())
+
+    def get_file_paths(self):
+        return list(self.entries)
+
+    def is_complete(self, file_path):
+        """Check if a file finished, and hasn't changed since it was processed"""
+        entry = self.entries.get(file_path, {})
+        return (
+            entry.get("status") == "done"
+            and exists(file_path)
+            and entry.get("fingerprint") == get_fingerprint(file_path)
+        )
+
+    def get_next_attempt_time(self, file_path, backoff=60):
+        """
+        Get the earliest time to start a file, waiting 'backoff' seconds after its
+        first failure & twice as long after each failure in a row after that
+
+        Returns: time in seconds since the epoch
+        """
+        entry = self.entries.get(file_path, {})
+        if entry.get("status") != "failed":
+            return 0
+        return entry["updated_at"] + backoff * 2 ** (entry["failures"] - 1)
+
+    def mark_started(self, file_path):
+        entry = self.entries.get(file_path, {})
+        self._update(
+            file_path,
+            status="running",
+            fingerprint=get_fingerprint(file_path),
+            attempts=entry.get("attempts", 0) + 1,
+        )
+
+    def mark_done(self, file_path):
+        self._update(file_path, status="done", failures=0, error=None)
+
+    def mark_failed(self, file_path, error):
+        entry = self.entries.get(file_path, {})
+        self._update(
+            file_path,
+            status="failed",
+            failures=entry.get("failures", 0) + 1,
+            error=error,
+        )
+
+    def get_summary(self):
+        """Get the number of files with each status"""
+        return dict(Counter(entry["status"] for entry in self.entries.values()))
@@ -0,0 +1,380 @@
+import json
+import argparse
+import numpy as np
+import pandas as pd
+
+from pathlib import Path
+from os.path import join
+from numpy.lib.stride_tricks import sliding_window_view
+
+import optimized_analysis_pipeline as p
+from bulk_processor import (
+    add_file_arguments,
+    get_file_paths,
+    get_results_path,
+    load_task,
+)
+from bg_sax_analysis import all_alphabet, get_breakpoints, get_pyramid_start
+
+"""
+Inverted index from SAX n-grams to the places they occur, across every patient in a cohort.
+
+The index is a folder of numpy arrays that are memory-mapped when the index is loaded:
+    - codes.npy: every patient's SAX letters as uint8 numbers, one patient after another
+    - gram_keys.npy: sorted keys of every n-gram that occurs (n-grams with missing data are skipped)
+    - posting_starts.npy: where each key's positions start in postings.npy
+    - postings.npy: positions in codes.npy where each n-gram starts, grouped by key
+    - patients.json: where each patient's letters are in codes.npy, & the time of their first letter
+
+Queries look up the n-grams of the query word to find candidate windows, and only
+check the letters of those candidates, so no patient files are read at query time.
+"""
+
+default_index_dir = get_results_path("sax_index")
+
+# Character used for "any letter" in query words
+wildcard = "?"
+
+
+def load_sax_codes(file_path, alphabet_size=7, sax_interval=10):
+    """
+    Load the SAX encoding of a raw data file with the given alphabet size & interval length
+    from TaskGetSAXPyramid, running the pipeline if needed
+
+    Returns: tuple of (time of the first SAX interval, array of uint8 codes where 0 is "a"
+        & missing data is the alphabet size)
+    """
+    identifier = file_path.split("/")[-1]
+    pyramid = load_task(
+        p.TaskGetSAXPyramid(
+            path=file_path,
+            identifier=identifier,
+            interval_lengths=[sax_interval],
+            alphabet_sizes=[alphabet_size],
+        )
+    )
+
+    codes = pyramid["codes_" + str(sax_interval) + "min_" + str(alphabet_size)]
+    return get_pyramid_start(pyramid, sax_interval), codes
+
+
+def get_gram_keys(codes, gram_length, alphabet_size):
+    """
+    Get the key of the n-gram starting at each position of an array of codes
+
+    Returns: tuple of (array of keys, boolean array of whether each n-gram has no missing data)
+    """
+    base = alphabet_size + 1
+    if len(codes) < gram_length:
+        return np.array([], dtype=np.uint64), np.array([], dtype=bool)
+    grams = sliding_window_view(codes.astype(np.uint64), gram_length)
+    powers = base ** np.arange(gram_length - 1, -1, -1, dtype=np.uint64)
+    keys = (grams * powers).sum(axis=1, dtype=np.uint64)
+    is_complete = ~(grams == alphabet_size).any(axis=1)
+    return keys, is_complete
+
+
+def build_sax_index(
+    file_paths,
+    index_dir=default_index_dir,
+    gram_length=6,
+    alphabet_size=7,
+    sax_interval=10,
+    bg_interval=5,
+):
+    """
+    Build the inverted index from the SAX encodings of every patient in a cohort
+
+    file_paths: list of paths to the raw data files of the patients
+    index_dir: folder to save the index to
+    gram_length: number of letters in each indexed n-gram
+    alphabet_size: alphabet size of the SAX encodings
+    sax_interval: minutes represented by each SAX letter
+    bg_interval: minutes between each BG value (used for MINDIST)
+    """
+    if gram_length * np.log2(alphabet_size + 1) > 63:
+        raise ValueError("N-grams are too long to be stored as 64-bit keys")
+
+    patients = []
+    all_codes = []
+    all_keys = []
+    all_positions = []
+    offset = 0
+    for file_path in file_paths:
+        start, codes = load_sax_codes(file_path, alphabet_size, sax_interval)
+        keys, is_complete = get_gram_keys(codes, gram_length, alphabet_size)
+        all_keys.append(keys[is_complete])
+        all_positions.append(offset + np.flatnonzero(is_complete))
+        all_codes.append(codes.astype(np.uint8))
+        patients.append(
+            {
+                "identifier": file_path.split("/")[-1],
+                "offset": offset,
+                "length": len(codes),
+                "start": start.isoformat(),
+            }
+        )
+        offset += len(codes)
+        print("Indexed", file_path)
+
+    keys = np.concatenate(all_keys) if all_keys else np.array([], dtype=np.uint64)
+    positions = np.concatenate(all_positions) if all_positions else np.array([])
+    order = np.argsort(keys, kind="stable")
+    gram_keys, posting_counts = np.unique(keys[order], return_counts=True)
+    posting_starts = np.concatenate([[0], np.cumsum(posting_counts)])
+
+    Path(index_dir).mkdir(parents=True, exist_ok=True)
+    np.save(
+        join(index_dir, "codes.npy"), np.concatenate(all_codes + [[]]).astype(np.uint8)
+    )
+    np.save(join(index_dir, "gram_keys.npy"), gram_keys.astype(np.uint64))
+    np.save(join(index_dir, "posting_starts.npy"), posting_starts.astype(np.int64))
+    np.save(join(index_dir, "postings.npy"), positions[order].astype(np.int64))
+    with open(join(index_dir, "patients.json"), "w") as f:
+        json.dump(
+            {
+                "gram_length": gram_length,
+                "alphabet_size": alphabet_size,
+                "sax_interval": sax_interval,
+                "bg_interval": bg_interval,
+                "patients": patients,
+            },
+            f,
+        )
+
+
+class SAXIndex:
+    """Query interface for an index built with 'build_sax_index'"""
+
+    def __init__(self, index_dir=default_index_dir):
+        with open(join(index_dir, "patients.json")) as f:
+            info = json.load(f)
+        self.gram_length = info["gram_length"]
+        self.alphabet_size = info["alphabet_size"]
+        self.sax_interval = info["sax_interval"]
+        self.points_per_letter = info["sax_interval"] / info["bg_interval"]
+        self.patients = pd.DataFrame(info["patients"])
+        self.patients["start"] = pd.to_datetime(self.patients["start"])
+        self.patient_offsets = self.patients["offset"].values
+
+        self.codes = np.load(join(index_dir, "codes.npy"), mmap_mode="r")
+        self.gram_keys = np.load(join(index_dir, "gram_keys.npy"), mmap_mode="r")
+        self.posting_starts = np.load(
+            join(index_dir, "posting_starts.npy"), mmap_mode="r"
+        )
+        self.postings = np.load(join(index_dir, "postings.npy"), mmap_mode="r")
+        self._decoded_keys = None
+
+        # Distance between letters, from the MINDIST lookup table of the SAX paper;
+        # missing data is infinitely far from everything
+        breakpoints = get_breakpoints(self.alphabet_size)[1:-1]
+        letters = np.arange(self.alphabet_size + 1)
+        high = np.maximum.outer(letters, letters)
+        low = np.minimum.outer(letters, letters)
+        with np.errstate(invalid="ignore"):
+            table = np.where(
+                high - low <= 1,
+                0.0,
+                breakpoints[np.minimum(high - 1, len(breakpoints) - 1)]
+                - breakpoints[np.minimum(low, len(breakpoints) - 1)],
+            )
+        table[self.alphabet_size, :] = np.inf
+        table[:, self.alphabet_size] = np.inf
+        self.letter_distances = table
+
+    def word_to_codes(self, word):
+        """Convert a query word to codes, where wildcards are -1"""
+        codes = np.array(
+            [-1 if c == wildcard else all_alphabet.index(c) for c in word], dtype=int
+        )
+        if len(codes) < self.gram_length:
+            raise ValueError(
+                "Query words must be at least "
+                + str(self.gram_length)
+                + " letters long"
+            )
+        if (codes >= self.alphabet_size).any():
+            raise ValueError("Query words can't contain letters for missing data")
+        return codes
+
+    def get_word(self, identifier, time, duration_minutes):
+        """
+        Get a patient's SAX word for the window of 'duration_minutes' starting at 'time',
+        to search for windows that resemble it; missing data becomes a wildcard
+        """
+        patient = self.patients.loc[self.patients["identifier"] == identifier].iloc[0]
+        first = int(
+            (pd.Timestamp(time) - patient["start"])
+            / pd.Timedelta(minutes=self.sax_interval)
+        )
+        length = int(duration_minutes // self.sax_interval)
+        if first < 0 or first + length > patient["length"]:
+            raise ValueError("Window is outside of the patient's data")
+        codes = self.codes[
+            patient["offset"] + first : patient["offset"] + first + length
+        ]
+        return "".join(
+            wildcard if c == self.alphabet_size else all_alphabet[c] for c in codes
+        )
+
+    def _postings_of_keys(self, key_indexes):
+        """Get every position of the n-grams at the given indexes of gram_keys"""
+        starts = np.asarray(self.posting_starts[key_indexes])
+        counts = np.asarray(self.posting_starts[key_indexes + 1]) - starts
+        if counts.sum() == 0:
+            return np.array([], dtype=np.int64)
+        # Positions of every posting in each key's range, without a python loop
+        run_offsets = np.repeat(starts - np.cumsum(counts) + counts, counts)
+        return np.asarray(self.postings[run_offsets + np.arange(counts.sum())])
+
+    def _postings_of_block(self, codes):
+        key = np.uint64(0)
+        for code in codes:
+            key = key * np.uint64(self.alphabet_size + 1) + np.uint64(code)
+        index = np.searchsorted(self.gram_keys, key)
+        if index == len(self.gram_keys) or self.gram_keys[index] != key:
+            return np.array([], dtype=np.int64)
+        return self._postings_of_keys(np.array([index]))
+
+    def _window_codes(self, candidates, length):
+        """Get the codes of the candidate windows that don't cross between patients"""
+        candidates = np.unique(candidates[candidates >= 0])
+        patient_indexes = np.searchsorted(self.patient_offsets, candidates, "right") - 1
+        patient_ends = (
+            self.patient_offsets[patient_indexes]
+            + self.patients["length"].values[patient_indexes]
+        )
+        candidates = candidates[candidates + length <= patient_ends]
+        windows = np.asarray(self.codes)[candidates[:, np.newaxis] + np.arange(length)]
+        return candidates, windows
+
+    def _to_results(self, positions, distances=None):
+        patient_indexes = np.searchsorted(self.patient_offsets, positions, "right") - 1
+        patients = self.patients.iloc[patient_indexes]
+        results = pd.DataFrame(
+            {
+                "identifier": patients["identifier"].values,
+                "time": patients["start"].values
+                + pd.to_timedelta(
+                    (positions - patients["offset"].values) * self.sax_interval,
+                    unit="min",
+                ),
+            }
+        )
+        if distances is not None:
+            results["mindist"] = distances
+            results = results.sort_values("mindist").reset_index(drop=True)
+        return results
+
+    def search(self, word):
+        """
+        Find every window that exactly matches a SAX word, where "?" matches any letter
+
+        word: query word; must be at least gram_length letters, & have gram_length
+              letters in a row without wildcards to use the index
+
+        Returns: df with the "identifier" & start "time" of the matching windows
+        """
+        codes = self.word_to_codes(word)
+        blocks = [
+            offset
+            for offset in range(len(codes) - self.gram_length + 1)
+            if (codes[offset : offset + self.gram_length] >= 0).all()
+        ]
+        if len(blocks) > 0:
+            # Use the n-gram with the fewest occurrences to find the candidates
+            candidates = min(
+                (
+                    self._postings_of_block(codes[offset : offset + self.gram_length])
+                    - offset
+                    for offset in blocks
+                ),
+                key=len,
+            )
+        else:
+            # Without a complete n-gram, every window is a candidate
+            candidates = np.arange(len(self.codes))
+
+        candidates, windows = self._window_codes(candidates, len(codes))
+        is_fixed = codes >= 0
+        matches = (windows[:, is_fixed] == codes[is_fixed]).all(axis=1)
+        return self._to_results(candidates[matches])
+
+    def search_mindist(self, word, max_distance):
+        """
+        Find every window whose MINDIST to a SAX word is at most 'max_distance',
+        where "?" is 0 distance from any letter
+
+        MINDIST is a lower bound on the Euclidean distance between the normalized log BGs
+        the words represent, so no window closer than 'max_distance' is missed.
+
+        Returns: df with the "identifier", start "time" & "mindist" of the matching windows,
+            sorted from closest to farthest
+        """
+        codes = self.word_to_codes(word)
+        # Squared letter-distance total that a window must be within
+        max_total = max_distance**2 / self.points_per_letter
+
+        # If the whole word is within the total, at least one of its non-overlapping
+        # n-grams is within its share of the total
+        n_blocks = len(codes) // self.gram_length
+        decoded_keys = self._get_decoded_keys()
+        candidates = []
+        for block in range(n_blocks):
+            offset = block * self.gram_length
+            block_codes = codes[offset : offset + self.gram_length]
+            is_fixed = block_codes >= 0
+            block_distances = (
+                self.letter_distances[block_codes[is_fixed], decoded_keys[:, is_fixed]]
+                ** 2
+            ).sum(axis=1)
+            close_keys = np.flatnonzero(block_distances <= max_total / n_blocks)
+            candidates.append(self._postings_of_keys(close_keys) - offset)
+
+        candidates, windows = self._window_codes(np.concatenate(candidates), len(codes))
+        is_fixed = codes >= 0
+        totals = (
+            self.letter_distances[codes[is_fixed], windows[:, is_fixed]] ** 2
+        ).sum(axis=1)
+        matches = totals <= max_total
+        distances = np.sqrt(self.points_per_letter * totals[matches])
+        return self._to_results(candidates[matches], distances)
+
+    def _get_decoded_keys(self):
+        """Letters of every indexed n-gram, as a (number of keys x gram_length) array"""
+        if self._decoded_keys is None:
+            base = np.uint64(self.alphabet_size + 1)
+            keys = np.asarray(self.gram_keys).copy()
+            decoded = np.zeros((len(keys), self.gram_length), dtype=np.uint8)
+            for i in range(self.gram_length - 1, -1, -1):
+                decoded[:, i] = keys % base
+                keys //= base
+            self._decoded_keys = decoded
+        return self._decoded_keys
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Build an inverted index of SAX n-grams across a cohort"
+    )
+    add_file_arguments(parser)
+    parser.add_argument("--index-dir", default=default_index_dir)
+    parser.add_argument("--gram-length", type=int, default=6)
+    parser.add_argument("--alphabet-size", type=int, default=7)
+    parser.add_argument(
+        "--sax-interval",
+        type=int,
+        default=10,
+        help="minutes represented by each letter",
+    )
+    args = parser.parse_args()
+
+    file_paths = get_file_paths(args)
+
+    build_sax_index(
+        file_paths,
+        args.index_dir,
+        args.gram_length,
+        args.alphabet_size,
+        args.sax_interval,
+    )
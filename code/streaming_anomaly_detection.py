@@ -0,0 +1,138 @@
+import numpy as np
+
+
+class SlidingWindowKNNDetector:
+    """
+    K-nearest neighbors outlier detector that scores doses one at a time as they arrive,
+    comparing each dose to a sliding window of the most recent doses.
+
+    The abnormality score of a dose is the distance to its k-th nearest neighbor within
+    the window, after standardizing the features with running means & standard deviations.
+    A dose is abnormal if its score is in the top "contamination" fraction of the recent
+    scores. Scoring a dose takes time & memory proportional to the window size, however
+    many doses have been seen, so the detector never needs to be refit on the full history.
+
+    Like pyod's KNN, predictions are 0 for normal doses and 1 for abnormal doses.
+    """
+
+    def __init__(
+        self,
+        n_neighbors=5,
+        contamination=0.05,
+        window_size=1000,
+        score_window_size=1000,
+        min_scores=50,
+    ):
+        """
+        n_neighbors: the k in k-nearest neighbors
+        contamination: expected fraction of outliers
+        window_size: number of recent doses that new doses are compared to
+        score_window_size: number of recent scores used to decide the outlier threshold
+        min_scores: number of doses to score before any are classified as abnormal
+        """
+        self.n_neighbors = n_neighbors
+        self.contamination = contamination
+        self.window_size = window_size
+        self.score_window_size = score_window_size
+        self.min_scores = min_scores
+        self.n_seen_ = 0
+        self.n_scored_ = 0
+
+    def _initialize(self, n_features):
+        self.window_ = np.zeros((self.window_size, n_features))
+        self.recent_scores_ = np.zeros(self.score_window_size)
+        self.mean_ = np.zeros(n_features)
+        self.sum_squared_differences_ = np.zeros(n_features)
+
+    def _std(self):
+        std = np.sqrt(self.sum_squared_differences_ / max(1, self.n_seen_))
+        # Constant features would otherwise divide by 0
+        return np.where(std > 0, std, 1)
+
+    def _threshold(self):
+        if self.n_scored_ < self.min_scores:
+            return np.inf
+        scores = self.recent_scores_[: min(self.n_scored_, self.score_window_size)]
+        return np.quantile(scores, 1 - self.contamination)
+
+    def _kth_neighbor_distances(self, X):
+        """Distance from each row of X to its k-th nearest neighbor in the window"""
+        if min(self.n_seen_, self.window_size) < self.n_neighbors:
+            return np.full(len(X), np.nan)
+        window = self.window_[: min(self.n_seen_, self.window_size)]
+
+        std = self._std()
+        distances = np.sqrt(
+            (((X[:, np.newaxis, :] - window[np.newaxis, :, :]) / std) ** 2).sum(axis=2)
+        )
+        return np.partition(distances, self.n_neighbors - 1, axis=1)[
+            :, self.n_neighbors - 1
+        ]
+
+    def score_one(self, x):
+        """
+        Score one dose against the window, and then add it to the window
+
+        x: array of the dose's features
+
+        Returns: tuple of (prediction, abnormality score), where the score is NaN
+            if fewer than k doses have been seen
+        """
+        x = np.asarray(x, dtype=float)
+        if self.n_seen_ == 0:
+            self._initialize(len(x))
+
+        score = self._kth_neighbor_distances(x[np.newaxis, :])[0]
+        prediction = 0
+        if not np.isnan(score):
+            prediction = int(score > self._threshold())
+            self.recent_scores_[self.n_scored_ % self.score_window_size] = score
+            self.n_scored_ += 1
+
+        # Replace the oldest dose in the window
+        self.window_[self.n_seen_ % self.window_size] = x
+        # Update the running mean & variance (Welford's algorithm)
+        self.n_seen_ += 1
+        difference = x - self.mean_
+        self.mean_ += difference / self.n_seen_
+        self.sum_squared_differences_ += difference * (x - self.mean_)
+
+        return prediction, score
+
+    def update(self, X):
+        """
+        Score doses in the order they occurred, adding each one to the window after it's scored
+
+        X: array or df of the doses' features, sorted by time
+
+        Returns: tuple of (array of predictions, array of abnormality scores)
+        """
+        results = [self.score_one(x) for x in np.asarray(X, dtype=float)]
+        if len(results) == 0:
+            return np.array([], dtype=int), np.array([])
+        predictions, scores = zip(*results)
+        return np.array(predictions), np.array(scores)
+
+    def fit(self, X):
+        """Stream doses through the detector"""
+        self.labels_, self.decision_scores_ = self.update(X)
+        return self
+
+    def decision_function(self, X, batch_size=1000):
+        """Get the abnormality scores of doses against the current window, without updating it"""
+        X = np.asarray(X, dtype=float)
+        return np.concatenate(
+            [
+                self._kth_neighbor_distances(X[start : start + batch_size])
+                for start in range(0, len(X), batch_size)
+            ]
+            + [np.array([])]
+        )
+
+    def predict(self, X):
+        """Predict whether doses are abnormal (1) or normal (0), without updating the window"""
+        return (self.decision_function(X) > self._threshold()).astype(int)
+
+
+# Model types that score doses incrementally, and the parameters they're created with
+streaming_model_types = {"streaming_knn": {}}
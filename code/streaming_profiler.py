@@ -0,0 +1,413 @@
+import os
+import argparse
+import numpy as np
+import pandas as pd
+
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+from bulk_processor import add_file_arguments, get_file_paths, get_results_path
+
+"""
+Summary statistics of the columns of data exports that are too large to load at once,
+like the summaries printed by 'exploratory_risk_analysis.py'.
+
+Each file is read in chunks, and every column gets a summary that's updated chunk by chunk:
+    - the number of present & missing values
+    - the mean & variance of the values that are numbers (Welford's algorithm, combined
+      across chunks with Chan et al.'s formula)
+    - approximate quantiles (a KLL sketch)
+    - an approximate number of distinct values (HyperLogLog)
+    - the most frequent values (Misra-Gries counters)
+
+Every summary takes a fixed amount of memory however many rows it has seen, and two summaries
+can be merged into the summary of all of their rows. Files are summarized in parallel
+across processes, and the summaries of every file are merged into one cohort report.
+"""
+
+default_output_path = get_results_path("profile/cohort_profile.csv")
+
+# Columns that are summarized by default (the columns in 'exploratory_risk_analysis.py')
+default_columns = [
+    "type",
+    "est.localTime",
+    "deliveryType",
+    "deviceTime",
+    "units",
+    "expectedDuration",
+    "percent",
+    "rate",
+    "insulinOnBoard",
+    "recommended.net",
+    "carbInput",
+    "value",
+]
+
+report_quantiles = [0.25, 0.5, 0.75]
+
+
+class RunningMoments:
+    """Count, mean, variance, min & max of a stream of numbers"""
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.sum_squared_differences = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+
+    def merge(self, other):
+        """Combine with the moments of other values (Chan et al.'s parallel algorithm)"""
+        if other.count == 0:
+            return self
+        count = self.count + other.count
+        difference = other.mean - self.mean
+        self.mean += difference * other.count / count
+        self.sum_squared_differences += (
+            other.sum_squared_differences
+            + difference**2 * self.count * other.count / count
+        )
+        self.count = count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        return self
+
+    def update(self, values):
+        """Add an array of numbers"""
+        if len(values) == 0:
+            return self
+        chunk = RunningMoments()
+        chunk.count = len(values)
+        chunk.mean = float(values.mean())
+        chunk.sum_squared_differences = float(((values - chunk.mean) ** 2).sum())
+        chunk.min = float(values.min())
+        chunk.max = float(values.max())
+        return self.merge(chunk)
+
+    def variance(self, ddof=1):
+        if self.count <= ddof:
+            return np.nan
+        return self.sum_squared_differences / (self.count - ddof)
+
+
+class KLLSketch:
+    """
+    Approximate quantiles of a stream of numbers (Karnin, Lang & Liberty, 2016)
+
+    The values are kept in levels, where each value in level h stands for 2 ** h of the values
+    that were added. When a level is full, it's sorted and every other value (starting from a
+    random one of the first two) is promoted to the level above. The error in the rank of a
+    quantile is about 1.7 / k of the number of values.
+    """
+
+    def __init__(self, k=200, seed=0):
+        """
+        k: size of the largest level; higher is more accurate but takes more memory
+        seed: seed for picking which values are promoted
+        """
+        self.k = k
+        self.rng = np.random.RandomState(seed)
+        self.levels = [np.empty(0)]
+
+    def _capacity(self, level):
+        # Lower levels hold fewer values, shrinking by 2/3 per level
+        depth = len(self.levels) - 1 - level
+        return max(2, int(np.ceil(self.k * (2 / 3) ** depth)))
+
+    def _compress(self):
+        level = 0
+        while level < len(self.levels):
+            if len(self.levels[level]) > self._capacity(level):
+                if level + 1 == len(self.levels):
+                    self.levels.append(np.empty(0))
+                values = np.sort(self.levels[level])
+                # Keep the last value at this level if there's an odd number of them
+                leftover = values[len(values) - len(values) % 2 :]
+                values = values[: len(values) - len(values) % 2]
+                promoted = values[self.rng.randint(2) :: 2]
+                self.levels[level] = leftover
+                self.levels[level + 1] = np.concatenate(
+                    [self.levels[level + 1], promoted]
+                )
+            level += 1
+
+    def update(self, values):
+        """Add an array of numbers"""
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        self._compress()
+        return self
+
+    def merge(self, other):
+        """Combine with the sketch of other values"""
+        for level, values in enumerate(other.levels):
+            if level == len(self.levels):
+                self.levels.append(np.empty(0))
+            self.levels[level] = np.concatenate([self.levels[level], values])
+        self._compress()
+        return self
+
+    def quantiles(self, fractions):
+        """
+        Get approximate quantiles
+
+        fractions: list of quantiles to get, between 0 & 1
+
+        Returns: array of the values at each quantile, or NaNs if no values have been added
+        """
+        values = np.concatenate(self.levels)
+        if len(values) == 0:
+            return np.full(len(fractions), np.nan)
+        weights = np.concatenate(
+            [np.full(len(values), 2**level) for level, values in enumerate(self.levels)]
+        )
+        order = np.argsort(values, kind="stable")
+        ranks = np.cumsum(weights[order])
+        positions = np.searchsorted(ranks, np.asarray(fractions) * ranks[-1], "left")
+        return values[order][np.minimum(positions, len(values) - 1)]
+
+
+def _bit_length(values):
+    """Number of bits needed to write each of an array of unsigned 64-bit integers"""
+    values = values.copy()
+    lengths = np.zeros(len(values), dtype=np.int64)
+    for shift in [32, 16, 8, 4, 2, 1]:
+        is_longer = values >= np.uint64(1 << shift)
+        lengths += shift * is_longer
+        values = np.where(is_longer, values >> np.uint64(shift), values)
+    return lengths + (values > 0)
+
+
+class HyperLogLog:
+    """
+    Approximate number of distinct values in a stream (Flajolet et al., 2007)
+
+    Each value is hashed, the first 'precision' bits of the hash pick a register, and the
+    register keeps the largest position of the first 1 bit in the rest of the hashes it's seen.
+    The relative error is about 1.04 / sqrt(2 ** precision).
+    """
+
+    def __init__(self, precision=14):
+        self.precision = precision
+        self.registers = np.zeros(2**precision, dtype=np.uint8)
+
+    def update(self, values):
+        """Add an array of values; equal values must have the same type to count as one"""
+        if len(values) == 0:
+            return self
+        hashes = pd.util.hash_array(np.asarray(values))
+        remaining_bits = 64 - self.precision
+        indices = (hashes >> np.uint64(remaining_bits)).astype(np.int64)
+        rest = hashes & np.uint64((1 << remaining_bits) - 1)
+        ranks = (remaining_bits - _bit_length(rest) + 1).astype(np.uint8)
+        np.maximum.at(self.registers, indices, ranks)
+        return self
+
+    def merge(self, other):
+        """Combine with the registers of other values"""
+        self.registers = np.maximum(self.registers, other.registers)
+        return self
+
+    def count(self):
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m**2 / np.sum(2.0 ** -self.registers.astype(float))
+        n_empty = np.count_nonzero(self.registers == 0)
+        # Use linear counting for small numbers of values
+        if estimate <= 2.5 * m and n_empty > 0:
+            estimate = m * np.log(m / n_empty)
+        return int(round(estimate))
+
+
+class TopValues:
+    """
+    Most frequent values of a stream (the Misra-Gries summary, merged as in Agarwal et al., 2012)
+
+    At most 'capacity' counters are kept; each count is a lower bound that's off by at most
+    the number of values divided by 'capacity' + 1, and is exact if there are fewer
+    distinct values than 'capacity'.
+    """
+
+    def __init__(self, capacity=100):
+        self.capacity = capacity
+        self.counts = pd.Series(dtype=np.int64)
+
+    def _add_counts(self, counts):
+        self.counts = self.counts.add(counts, fill_value=0).astype(np.int64)
+        if len(self.counts) > self.capacity:
+            self.counts = self.counts.sort_values(ascending=False)
+            self.counts -= self.counts.iloc[self.capacity]
+            self.counts = self.counts[self.counts > 0]
+
+    def update(self, values):
+        """Add a Series of values"""
+        self._add_counts(values.value_counts())
+        return self
+
+    def merge(self, other):
+        self._add_counts(other.counts)
+        return self
+
+    def top(self, k=5):
+        """Get the 'k' most frequent values & their approximate counts, as a Series"""
+        return self.counts.sort_values(ascending=False, kind="stable").head(k)
+
+
+class ColumnSummary:
+    """Mergeable summary of the values in one column"""
+
+    def __init__(self, kll_k=200, hll_precision=14, top_capacity=100, seed=0):
+        self.count = 0
+        self.missing = 0
+        self.moments = RunningMoments()
+        self.quantile_sketch = KLLSketch(kll_k, seed)
+        self.distinct_sketch = HyperLogLog(hll_precision)
+        self.top_values = TopValues(top_capacity)
+
+    def update(self, values):
+        """
+        Add a chunk of a column
+
+        values: Series of the column's values, read as strings
+        """
+        present = values.dropna()
+        self.count += len(present)
+        self.missing += len(values) - len(present)
+        numbers = pd.to_numeric(present, errors="coerce").to_numpy(dtype=float)
+        numbers = numbers[np.isfinite(numbers)]
+        self.moments.update(numbers)
+        self.quantile_sketch.update(numbers)
+        self.distinct_sketch.update(present.to_numpy(dtype=str))
+        self.top_values.update(present)
+        return self
+
+    def merge(self, other):
+        self.count += other.count
+        self.missing += other.missing
+        self.moments.merge(other.moments)
+        self.quantile_sketch.merge(other.quantile_sketch)
+        self.distinct_sketch.merge(other.distinct_sketch)
+        self.top_values.merge(other.top_values)
+        return self
+
+    def to_dict(self, quantiles=report_quantiles, top_k=5):
+        """Get the summary statistics, in the style of pandas' 'describe'"""
+        stats = {
+            "count": self.count,
+            "missing": self.missing,
+            "numeric_count": self.moments.count,
+            "mean": self.moments.mean if self.moments.count > 0 else np.nan,
+            "std": np.sqrt(self.moments.variance()),
+            "min": self.moments.min if self.moments.count > 0 else np.nan,
+        }
+        for fraction, value in zip(
+            quantiles, self.quantile_sketch.quantiles(quantiles)
+        ):
+            stats[format(fraction, ".0%")] = value
+        stats["max"] = self.moments.max if self.moments.count > 0 else np.nan
+        stats["approx_distinct"] = self.distinct_sketch.count()
+        stats["top_values"] = "; ".join(
+            str(value) + " (" + str(count) + ")"
+            for value, count in self.top_values.top(top_k).items()
+        )
+        return stats
+
+
+def merge_summaries(summaries, other_summaries):
+    """
+    Merge two dicts of column name -> ColumnSummary
+
+    Returns: dict with the merged summary of each column in either dict
+    """
+    for column, summary in other_summaries.items():
+        if column in summaries:
+            summaries[column].merge(summary)
+        else:
+            summaries[column] = summary
+    return summaries
+
+
+def profile_file(file_path, columns=default_columns, chunk_size=100000):
+    """
+    Summarize the columns of one csv, reading 'chunk_size' rows at a time
+
+    file_path: path to the csv
+    columns: names of the columns to summarize; columns that aren't in the file are skipped
+
+    Returns: dict of column name -> ColumnSummary
+    """
+    summaries = {}
+    chunks = pd.read_csv(
+        file_path,
+        usecols=lambda column: column in columns,
+        dtype=str,
+        chunksize=chunk_size,
+    )
+    for chunk in chunks:
+        for column in chunk.columns:
+            summaries.setdefault(column, ColumnSummary()).update(chunk[column])
+    return summaries
+
+
+def _profile_file(job):
+    return profile_file(*job)
+
+
+def profile_files(
+    file_paths, columns=default_columns, chunk_size=100000, max_workers=None
+):
+    """
+    Summarize the columns of many csvs, in parallel across processes, and merge the summaries
+
+    file_paths: list of paths to the csvs
+    columns: names of the columns to summarize
+    chunk_size: number of rows to read at a time
+    max_workers: number of processes to use (defaults to the number of cores)
+
+    Returns: dict of column name -> ColumnSummary of the values in every file
+    """
+    jobs = [(file_path, columns, chunk_size) for file_path in file_paths]
+    summaries = {}
+    with ProcessPoolExecutor(max_workers=max_workers or os.cpu_count()) as executor:
+        for file_path, file_summaries in zip(
+            file_paths, executor.map(_profile_file, jobs)
+        ):
+            merge_summaries(summaries, file_summaries)
+            print("Profiled", file_path)
+    return summaries
+
+
+def get_report(summaries, columns=default_columns):
+    """
+    Get a df of the summary statistics with one row per column, in the order of 'columns'
+    """
+    ordered = [column for column in columns if column in summaries]
+    return pd.DataFrame(
+        [summaries[column].to_dict() for column in ordered], index=ordered
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Summarize the columns of data exports without loading them into memory"
+    )
+    add_file_arguments(parser, "data")
+    parser.add_argument(
+        "--columns",
+        nargs="+",
+        default=default_columns,
+        help="columns to summarize",
+    )
+    parser.add_argument("--chunk-size", type=int, default=100000)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--output", default=default_output_path)
+    args = parser.parse_args()
+
+    file_paths = get_file_paths(args)
+
+    report = get_report(
+        profile_files(file_paths, args.columns, args.chunk_size, args.workers),
+        args.columns,
+    )
+    Path(args.output).parent.mkdir(parents=True, exist_ok=True)
+    report.to_csv(args.output)
+    print(report.to_string())
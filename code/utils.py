@@ -2,6 +2,10 @@ import os
 import numpy as np
 import pandas as pd
 from pathlib import Path
+from numpy.lib.stride_tricks import sliding_window_view
+
+# Multiply a BG in mmol/L by this to convert it to mg/dL
+mg_dl_per_mmol = 18.0182
 
 
 def extract_array(s):
@@ -181,7 +185,38 @@ def find_duration_of_gap(
 
         Returns: number of minutes where no BG data is present
     """
-    return bg_list.count(missing_data_key) * 5 + max(0, (180 / 5 - len(bg_list)) * 5)
+    return bg_list.count(missing_data_key) * time_interval + max(
+        0, (list_duration / time_interval - len(bg_list)) * time_interval
+    )
+
+
+def sliding_windows(values, window_length, hop=1, missing_value=-1, dtype=np.float32):
+    """
+    Get every window of 'window_length' consecutive values as read-only views into one array,
+    so the values aren't copied into each window
+
+    values: list or 1d array of values at a consistent interval (ex: BGs every 5 minutes)
+    window_length: number of values in each window
+    hop: number of values between the starts of consecutive windows
+    missing_value: the value given to missing values (NaNs are also treated as missing)
+    dtype: type to store the values as; the values are only copied if they aren't already this type
+
+    Returns: tuple of (2d array with one window per row,
+                       2d boolean array that's True where a window's value is missing),
+        where both arrays are empty if there are fewer than 'window_length' values
+    """
+    values = np.asarray(values, dtype=dtype)
+    is_missing = np.isnan(values) | (values == missing_value)
+
+    if len(values) < window_length:
+        return (
+            np.empty((0, window_length), dtype=dtype),
+            np.empty((0, window_length), dtype=bool),
+        )
+
+    windows = sliding_window_view(values, window_length)[::hop]
+    missing_windows = sliding_window_view(is_missing, window_length)[::hop]
+    return windows, missing_windows
 
 
 def find_full_path(resource_name, extension):
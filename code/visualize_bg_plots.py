@@ -1,44 +1,25 @@
 from pathlib import Path
-import pandas as pd
+import numpy as np
 import matplotlib.pyplot as plt
 from math import isnan
 from os.path import exists
 from utils import extract_array
+from row_offset_index import IndexedCSV
 
-# Get user inputs
-path = "/Users/annaquinlan/Desktop/diabetes-risk-analysis/data/risky_behavior_processed_doses.csv"#None
-while path == None or not exists(path):
-    path = input("Path to input file: ")
-    if not exists(path):
-        print("Path does not exist in computer, try again.")
-
-# Load the data in
-df = pd.read_csv(path)
-
-# Get index to examine
-file_index = -1
-while file_index < 2 or file_index > len(df) + 1:
-    try:
-        file_index = int(
-            input(
-                "What row number would you like visualized? (indexed including the csv"
-                " header) "
-            )
-        )
-    except:
-        print("Invalid entry; row must be between 2 and the size of the dataframe")
-        continue
-# convert to zero-indexed location
-file_index -= 2
-
-while True:
-#for file_index in range(0, len(df)):
-    # Get times & values
-    before_event_values = extract_array(df["bgs_before"].iloc[file_index])
-    after_event_values = extract_array(df["bgs_after"].iloc[file_index])
-
-    if not isnan(df["bgInput"].iloc[file_index]):
-        event_bg = df["bgInput"].iloc[file_index]
+
+def get_bg_tracing(dose):
+    """
+    Get the BGs around a dose, relative to the time of the dose
+
+    dose: row of a processed dose file, with "bgs_before", "bgs_after" & "bgInput" values
+
+    Returns: tuple of (list of minutes since the dose, list of BGs in mg/dL, BG at the dose in mg/dL)
+    """
+    before_event_values = extract_array(dose["bgs_before"])
+    after_event_values = extract_array(dose["bgs_after"])
+
+    if not isnan(dose["bgInput"]):
+        event_bg = dose["bgInput"]
     elif (
         len(before_event_values) > 0
         and len(after_event_values) > 0
@@ -63,33 +44,120 @@ while True:
     all_bg_values = [round(val * 18.0182, 3) for val in all_bg_values]
     event_bg *= 18.0182
 
-    # Print out the data for the measurement
-    print(df.iloc[file_index])
+    return all_times, all_bg_values, event_bg
+
+
+def downsample_tracing(times, bg_values, max_points):
+    """
+    Reduce the number of points in a long BG tracing, keeping the lowest & highest BG in
+    each of 'max_points' / 2 equal time buckets so that lows & highs are still visible.
+    Missing BGs (which are plotted below the axes) are dropped.
+
+    times: list of minutes since the dose
+    bg_values: list of BGs in mg/dL, where missing BGs are negative
+    max_points: maximum number of points to keep
+
+    Returns: tuple of (array of the kept times, array of the kept BGs)
+    """
+    times = np.asarray(times, dtype=float)
+    bg_values = np.asarray(bg_values, dtype=float)
+    is_present = bg_values >= 0
+    times, bg_values = times[is_present], bg_values[is_present]
+    if len(times) <= max_points:
+        return times, bg_values
+
+    buckets = np.array_split(np.arange(len(times)), max(max_points // 2, 1))
+    kept = np.unique(
+        [
+            index
+            for bucket in buckets
+            for index in [
+                bucket[bg_values[bucket].argmin()],
+                bucket[bg_values[bucket].argmax()],
+            ]
+        ]
+    )
+    return times[kept], bg_values[kept]
+
+
+def plot_bg_tracing(
+    dose, ax=None, title="Example Blood Glucose Tracing", max_points=None
+):
+    """
+    Plot the BGs around a dose
 
-    # Plot the graph
-    max_y = max(150, max(all_bg_values) + 10)
+    dose: row of a processed dose file, with "bgs_before", "bgs_after" & "bgInput" values
+    ax: matplotlib axes to plot on; defaults to the current axes
+    max_points: maximum number of BGs to plot; longer tracings are downsampled
+                with 'downsample_tracing'
+
+    Returns: the axes
+    """
+    ax = ax if ax is not None else plt.gca()
+    all_times, all_bg_values, event_bg = get_bg_tracing(dose)
+    if max_points is not None:
+        all_times, all_bg_values = downsample_tracing(
+            all_times, all_bg_values, max_points
+        )
+
+    max_y = max(150, max(all_bg_values, default=0) + 10)
     min_y = 30
-    plt.ylim(min_y, max_y)
-    plt.scatter(all_times, all_bg_values)
+    ax.set_ylim(min_y, max_y)
+    ax.scatter(all_times, all_bg_values)
     # Plot the BG at the abnormal event as a star
-    plt.scatter([0], [event_bg], marker="o", s=100)
-    plt.title("Example Blood Glucose Tracing")#"Dose at Row " + str(file_index + 2))
-    plt.xlabel("Minutes since dose event")
-    plt.ylabel("BG (mg/dL)")
-
-    plt.show()
-
-    try:
-        file_index = (
-            int(
-                input(
-                    "What row number would you like visualized? (indexed including the"
-                    " csv header) "
-                )
+    ax.scatter([0], [event_bg], marker="o", s=100)
+    ax.set_title(title)
+    ax.set_xlabel("Minutes since dose event")
+    ax.set_ylabel("BG (mg/dL)")
+    return ax
+
+
+def get_row_number():
+    """Prompt for the row number to visualize, converted to a zero-indexed location"""
+    return (
+        int(
+            input(
+                "What row number would you like visualized? (indexed including the"
+                " csv header) "
             )
-            - 2
         )
-        assert file_index >= 0 and file_index < len(df) + 1
-    except:
-        print("Quitting...")
-        break
+        - 2
+    )
+
+
+if __name__ == "__main__":
+    # Get user inputs
+    path = "/Users/annaquinlan/Desktop/diabetes-risk-analysis/data/risky_behavior_processed_doses.csv"  # None
+    while path == None or not exists(path):
+        path = input("Path to input file: ")
+        if not exists(path):
+            print("Path does not exist in computer, try again.")
+
+    # Open the file with a row index, so only the rows that are visualized are loaded
+    doses = IndexedCSV(path)
+
+    # Get index to examine
+    file_index = -1
+    while file_index < 0 or file_index >= len(doses):
+        try:
+            file_index = get_row_number()
+        except:
+            print("Invalid entry; row must be between 2 and the size of the dataframe")
+            continue
+
+    while True:
+        dose = doses.get_row(file_index)
+
+        # Print out the data for the measurement
+        print(dose)
+
+        # Plot the graph
+        plot_bg_tracing(dose)
+        plt.show()
+
+        try:
+            file_index = get_row_number()
+            assert file_index >= 0 and file_index < len(doses)
+        except:
+            print("Quitting...")
+            break